@@ -0,0 +1,392 @@
+"""End-to-end HTTPMR benchmark, run against a local datastore stand-in.
+
+Fills an in-memory stand-in for google.appengine.ext.db (see stubs/) with a
+synthetic corpus, serves the construct_document_index job from a local
+keep-alive HTTP server and runs it with the real Master handler and
+httpmr.driver.  For every phase, reports the wall time, the records processed
+per second and the datastore calls made, then checks the index that was built.
+
+Sample usage:
+
+  python benchmark/run_benchmark.py --documents 500 --vocabulary_size 2000 \
+      --skew 1.1 --max_operations_inflight 10
+
+--slow_request_fraction and --slow_request_sec delay a random fraction of the
+operation requests, to exercise the driver's --speculative_execution.
+
+--local runs the same job with httpmr.local.LocalRunner instead; worker
+processes count their own datastore calls, so only calls made by the parent
+process are reported in that mode.
+"""
+
+import BaseHTTPServer
+import bisect
+import logging
+import optparse
+import os
+import random
+import SocketServer
+import sys
+import threading
+import time
+
+_BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(_BENCHMARK_DIR, "stubs"))
+sys.path.insert(0, os.path.join(os.path.dirname(_BENCHMARK_DIR), "src"))
+
+from google.appengine.ext import db
+from google.appengine.ext import webapp
+import construct_document_index
+from httpmr import appengine
+from httpmr import driver
+
+JOB_PATH = "/construct_document_index"
+
+# The statistic counting each phase's records, as reported by the Master.
+MAP_RECORDS_STATISTIC = "map-count"
+REDUCE_RECORDS_STATISTIC = "reduce-count"
+CLEAN_RECORDS_STATISTIC = "clean-count"
+
+
+class WSGIRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+  """Serves GET requests from a WSGI application over keep-alive HTTP/1.1."""
+
+  protocol_version = "HTTP/1.1"
+
+  def log_message(self, format, *args):
+    pass
+
+  def do_GET(self):
+    path, unused_separator, query = self.path.partition("?")
+    if ("%s=%s" % (driver.TASK, driver.MAPPER_TASK_NAME) in query.split("&")
+        and self.server.random.random() < self.server.slow_request_fraction):
+      time.sleep(self.server.slow_request_sec)
+    environ = {"PATH_INFO": path,
+               "QUERY_STRING": query,
+               "SERVER_NAME": self.server.server_address[0],
+               "SERVER_PORT": str(self.server.server_port),
+               "HTTP_HOST": self.headers.get("Host"),
+               "wsgi.url_scheme": "http"}
+    response = []
+    def StartResponse(status, headers):
+      response.append((status, headers))
+    try:
+      body = "".join(self.server.application(environ, StartResponse))
+    except Exception:
+      logging.exception("Error serving %s" % self.path)
+      self.send_response(500)
+      self.send_header("Content-Length", "0")
+      self.end_headers()
+      return
+    (status, headers) = response[0]
+    (code, unused_separator, reason) = status.partition(" ")
+    self.send_response(int(code), reason)
+    for (name, value) in headers:
+      self.send_header(name, value)
+    self.end_headers()
+    self.wfile.write(body)
+
+
+class WSGIServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+
+  daemon_threads = True
+
+  def __init__(self, application, slow_request_fraction=0, slow_request_sec=0,
+               seed=None):
+    BaseHTTPServer.HTTPServer.__init__(self,
+                                       ("127.0.0.1", 0),
+                                       WSGIRequestHandler)
+    self.application = application
+    self.slow_request_fraction = slow_request_fraction
+    self.slow_request_sec = slow_request_sec
+    self.random = random.Random(seed)
+
+
+def GenerateCorpus(num_documents, vocabulary_size, words_per_document, skew,
+                   seed):
+  """Generate a synthetic corpus of (title, contents) documents.
+
+  Words are drawn from a Zipf-like distribution, in which the i-th word of the
+  vocabulary appears with weight 1 / (i + 1) ** skew.  A skew of 0 draws every
+  word uniformly, larger skews concentrate the corpus on a few hot tokens.
+  """
+  generator = random.Random(seed)
+  vocabulary = ["token%d" % i for i in xrange(vocabulary_size)]
+  cumulative_weights = []
+  total_weight = 0.0
+  for i in xrange(vocabulary_size):
+    total_weight += 1.0 / (i + 1) ** skew
+    cumulative_weights.append(total_weight)
+  documents = []
+  for i in xrange(num_documents):
+    words = []
+    for j in xrange(words_per_document):
+      index = bisect.bisect_left(cumulative_weights,
+                                 generator.random() * total_weight)
+      words.append(vocabulary[min(index, vocabulary_size - 1)])
+    title = "%08x-%06d" % (generator.getrandbits(32), i)
+    documents.append((title, " ".join(words)))
+  return documents
+
+
+def LoadCorpus(documents):
+  """Store the corpus, returning the document index it should produce."""
+  expected_index = {}
+  models = []
+  for (title, contents) in documents:
+    models.append(construct_document_index.Document(title=title,
+                                                    contents=contents))
+    for token in contents.split(" "):
+      expected_index.setdefault(token, set()).add(title)
+  for i in xrange(0, len(models), appengine.MAX_DATASTORE_BATCH_SIZE):
+    db.put(models[i:i + appengine.MAX_DATASTORE_BATCH_SIZE])
+  return expected_index
+
+
+def CheckIndex(expected_index):
+  """Check the stored document index against the expected index.
+
+  Returns:
+    A list of problems found, empty if the index is correct.
+  """
+  problems = []
+  index = {}
+  for entry in construct_document_index.DocumentIndex.all():
+    if entry.token in index:
+      problems.append("Token %s indexed more than once" % entry.token)
+    if len(entry.document_titles) != len(set(entry.document_titles)):
+      problems.append("Token %s lists a document twice" % entry.token)
+    index.setdefault(entry.token, set()).update(entry.document_titles)
+  for token in expected_index:
+    if token not in index:
+      problems.append("Token %s is missing" % token)
+    elif index[token] != expected_index[token]:
+      problems.append("Token %s lists the wrong documents" % token)
+  for token in index:
+    if token not in expected_index:
+      problems.append("Token %s should not be indexed" % token)
+  intermediate_values = appengine.IntermediateValueHolder.all().count()
+  if intermediate_values:
+    problems.append("%d intermediate values were left behind" %
+                    intermediate_values)
+  return problems
+
+
+class PhaseRecorder(object):
+  """Records the wall time, records and datastore calls of each phase."""
+
+  def __init__(self, get_statistics):
+    self._get_statistics = get_statistics
+    self.phases = []
+    self.notes = []
+
+  def Run(self, name, records_statistics, function):
+    statistics_before = self._get_statistics()
+    calls_before = db.GetCallCounts()
+    start_time = time.time()
+    function()
+    elapsed_sec = time.time() - start_time
+    statistics_after = self._get_statistics()
+    calls_after = db.GetCallCounts()
+    records = {}
+    for statistic in records_statistics:
+      records[statistic] = (statistics_after.get(statistic, 0) -
+                            statistics_before.get(statistic, 0))
+    calls = {}
+    for call in calls_after:
+      calls[call] = calls_after[call] - calls_before.get(call, 0)
+    self.phases.append((name, elapsed_sec, records, calls))
+
+  def Report(self):
+    lines = []
+    for (name, elapsed_sec, records, calls) in self.phases:
+      lines.append("%-20s %8.3f sec" % (name, elapsed_sec))
+      for record_name in sorted(records):
+        lines.append("  %-18s %8d records %10.1f records/sec" %
+                     (record_name,
+                      records[record_name],
+                      records[record_name] / max(elapsed_sec, 1e-9)))
+      for call in sorted(calls):
+        lines.append("  datastore %-8s %8d calls" % (call, calls[call]))
+    lines.extend(self.notes)
+    return "\n".join(lines)
+
+
+def RunDriverBenchmark(options):
+  application = webapp.WSGIApplication(
+      [(JOB_PATH, construct_document_index.ConstructDocumentIndexMapReduce)])
+  server = WSGIServer(application,
+                      options.slow_request_fraction,
+                      options.slow_request_sec,
+                      options.seed)
+  server_thread = threading.Thread(target=server.serve_forever)
+  server_thread.setDaemon(True)
+  server_thread.start()
+
+  httpmr_driver = driver.HTTPMRDriver(
+      "http://127.0.0.1:%d%s" % (server.server_port, JOB_PATH),
+      max_operation_tries=options.max_operation_tries,
+      max_operations_inflight=options.max_operations_inflight,
+      response_format=options.response_format,
+      pipelined_cleanup=not options.no_pipelined_cleanup,
+      speculative_execution=options.speculative_execution)
+  recorder = PhaseRecorder(httpmr_driver.GetAggregateResults)
+  recorder.Run("map", [MAP_RECORDS_STATISTIC], httpmr_driver.Map)
+  if options.no_pipelined_cleanup:
+    recorder.Run("reduce", [REDUCE_RECORDS_STATISTIC], httpmr_driver.Reduce)
+    recorder.Run("cleanup", [CLEAN_RECORDS_STATISTIC], httpmr_driver.Cleanup)
+  else:
+    recorder.Run("reduce and cleanup",
+                 [REDUCE_RECORDS_STATISTIC, CLEAN_RECORDS_STATISTIC],
+                 httpmr_driver.ReduceAndCleanup)
+  server.shutdown()
+  if options.speculative_execution:
+    statistics = httpmr_driver.GetAggregateResults()
+    for name in sorted(statistics):
+      if name.startswith("speculative-"):
+        recorder.notes.append("%s %s" % (name, statistics[name]))
+  return recorder
+
+
+def RunLocalBenchmark(options):
+  statistics = {}
+  def Run():
+    statistics.update(construct_document_index.RunLocally(
+        options.num_processes))
+  recorder = PhaseRecorder(lambda: dict(statistics))
+  recorder.Run("local run",
+               ["map-count", "intermediate-values", "reduce-count"],
+               Run)
+  return recorder
+
+
+def main():
+  options_parser = optparse.OptionParser()
+  options_parser.add_option("--documents",
+                            action="store",
+                            type="int",
+                            dest="documents",
+                            default=200,
+                            help="The number of documents in the corpus.")
+  options_parser.add_option("--vocabulary_size",
+                            action="store",
+                            type="int",
+                            dest="vocabulary_size",
+                            default=1000,
+                            help="The number of distinct words in the corpus.")
+  options_parser.add_option("--words_per_document",
+                            action="store",
+                            type="int",
+                            dest="words_per_document",
+                            default=50,
+                            help="The number of words in each document.")
+  options_parser.add_option("--skew",
+                            action="store",
+                            type="float",
+                            dest="skew",
+                            default=1.0,
+                            help="The Zipf exponent of the word distribution,"
+                                + " 0 for uniform.")
+  options_parser.add_option("--seed",
+                            action="store",
+                            type="int",
+                            dest="seed",
+                            default=1,
+                            help="The seed of the corpus generator.")
+  options_parser.add_option("--max_operations_inflight",
+                            action="store",
+                            type="int",
+                            dest="max_operations_inflight",
+                            default=10,
+                            help="The maximum number of operations to keep "
+                                + "simultaneously inflight.  -1 for inf.")
+  options_parser.add_option("--max_operation_tries",
+                            action="store",
+                            type="int",
+                            dest="max_operation_tries",
+                            default=3,
+                            help="The maximum number of times any operation "
+                                + "may be tried.")
+  options_parser.add_option("--response_format",
+                            action="store",
+                            type="choice",
+                            choices=[driver.JSON_RESPONSE_FORMAT,
+                                     driver.HTML_RESPONSE_FORMAT],
+                            dest="response_format",
+                            default=driver.JSON_RESPONSE_FORMAT,
+                            help="The format HTTPMR should respond in.")
+  options_parser.add_option("--no_pipelined_cleanup",
+                            action="store_true",
+                            dest="no_pipelined_cleanup",
+                            default=False,
+                            help="Run the cleanup phase after the whole "
+                                + "reduce phase.")
+  options_parser.add_option("--speculative_execution",
+                            action="store_true",
+                            dest="speculative_execution",
+                            default=False,
+                            help="Let the driver duplicate straggling "
+                                + "operations.")
+  options_parser.add_option("--slow_request_fraction",
+                            action="store",
+                            type="float",
+                            dest="slow_request_fraction",
+                            default=0,
+                            help="The fraction of mapper requests to delay.")
+  options_parser.add_option("--slow_request_sec",
+                            action="store",
+                            type="float",
+                            dest="slow_request_sec",
+                            default=5,
+                            help="How long to delay each delayed request.")
+  options_parser.add_option("--local",
+                            action="store_true",
+                            dest="local",
+                            default=False,
+                            help="Run the job with the local runner instead "
+                                + "of the driver.")
+  options_parser.add_option("--num_processes",
+                            action="store",
+                            type="int",
+                            dest="num_processes",
+                            default=None,
+                            help="The number of local runner processes.")
+  options_parser.add_option("-v",
+                            "--verbose",
+                            action="store_true",
+                            dest="verbose",
+                            default=False,
+                            help="Log the driver's progress.")
+  (options, args) = options_parser.parse_args()
+  logging.basicConfig(level=options.verbose and logging.INFO or logging.ERROR,
+                      format='%(asctime)s %(levelname)-8s %(message)s',
+                      stream=sys.stderr)
+
+  documents = GenerateCorpus(options.documents,
+                             options.vocabulary_size,
+                             options.words_per_document,
+                             options.skew,
+                             options.seed)
+  expected_index = LoadCorpus(documents)
+  print "Corpus: %d documents, %d distinct tokens" % (len(documents),
+                                                       len(expected_index))
+
+  start_time = time.time()
+  if options.local:
+    recorder = RunLocalBenchmark(options)
+  else:
+    recorder = RunDriverBenchmark(options)
+  elapsed_sec = time.time() - start_time
+  print recorder.Report()
+  print "%-20s %8.3f sec" % ("total", elapsed_sec)
+
+  problems = CheckIndex(expected_index)
+  for problem in problems:
+    print "ERROR: %s" % problem
+  if problems:
+    sys.exit(1)
+  print "Index is correct."
+
+
+if __name__ == "__main__":
+  main()
@@ -0,0 +1,430 @@
+"""An in-memory stand-in for the parts of google.appengine.ext.db HTTPMR uses.
+
+Entities live in a process-wide dict guarded by a lock, so the stand-in can be
+shared by a threaded HTTP server.  Every call that would be a datastore round
+trip on AppEngine is counted in CALL_COUNTS.
+"""
+
+import base64
+import bisect
+import copy
+import itertools
+import pickle
+import threading
+
+
+class Error(Exception): pass
+class BadValueError(Error): pass
+class BadQueryError(Error): pass
+class BadArgumentError(Error): pass
+
+
+_lock = threading.RLock()
+_entities = {}
+_id_sequence = itertools.count(1)
+# Every model class, by kind, for loading entities by key.
+_model_classes = {}
+CALL_COUNTS = {}
+
+
+def _CountCall(name):
+  CALL_COUNTS[name] = CALL_COUNTS.get(name, 0) + 1
+
+
+def Reset():
+  """Drop every stored entity and zero the call counters."""
+  _lock.acquire()
+  try:
+    _entities.clear()
+    CALL_COUNTS.clear()
+  finally:
+    _lock.release()
+
+
+def GetCallCounts():
+  _lock.acquire()
+  try:
+    return dict(CALL_COUNTS)
+  finally:
+    _lock.release()
+
+
+class Key(object):
+
+  def __init__(self, kind, id_or_name):
+    self._kind = kind
+    self._id = id_or_name
+
+  @classmethod
+  def from_path(cls, kind, id_or_name):
+    return cls(kind, id_or_name)
+
+  def kind(self):
+    return self._kind
+
+  def id(self):
+    if isinstance(self._id, basestring):
+      return None
+    return self._id
+
+  def name(self):
+    if isinstance(self._id, basestring):
+      return self._id
+    return None
+
+  def _Tuple(self):
+    return (self._kind, self._id)
+
+  def __cmp__(self, other):
+    if not isinstance(other, Key):
+      return cmp(type(self).__name__, type(other).__name__)
+    return cmp(self._Tuple(), other._Tuple())
+
+  def __hash__(self):
+    return hash(self._Tuple())
+
+  def __str__(self):
+    return "%s:%s" % self._Tuple()
+
+  __repr__ = __str__
+
+
+class Property(object):
+
+  data_type = object
+
+  def __init__(self, verbose_name=None, required=False, default=None,
+               indexed=True):
+    self.required = required
+    self.default = default
+    self.indexed = indexed
+    self.name = None
+
+  def __get__(self, instance, owner):
+    if instance is None:
+      return self
+    return instance._values.get(self.name, self.default)
+
+  def __set__(self, instance, value):
+    instance._values[self.name] = self.Validate(value)
+
+  def Validate(self, value):
+    if value is None:
+      if self.required:
+        raise BadValueError("Property %s is required" % self.name)
+      return value
+    if not isinstance(value, self.data_type):
+      raise BadValueError("Property %s must be %s, not %s" %
+                          (self.name, self.data_type, type(value)))
+    return value
+
+
+class StringProperty(Property):
+  data_type = basestring
+
+
+class Text(unicode): pass
+
+
+class TextProperty(Property):
+  data_type = basestring
+
+  def __init__(self, *args, **kwargs):
+    kwargs["indexed"] = False
+    Property.__init__(self, *args, **kwargs)
+
+  def Validate(self, value):
+    # Like the real TextProperty, convert numbers and the like.  Strings are
+    # kept as they are, since the stub webapp passes request parameters on
+    # undecoded.
+    if value is not None and not isinstance(value, basestring):
+      value = Text(value)
+    return Property.Validate(self, value)
+
+
+class Blob(str): pass
+
+
+class BlobProperty(Property):
+  data_type = str
+
+  def __init__(self, *args, **kwargs):
+    kwargs["indexed"] = False
+    Property.__init__(self, *args, **kwargs)
+
+
+class IntegerProperty(Property):
+  data_type = (int, long)
+
+
+class FloatProperty(Property):
+  data_type = float
+
+
+class BooleanProperty(Property):
+  data_type = bool
+
+
+class ListProperty(Property):
+
+  def __init__(self, item_type, *args, **kwargs):
+    Property.__init__(self, *args, **kwargs)
+    self.item_type = item_type
+    if self.default is None:
+      self.default = []
+
+  def Validate(self, value):
+    if value is None:
+      value = []
+    return list(value)
+
+
+class StringListProperty(ListProperty):
+
+  def __init__(self, *args, **kwargs):
+    ListProperty.__init__(self, basestring, *args, **kwargs)
+
+
+class _PropertiedClass(type):
+
+  def __init__(cls, name, bases, dct):
+    type.__init__(cls, name, bases, dct)
+    properties = {}
+    for base in bases:
+      properties.update(getattr(base, "_properties", {}))
+    for attr_name, attr in dct.items():
+      if isinstance(attr, Property):
+        attr.name = attr_name
+        properties[attr_name] = attr
+    cls._properties = properties
+    _model_classes[name] = cls
+
+
+class Model(object):
+
+  __metaclass__ = _PropertiedClass
+
+  def __init__(self, key_name=None, **kwargs):
+    self._values = {}
+    self._key = None
+    if key_name is not None:
+      if key_name[:1].isdigit():
+        raise BadValueError("Names may not begin with a digit")
+      self._key = Key(self.kind(), key_name)
+    for name, prop in self._properties.items():
+      if name in kwargs:
+        setattr(self, name, kwargs[name])
+      elif prop.required and prop.default is None:
+        raise BadValueError("Property %s is required" % name)
+
+  @classmethod
+  def kind(cls):
+    return cls.__name__
+
+  @classmethod
+  def all(cls, keys_only=False, projection=None):
+    return Query(cls, keys_only=keys_only, projection=projection)
+
+  @classmethod
+  def properties(cls):
+    return dict(cls._properties)
+
+  def key(self):
+    return self._key
+
+  def is_saved(self):
+    return self._key is not None and self._key in _entities.get(self.kind(), {})
+
+  def put(self):
+    return put(self)
+
+  def delete(self):
+    delete(self)
+
+  def __repr__(self):
+    return "%s(%r)" % (self.kind(), self._values)
+
+
+def _AsList(values):
+  if isinstance(values, (list, tuple)):
+    return list(values), True
+  return [values], False
+
+
+def put(models):
+  models, multiple = _AsList(models)
+  _lock.acquire()
+  try:
+    _CountCall("put")
+    keys = []
+    for model in models:
+      if model._key is None:
+        model._key = Key(model.kind(), _id_sequence.next())
+      _entities.setdefault(model.kind(), {})[model._key] = \
+          copy.deepcopy(model._values)
+      keys.append(model._key)
+  finally:
+    _lock.release()
+  if multiple:
+    return keys
+  return keys[0]
+
+
+def get(keys):
+  keys, multiple = _AsList(keys)
+  _lock.acquire()
+  try:
+    _CountCall("get")
+    models = []
+    for key in keys:
+      values = _entities.get(key.kind(), {}).get(key)
+      model = None
+      if values is not None:
+        model = _Load(_model_classes[key.kind()], key, values)
+      models.append(model)
+  finally:
+    _lock.release()
+  if multiple:
+    return models
+  return models[0]
+
+
+def delete(models):
+  models, multiple = _AsList(models)
+  _lock.acquire()
+  try:
+    _CountCall("delete")
+    for model in models:
+      key = model
+      if isinstance(model, Model):
+        key = model.key()
+      _entities.get(key.kind(), {}).pop(key, None)
+  finally:
+    _lock.release()
+
+
+def _Load(model_class, key, values):
+  model = model_class.__new__(model_class)
+  model._values = copy.deepcopy(values)
+  model._key = key
+  return model
+
+
+_OPERATORS = {"=": lambda a, b: a == b,
+              "==": lambda a, b: a == b,
+              ">": lambda a, b: a > b,
+              ">=": lambda a, b: a >= b,
+              "<": lambda a, b: a < b,
+              "<=": lambda a, b: a <= b}
+
+
+class Query(object):
+
+  def __init__(self, model_class, keys_only=False, projection=None):
+    self._model_class = model_class
+    self._keys_only = keys_only
+    self._projection = projection
+    self._filters = []
+    self._orders = []
+    self._cursor = None
+    self._end_cursor = None
+
+  def filter(self, property_operator, value):
+    parts = property_operator.split()
+    if len(parts) == 1:
+      parts.append("=")
+    name, operator = parts
+    if operator not in _OPERATORS:
+      raise BadQueryError("Unsupported operator %s" % operator)
+    self._filters.append((name, operator, value))
+    return self
+
+  def order(self, property_name):
+    self._orders.append(property_name)
+    return self
+
+  def _PropertyValue(self, key, values, name):
+    if name == "__key__":
+      return key
+    return values.get(name)
+
+  def _Matches(self, key, values):
+    for name, operator, value in self._filters:
+      entity_value = self._PropertyValue(key, values, name)
+      if isinstance(entity_value, list):
+        if not [item for item in entity_value
+                if _OPERATORS[operator](item, value)]:
+          return False
+      elif entity_value is None and name != "__key__":
+        return False
+      elif not _OPERATORS[operator](entity_value, value):
+        return False
+    return True
+
+  def _SortKey(self, key, values):
+    sort_key = []
+    for name in self._orders:
+      descending = name.startswith("-")
+      name = name.lstrip("-")
+      value = self._PropertyValue(key, values, name)
+      if descending:
+        raise BadQueryError("Descending orders are not supported")
+      sort_key.append(value)
+    sort_key.append(key)
+    return tuple(sort_key)
+
+  def _Run(self):
+    _lock.acquire()
+    try:
+      rows = []
+      for key, values in _entities.get(self._model_class.kind(), {}).items():
+        if self._Matches(key, values):
+          rows.append((self._SortKey(key, values), key, values))
+      rows.sort()
+      return rows
+    finally:
+      _lock.release()
+
+  def _Result(self, row):
+    if self._keys_only:
+      return row[1]
+    values = row[2]
+    if self._projection is not None:
+      values = dict([(name, values.get(name)) for name in self._projection])
+    return _Load(self._model_class, row[1], values)
+
+  def fetch(self, limit, offset=0):
+    _CountCall("query")
+    rows = self._Run()
+    if self._cursor is not None:
+      sort_keys = [row[0] for row in rows]
+      rows = rows[bisect.bisect_right(sort_keys, self._cursor):]
+    rows = rows[offset:offset + limit]
+    self._end_cursor = self._cursor
+    if rows:
+      self._end_cursor = rows[-1][0]
+    return [self._Result(row) for row in rows]
+
+  def cursor(self):
+    """Get a websafe cursor just past the last result fetched."""
+    return base64.urlsafe_b64encode(pickle.dumps(self._end_cursor))
+
+  def with_cursor(self, start_cursor):
+    self._cursor = pickle.loads(base64.urlsafe_b64decode(str(start_cursor)))
+    return self
+
+  def get(self):
+    results = self.fetch(1)
+    if results:
+      return results[0]
+    return None
+
+  def count(self, limit=None):
+    _CountCall("query")
+    count = len(self._Run())
+    if limit is not None:
+      count = min(count, limit)
+    return count
+
+  def __iter__(self):
+    return iter(self.fetch(1000000))
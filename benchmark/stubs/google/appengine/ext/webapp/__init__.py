@@ -0,0 +1,74 @@
+"""A stand-in for the parts of google.appengine.ext.webapp HTTPMR uses."""
+
+import cgi
+import re
+import StringIO
+
+
+class Request(object):
+
+  def __init__(self, environ):
+    self.environ = environ
+    self.path = environ.get("PATH_INFO", "/")
+    host = environ.get("HTTP_HOST") or ("%s:%s" % (environ["SERVER_NAME"],
+                                                   environ["SERVER_PORT"]))
+    self.path_url = "%s://%s%s" % (environ.get("wsgi.url_scheme", "http"),
+                                   host,
+                                   self.path)
+    self.params = {}
+    for key, values in cgi.parse_qs(environ.get("QUERY_STRING", ""),
+                                    keep_blank_values=True).items():
+      self.params[key] = values[-1]
+
+  def get(self, name, default_value=""):
+    return self.params.get(name, default_value)
+
+
+class Response(object):
+
+  def __init__(self):
+    self.out = StringIO.StringIO()
+    self.headers = {"Content-Type": "text/html; charset=utf-8"}
+    self.status = 200
+
+  def set_status(self, status):
+    self.status = status
+
+
+class RequestHandler(object):
+
+  def initialize(self, request, response):
+    self.request = request
+    self.response = response
+
+  def error(self, code):
+    self.response.set_status(code)
+
+
+class WSGIApplication(object):
+
+  def __init__(self, url_mapping, debug=False):
+    self._url_mapping = [(re.compile("^%s$" % regexp), handler)
+                         for regexp, handler in url_mapping]
+
+  def __call__(self, environ, start_response):
+    request = Request(environ)
+    response = Response()
+    for regexp, handler_class in self._url_mapping:
+      match = regexp.match(request.path)
+      if match:
+        handler = handler_class()
+        handler.initialize(request, response)
+        handler.get(*match.groups())
+        break
+    else:
+      response.set_status(404)
+    body = response.out.getvalue()
+    if isinstance(body, unicode):
+      body = body.encode("utf-8")
+    headers = response.headers.items()
+    headers.append(("Content-Length", str(len(body))))
+    start_response("%d %s" % (response.status,
+                              response.status == 200 and "OK" or "Error"),
+                   headers)
+    return [body]
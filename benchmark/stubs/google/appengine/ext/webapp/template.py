@@ -0,0 +1,81 @@
+"""A minimal stand-in for the Django templates HTTPMR renders.
+
+Supports {% extends %}, {% block %}, {% if %}/{% else %}, {% for %} and
+{{ variable }}, which is all the HTTPMR templates use.
+"""
+
+import os
+import re
+
+_TOKEN = re.compile(r"({%.*?%}|{{.*?}})", re.S)
+
+
+def _Tokens(text):
+  return [token for token in _TOKEN.split(text) if token]
+
+
+def _Parse(tokens, end_tags=()):
+  nodes = []
+  while tokens:
+    token = tokens.pop(0)
+    if token.startswith("{%"):
+      words = token[2:-2].split()
+      if words[0] in end_tags:
+        return nodes, words[0]
+      if words[0] == "if":
+        body, end = _Parse(tokens, ("else", "endif"))
+        else_body = []
+        if end == "else":
+          else_body, end = _Parse(tokens, ("endif",))
+        nodes.append(("if", words[1], body, else_body))
+      elif words[0] == "for":
+        body, end = _Parse(tokens, ("endfor",))
+        nodes.append(("for", words[1], words[3], body))
+      elif words[0] == "block":
+        body, end = _Parse(tokens, ("endblock",))
+        nodes.append(("block", words[1], body))
+      elif words[0] == "extends":
+        nodes.append(("extends", words[1].strip("\"'")))
+    elif token.startswith("{{"):
+      nodes.append(("var", token[2:-2].strip()))
+    else:
+      nodes.append(("text", token))
+  return nodes, None
+
+
+def _Render(nodes, data, blocks):
+  out = []
+  for node in nodes:
+    if node[0] == "text":
+      out.append(node[1])
+    elif node[0] == "var":
+      value = data.get(node[1], "")
+      if value is None:
+        value = ""
+      if isinstance(value, str):
+        value = value.decode("utf-8")
+      out.append(unicode(value))
+    elif node[0] == "if":
+      if data.get(node[1]):
+        out.append(_Render(node[2], data, blocks))
+      else:
+        out.append(_Render(node[3], data, blocks))
+    elif node[0] == "for":
+      for item in data.get(node[2], []):
+        loop_data = dict(data)
+        loop_data[node[1]] = item
+        out.append(_Render(node[3], loop_data, blocks))
+    elif node[0] == "block":
+      out.append(_Render(blocks.get(node[1], node[2]), data, blocks))
+  return "".join(out)
+
+
+def render(template_path, template_dict):
+  nodes, _ = _Parse(_Tokens(open(template_path).read()))
+  if nodes and [node for node in nodes if node[0] == "extends"]:
+    parent = [node for node in nodes if node[0] == "extends"][0][1]
+    blocks = dict((node[1], node[2]) for node in nodes if node[0] == "block")
+    parent_path = os.path.join(os.path.dirname(template_path), parent)
+    parent_nodes, _ = _Parse(_Tokens(open(parent_path).read()))
+    return _Render(parent_nodes, template_dict, blocks)
+  return _Render(nodes, template_dict, {})
@@ -2,6 +2,7 @@ import wsgiref
 from google.appengine.ext import webapp
 from httpmr import appengine
 from httpmr import base
+from httpmr import local
 from wsgiref import handlers
 from google.appengine.ext import db
 
@@ -37,13 +38,26 @@ class ConstructDocumentIndexMapReduce(appengine.AppEngineMaster):
     self.QuickInit("construct_token_index",
                    mapper=TokenMapper(),
                    reducer=TokenReducer(),
-                   source=appengine.AppEngineSource(Document.all(),
+                   source=appengine.AppEngineSource(Document.all,
                                                     "title"),
                    sink=appengine.AppEngineSink(),
                    intermediate_values_set_job_name=False,
                    intermediate_values_set_nonsense_value=False)
 
 
+def RunLocally(num_processes=None):
+  """Build the document index in-process, e.g. for backfills and tests."""
+  runner = local.LocalRunner().QuickInit("construct_token_index",
+                                         mapper=TokenMapper(),
+                                         reducer=TokenReducer(),
+                                         source=appengine.AppEngineSource(
+                                             Document.all, "title"),
+                                         sink=appengine.AppEngineSink())
+  if num_processes is not None:
+    runner.SetNumProcesses(num_processes)
+  return runner.Run()
+
+
 def main():
   application = webapp.WSGIApplication([('/construct_document_index',
                                          ConstructDocumentIndexMapReduce)],
@@ -1,16 +1,236 @@
+import copy
+import heapq
+import itertools
 import logging
 import random
 import sys
+import uuid
 from google.appengine.ext import db
 from httpmr import base
 from httpmr import master
+from httpmr import partitioners
+from httpmr import sharding
+
+
+# The AppEngine datastore accepts at most this many entities in a single batch
+# put or delete.
+MAX_DATASTORE_BATCH_SIZE = 500
+# The AppEngine datastore returns at most this many results for a single query.
+MAX_QUERY_RESULTS = 1000
+# AppEngineSource fetches models in chunks of at most this many, taking a
+# datastore cursor after each, so that a partly used batch is resumed from the
+# cursor of its last used chunk.
+SOURCE_CURSOR_CHUNK_SIZE = 100
+DEFAULT_INTERMEDIATE_WRITE_BATCH_SIZE = 100
+# Packed intermediate entities hold at most this many values, and this many
+# bytes of values, keeping them well under the datastore's entity size limit.
+MAX_PACKED_VALUES = 1000
+MAX_PACKED_BYTES = 500000
+# A packing sink writes out its buffered values once it holds this many.
+MAX_PACKING_BUFFERED_VALUES = 10000
+# Key samples are taken with at most this many queries per sampled key.
+KEY_SAMPLE_QUERIES_PER_KEY = 3
+# Points of the key space are computed from this many characters following
+# the common prefix of the keys they fall between.
+MIDPOINT_CHARACTERS = 3
 
 
 class IntermediateValueHolder(db.Model):
+  """An intermediate value, or a packed list of values for the same key.
+  
+  Exactly one of intermediate_value and intermediate_values is set, or for
+  values encoded by a job's Codec, one of intermediate_blob and
+  intermediate_blobs.
+  """
   job_name = db.StringProperty(required=False)
   nonsense = db.IntegerProperty(required=False)
   intermediate_key = db.StringProperty(required=True)
-  intermediate_value = db.TextProperty(required=True)
+  partition = db.IntegerProperty(required=False)
+  attempt = db.StringProperty(required=False)
+  intermediate_value = db.TextProperty(required=False)
+  intermediate_values = db.ListProperty(db.Text)
+  intermediate_blob = db.BlobProperty(required=False)
+  intermediate_blobs = db.ListProperty(db.Blob)
+
+
+def _GetIntermediateKeyName(num_values):
+  """Name an intermediate entity after the number of values it holds.
+  
+  Keys-only queries return the names, so that a scan can tell how many values
+  entities hold before fetching them, see IntermediateAppEngineSource#_Scan.
+  """
+  return "n%d:%s" % (num_values, uuid.uuid4().hex)
+
+
+def _GetIntermediateKeyValueCount(key):
+  """Get the number of values held by the entity with the key.
+  
+  Entities written before their keys were named are assumed to be full.
+  """
+  name = key.name()
+  if name is None or not name.startswith("n") or ":" not in name:
+    return MAX_PACKED_VALUES
+  return int(name[1:].split(":", 1)[0])
+
+
+class UnpackedIntermediateValue(object):
+  """One of the values of a packed IntermediateValueHolder.
+  
+  Has the same intermediate_key and intermediate_value attributes as an
+  unpacked IntermediateValueHolder, so that readers of intermediate values
+  needn't know whether they were packed.  Deleting it deletes the whole
+  packed holder.
+  """
+  
+  def __init__(self, holder, intermediate_value):
+    self.holder = holder
+    self.intermediate_key = holder.intermediate_key
+    self.intermediate_value = intermediate_value
+  
+  def delete(self):
+    self.holder.delete()
+
+
+def _UnpackIntermediateValues(holder, codec):
+  """Generate each of the intermediate values a holder holds.
+  
+  Values encoded by a Codec are decoded with codec.
+  """
+  if holder.intermediate_blobs:
+    for encoded_value in holder.intermediate_blobs:
+      yield UnpackedIntermediateValue(holder, codec.Decode(encoded_value))
+  elif holder.intermediate_blob is not None:
+    yield UnpackedIntermediateValue(holder,
+                                    codec.Decode(holder.intermediate_blob))
+  elif holder.intermediate_values:
+    for intermediate_value in holder.intermediate_values:
+      yield UnpackedIntermediateValue(holder, intermediate_value)
+  else:
+    yield holder
+
+
+def _ChunkPackedValues(values):
+  """Split a key's values into lists small enough for one packed entity."""
+  chunk = []
+  chunk_bytes = 0
+  for value in values:
+    if chunk and (len(chunk) >= MAX_PACKED_VALUES or
+                  chunk_bytes + len(value) > MAX_PACKED_BYTES):
+      yield chunk
+      chunk = []
+      chunk_bytes = 0
+    chunk.append(value)
+    chunk_bytes += len(value)
+  if chunk:
+    yield chunk
+
+
+def _GetCharacterRank(character):
+  """Rank a character among 256, giving every ASCII character its own rank."""
+  code = ord(character)
+  if code < 0x80:
+    return code
+  return min(0x80 + ((code - 0x80) >> 8), 0xFF)
+
+
+def _GetRankedCharacter(rank):
+  if rank < 0x80:
+    return unichr(rank)
+  return unichr(0x80 + ((rank - 0x80) << 8))
+
+
+def _GetMidpoint(low, high):
+  """Get a string roughly halfway between two strings, or None if none fits."""
+  prefix_length = 0
+  while (prefix_length < min(len(low), len(high)) and
+         low[prefix_length] == high[prefix_length]):
+    prefix_length += 1
+  
+  def ToNumber(string):
+    number = 0
+    for i in xrange(MIDPOINT_CHARACTERS):
+      rank = 0
+      if prefix_length + i < len(string):
+        rank = _GetCharacterRank(string[prefix_length + i])
+      number = (number << 8) + rank
+    return number
+  
+  middle = (ToNumber(low) + ToNumber(high)) // 2
+  characters = []
+  for i in xrange(MIDPOINT_CHARACTERS):
+    characters.insert(0, _GetRankedCharacter(middle & 0xFF))
+    middle >>= 8
+  point = (low[:prefix_length] + u"".join(characters)).rstrip(u"\x00")
+  if not low < point < high:
+    return None
+  return point
+
+
+def _GetBisectedKeySample(get_keys, count_keys, sample_size):
+  """Sample string keys by bisecting the key space, densest ranges first.
+  
+  get_keys(after, up_to, limit) fetches the first limit keys k with
+  after < k <= up_to, in order, and count_keys(after, up_to) counts those
+  keys, up to MAX_QUERY_RESULTS; an after of None means no lower limit.
+  
+  Fewer than MAX_QUERY_RESULTS keys are all fetched with a single query, and
+  sampled at evenly spaced positions.  Otherwise the range of the key space holding the most keys is
+  repeatedly split at its midpoint, the first key after the midpoint is
+  sampled, and both halves are counted.  Ranges whose counts are capped are
+  split breadth first.  Sampling costs at most KEY_SAMPLE_QUERIES_PER_KEY
+  single-entity fetches and capped counts per sampled key, whatever the size
+  of the data, and no offsets, which the datastore caps at MAX_QUERY_RESULTS.
+  
+  Returns:
+    A list of keys, or None if the keys are not strings.
+  """
+  top = sharding.GREATEST_UNICODE_CHARACTER.decode("utf-8")
+  num_keys = count_keys(None, top)
+  if num_keys < MAX_QUERY_RESULTS:
+    keys = get_keys(None, top, num_keys)
+    sample_size = min(sample_size, len(keys))
+    return [keys[i * len(keys) // sample_size] for i in xrange(sample_size)]
+  
+  first_key = get_keys(None, top, 1)[0]
+  if not isinstance(first_key, basestring):
+    logging.warning("Cannot bisect keys of %s, so cannot sample them." %
+                    type(first_key))
+    return None
+  keys = [first_key]
+  # A heap of (-number of keys, sequence, low, high), for the ranges
+  # low < k <= high that may hold more keys.
+  ranges = []
+  sequence = itertools.count()
+  def AddRange(num_keys, low, high):
+    if num_keys > 0:
+      heapq.heappush(ranges, (-num_keys, sequence.next(), low, high))
+  AddRange(num_keys, first_key, top)
+  queries = 2
+  while (ranges and len(keys) < sample_size and
+         queries < sample_size * KEY_SAMPLE_QUERIES_PER_KEY):
+    (num_keys, unused_sequence, low, high) = heapq.heappop(ranges)
+    num_keys = -num_keys
+    point = _GetMidpoint(low, high)
+    if point is None:
+      continue
+    high_keys = get_keys(point, high, 1)
+    queries += 1
+    if not high_keys:
+      # All of the range's keys are at or below the midpoint.
+      AddRange(num_keys, low, point)
+      continue
+    key = high_keys[0]
+    keys.append(key)
+    num_low_keys = count_keys(low, point)
+    queries += 1
+    if num_keys < MAX_QUERY_RESULTS:
+      num_high_keys = num_keys - num_low_keys - 1
+    else:
+      num_high_keys = count_keys(key, high)
+      queries += 1
+    AddRange(num_low_keys, low, point)
+    AddRange(num_high_keys, key, high)
+  return keys
 
 
 class AppEngineSink(base.Sink):
@@ -39,6 +259,18 @@ class AppEngineIntermediateSink(AppEngineSink):
     self.SetJobName(job_name)
     self.SetAddJobName(True)
     self.SetAddNonsenseValue(True)
+    self.SetWriteBatchSize(1)
+    self.SetPackValues(False)
+    self.SetPartitioner(None, None)
+    self.SetAttempt(None)
+    self.SetCodec(None)
+    self._buffer = []
+    self._buffered_values = 0
+    self._packing_buffer = {}
+    self._packing_buffered_values = 0
+    self._batches_written = 0
+    self._values_written = 0
+    self._packed_entities_written = 0
   
   def SetJobName(self, job_name):
     self._job_name = job_name
@@ -51,10 +283,81 @@ class AppEngineIntermediateSink(AppEngineSink):
     self._add_nonsense_value = add_nonsense_value
     return self
   
+  def SetWriteBatchSize(self, write_batch_size):
+    """Set the number of intermediate values buffered per datastore put.
+    
+    Intermediate values are collected in memory and written with a single batch
+    put whenever write_batch_size of them are buffered, and whenever the Master
+    flushes the sink at the end of a task.  A write_batch_size of 1 writes every
+    value through as soon as it is Put.
+    """
+    assert 1 <= write_batch_size <= MAX_DATASTORE_BATCH_SIZE
+    self._write_batch_size = write_batch_size
+    return self
+  
+  def SetPackValues(self, pack_values):
+    """Set whether the values Put for a key should be packed together.
+    
+    A packing sink holds on to the values Put for each key until it is
+    flushed, and then writes them as packed entities of up to
+    MAX_PACKED_VALUES values each (batched per write_batch_size entities), so
+    a key output many times by one task costs a single entity write rather
+    than one per value.  IntermediateAppEngineSource reads packed and unpacked
+    values alike.
+    """
+    self._pack_values = pack_values
+    return self
+  
+  def SetPartitioner(self, partitioner, num_partitions):
+    """Set the Partitioner that assigns each value to a reduce partition.
+    
+    The partition is stored on every intermediate entity, for the
+    IntermediateAppEngineSource and Cleaner to select one partition with.  A
+    partitioner of None leaves the intermediate values unpartitioned.
+    """
+    assert partitioner is None or isinstance(partitioner, base.Partitioner)
+    self._partitioner = partitioner
+    self._num_partitions = num_partitions
+    return self
+  
+  def SetAttempt(self, attempt):
+    self._attempt = attempt
+    return self
+  
+  def SetCodec(self, codec):
+    """Set the Codec that encodes every value Put, see base.Codec.
+    
+    Encoded values are stored as blobs, and must be read by an
+    IntermediateAppEngineSource with the same Codec.  A codec of None stores
+    the values as text, as they are Put.
+    """
+    assert codec is None or isinstance(codec, base.Codec)
+    self._codec = codec
+    return self
+  
   def Put(self, key, value):
-    intermediate_value = \
-        IntermediateValueHolder(intermediate_key=key,
-                                intermediate_value=value)
+    if self._codec is not None:
+      value = db.Blob(self._codec.Encode(value))
+    if self._pack_values:
+      if self._codec is None:
+        # Convert the value as a TextProperty would, before it is measured.
+        value = db.Text(unicode(value))
+      self._packing_buffer.setdefault(key, []).append(value)
+      self._packing_buffered_values += 1
+      if self._packing_buffered_values >= MAX_PACKING_BUFFERED_VALUES:
+        self.Flush()
+      return
+    if self._codec is not None:
+      holder = IntermediateValueHolder(key_name=_GetIntermediateKeyName(1),
+                                       intermediate_key=key,
+                                       intermediate_blob=value)
+    else:
+      holder = IntermediateValueHolder(key_name=_GetIntermediateKeyName(1),
+                                       intermediate_key=key,
+                                       intermediate_value=value)
+    self._Buffer(holder, 1)
+  
+  def _Buffer(self, intermediate_value, num_values):
     if self._add_nonsense_value:
       max = sys.maxint
       # For the intermediate value sink to function properly, we have to guarantee
@@ -70,8 +373,58 @@ class AppEngineIntermediateSink(AppEngineSink):
                     self._job_name)
       intermediate_value.job_name = self._job_name
     
-    logging.debug("Writing intermediate value: %s" % intermediate_value)
-    intermediate_value.put()
+    if self._partitioner is not None:
+      intermediate_value.partition = self._partitioner.Partition(
+          intermediate_value.intermediate_key, self._num_partitions)
+    
+    if self._attempt is not None:
+      intermediate_value.attempt = self._attempt
+    
+    logging.debug("Buffering intermediate value: %s" % intermediate_value)
+    self._buffer.append(intermediate_value)
+    self._buffered_values += num_values
+    if len(self._buffer) >= self._write_batch_size:
+      self._WriteBuffer()
+  
+  def Flush(self):
+    """Write all buffered intermediate values with batch puts."""
+    packing_buffer = self._packing_buffer
+    self._packing_buffer = {}
+    self._packing_buffered_values = 0
+    for key in packing_buffer:
+      for values in _ChunkPackedValues(packing_buffer[key]):
+        key_name = _GetIntermediateKeyName(len(values))
+        if self._codec is not None:
+          holder = IntermediateValueHolder(key_name=key_name,
+                                           intermediate_key=key,
+                                           intermediate_blobs=values)
+        else:
+          holder = IntermediateValueHolder(
+              key_name=key_name,
+              intermediate_key=key,
+              intermediate_values=values)
+        self._Buffer(holder, len(values))
+        self._packed_entities_written += 1
+    self._WriteBuffer()
+  
+  def _WriteBuffer(self):
+    if not self._buffer:
+      return
+    logging.debug("Writing batch of %d intermediate entities." %
+                  len(self._buffer))
+    try:
+      db.put(self._buffer)
+    except db.Error, e:
+      raise base.SinkError(e)
+    self._batches_written += 1
+    self._values_written += self._buffered_values
+    self._buffer = []
+    self._buffered_values = 0
+  
+  def GetCounters(self):
+    return {"intermediate-write-batches": self._batches_written,
+            "intermediate-write-batch-values": self._values_written,
+            "intermediate-packed-entities": self._packed_entities_written}
                             
 
 class AppEngineSource(base.Source):
@@ -95,29 +448,147 @@ class AppEngineSource(base.Source):
       query.filter("%s <= " % key_parameter, end_point)
       for entry in query.fetch():
         mapper.Map(getattr(entry, key_parameter), entry)
+    
+    The base query may instead be given as a function that builds it, taking
+    the keyword arguments of Model.all, so that the source can build
+    projection queries, see SetFields:
+    
+      source = AppEngineSource(
+          lambda **kwds: Story.all(**kwds).filter('active = True'), 'title')
 
     Args:
       base_query: A db.Query instance that defines the base filters for
-        all mapper operations
+        all mapper operations, or a function returning a new one
       key_parameter: The parameter of the model that will be retrieved by the
         base_query that should be used as the mapper key, and which will be
         used to shard map operations.
     """
-    assert isinstance(base_query, db.Query)
+    assert isinstance(base_query, db.Query) or callable(base_query)
     self.base_query = base_query
     self.key_parameter = key_parameter
+    self.SetFields(None)
+    self.SetCursor(None)
+  
+  def SetFields(self, fields):
+    """Fetch only the named properties of each model, rather than whole models.
+    
+    The models are fetched with a projection query, so that large properties
+    the Mapper never reads (a TextProperty, say) are neither read from the
+    datastore nor decoded.  The key parameter is always projected, and every
+    model keeps its key().  An empty list projects onto the key parameter
+    alone.  Reading any other property of the models raises an error.  A
+    projection query is served from an index, so the projected properties
+    must be indexed, and the base query's filters and orders combined with
+    the projection may need a composite index of their own.
+    
+    Only a source whose base query is given as a function can build
+    projection queries.
+    
+    Args:
+      fields: A list of property names, or None to fetch whole models
+    """
+    assert fields is None or callable(self.base_query)
+    self._fields = fields
+    return self
 
   def Get(self,
         start_point,
         end_point,
         max_entries):
+    """Get up to max_entries models in ascending key order.
+    
+    Every call runs fresh copies of the base query, so that the base query is
+    never modified.  The models are fetched in chunks of up to
+    SOURCE_CURSOR_CHUNK_SIZE as they are used, each chunk from the datastore
+    cursor of the one before, see GetCursor.  A call resumed from a cursor
+    runs the same query from the datastore cursor, skipping the models of a
+    partly used chunk.
+    """
     assert isinstance(max_entries, int)
-    self.base_query.filter("%s > " % self.key_parameter, start_point)
-    self.base_query.filter("%s <= " % self.key_parameter, end_point)
-    self.base_query.order(self.key_parameter)
-    for model in self.base_query.fetch(limit=max_entries):
-      key = getattr(model, self.key_parameter)
-      yield key, model
+    (datastore_cursor, skip) = self._cursor
+    # (entries returned, datastore cursor, models to skip past it) for each
+    # point a later Get could resume from.
+    self._resume_points = [(0, datastore_cursor, skip)]
+    entries_returned = 0
+    while entries_returned < max_entries:
+      query = self._GetQuery(self._fields)
+      query.filter("%s > " % self.key_parameter, start_point)
+      query.filter("%s <= " % self.key_parameter, end_point)
+      query.order(self.key_parameter)
+      if datastore_cursor:
+        query.with_cursor(datastore_cursor)
+      limit = min(max_entries - entries_returned, SOURCE_CURSOR_CHUNK_SIZE)
+      models = query.fetch(limit=limit, offset=skip)
+      datastore_cursor = query.cursor()
+      skip = 0
+      self._resume_points.append((entries_returned + len(models),
+                                  datastore_cursor,
+                                  0))
+      for model in models:
+        key = getattr(model, self.key_parameter)
+        yield key, model
+        entries_returned += 1
+      if len(models) < limit:
+        return
+  
+  def GetCursor(self, entries_returned):
+    """Get a cursor, '<datastore cursor>:<models to skip past it>'.
+    
+    The datastore cursor points past the last chunk of models that was used
+    up, so fewer than SOURCE_CURSOR_CHUNK_SIZE models are ever skipped past
+    it.
+    """
+    for (resume_point_entries, datastore_cursor, skip) in \
+        reversed(self._resume_points):
+      if resume_point_entries <= entries_returned:
+        return "%s:%d" % (datastore_cursor or "",
+                          skip + entries_returned - resume_point_entries)
+  
+  def SetCursor(self, cursor):
+    self._cursor = (None, 0)
+    if cursor:
+      (datastore_cursor, skip) = cursor.rsplit(":", 1)
+      self._cursor = (datastore_cursor, int(skip))
+    return self
+
+  def GetKeySample(self, sample_size):
+    """Sample the keys by bisecting the key space, see _GetBisectedKeySample.
+    
+    The sampling fetches are projected onto the key parameter when the base
+    query is given as a function.
+    """
+    fields = None
+    if callable(self.base_query):
+      # Only the keys are sampled, so only the keys need be fetched.
+      fields = []
+    
+    def GetQuery(fields, after, up_to):
+      query = self._GetQuery(fields)
+      if after is not None:
+        query.filter("%s > " % self.key_parameter, after)
+      query.filter("%s <= " % self.key_parameter, up_to)
+      query.order(self.key_parameter)
+      return query
+    
+    def GetKeys(after, up_to, limit):
+      return [getattr(model, self.key_parameter) for model
+              in GetQuery(fields, after, up_to).fetch(limit=limit)]
+    
+    def CountKeys(after, up_to):
+      return GetQuery(None, after, up_to).count(limit=MAX_QUERY_RESULTS)
+    
+    return _GetBisectedKeySample(GetKeys, CountKeys, sample_size)
+  
+  def _GetQuery(self, fields):
+    """Get a new base query, projected onto the fields unless they're None."""
+    if not callable(self.base_query):
+      return copy.deepcopy(self.base_query)
+    if fields is None:
+      return self.base_query()
+    projection = list(fields)
+    if self.key_parameter not in projection:
+      projection.append(self.key_parameter)
+    return self.base_query(projection=tuple(projection))
 
 
 class IntermediateAppEngineSource(base.Source):
@@ -127,6 +598,9 @@ class IntermediateAppEngineSource(base.Source):
 
   def __init__(self, job_name):
     self.job_name = job_name
+    self._partition = None
+    self.SetCodec(None)
+    self.SetPackedValues(True)
   
   def SetUseJobName(self, use_job_name):
     self._use_job_name = use_job_name
@@ -135,115 +609,338 @@ class IntermediateAppEngineSource(base.Source):
   def SetUseNonsenseValues(self, use_nonsense_values):
     self._use_nonsense_values = use_nonsense_values
     return self
+  
+  def SetPackedValues(self, packed_values):
+    """Set whether the values may have been written packed, see _Scan."""
+    self._packed_values = packed_values
+    return self
+  
+  def SetCodec(self, codec):
+    """Set the Codec that decodes values written by a sink with the same one."""
+    assert codec is None or isinstance(codec, base.Codec)
+    self._codec = codec
+    return self
 
   def Get(self,
           start_point,
           end_point,
           max_entries):
+    """Get intermediate values in ascending key order.
+    
+    The range is read with ordered scans of up to max_entries values each, and
+    every key whose values all fall within a scan is served from it directly.
+    Only the last key of a full scan may have more values beyond it, so that
+    key's values are fetched by _GetIntermediateValuesForKey and the next scan
+    starts after it.  This keeps the number of queries proportional to the
+    number of scans rather than the number of keys.
+    
+    All of the values for a key are returned together: iteration stops at the
+    first key boundary after max_entries values have been returned.  Packed
+    intermediate entities are unpacked, so one value is returned at a time
+    either way, and every scan fetches only as many entities as hold the
+    values still wanted, see _Scan.
+    """
     assert isinstance(max_entries, int)
     num_values_returned = 0
-    num_keys_returned = 0
     while True:
-      if num_values_returned > max_entries:
-        return
+      query = self._GetScanQuery()
+      query.filter("intermediate_key > ", start_point)
+      query.filter("intermediate_key <= ", end_point)
+      query.order("intermediate_key")
+      (scanned_values, more) = self._Scan(query,
+                                          max_entries - num_values_returned)
+      
+      last_key = None
+      if more and scanned_values:
+        last_key = scanned_values[-1].intermediate_key
+      
+      previous_key = None
+      for intermediate_value in scanned_values:
+        key = intermediate_value.intermediate_key
+        if key == last_key:
+          break
+        if key != previous_key and num_values_returned >= max_entries:
+          return
+        for unpacked_value in _UnpackIntermediateValues(intermediate_value,
+                                                        self._codec):
+          yield key, unpacked_value
+          num_values_returned += 1
+        previous_key = key
       
-      # TODO: This is a pretty inefficient way to loop through the keys, but
-      # is done to simplify fetching full sets of intermediate values for
-      # intermediate value keys.  A more effective method would loop through
-      # a full set of 1000 results, and depending on the keys that were seen in
-      # that set either issue queries for the subsequent set of results or
-      # stop iteration.
-      current_key = self._GetNextKey(start_point, end_point)
-      if current_key is None:
+      if last_key is None:
+        # The scan was short, so it covered the rest of the range.
+        return
+      if num_values_returned >= max_entries:
         return
-      else:
-        # The next time we loop, the next key we fetch should be > the key we're
-        # currently serving
-        start_point = current_key
       
       for intermediate_value in \
-          self._GetIntermediateValuesForKey(current_key,
-                                            max_entries - num_values_returned):
-        yield current_key, intermediate_value
-        num_values_returned += 1
-      
-  def _GetIntermediateValuesForKey(self, intermediate_key, limit):
-    """For the given intermediate value key, get all intermediate values.
+          self._GetIntermediateValuesForKey(last_key, max_entries):
+        for unpacked_value in _UnpackIntermediateValues(intermediate_value,
+                                                        self._codec):
+          yield last_key, unpacked_value
+          num_values_returned += 1
+      if num_values_returned >= max_entries:
+        return
+      # The next scan should start after the key we've just finished serving.
+      start_point = last_key
+  
+  def GetKeySlice(self, key, position, max_entries):
+    """Get a slice of the intermediate values for a single key.
+    
+    The key's intermediate entities are read in order, see _GetKeyQuery.  A
+    position is the nonsense value (or the datastore key) of the last entity
+    read, and the number of values of the next entity that have already been
+    returned, since a packed entity may be split across slices.
+    """
+    (cursor, skip) = (None, 0)
+    if position:
+      (cursor, skip) = position.rsplit(":", 1)
+      (cursor, skip) = (self._DecodeKeyCursor(cursor), int(skip))
     
-    Get all intermediate values from the Datastore.
+    values = []
+    while len(values) < max_entries:
+      (intermediate_values, more) = self._Scan(self._GetKeyQuery(key, cursor),
+                                               max_entries - len(values))
+      
+      for intermediate_value in intermediate_values:
+        unpacked_values = [unpacked_value.intermediate_value for unpacked_value
+                           in _UnpackIntermediateValues(intermediate_value,
+                                                        self._codec)]
+        unpacked_values = unpacked_values[skip:]
+        room = max_entries - len(values)
+        if len(unpacked_values) > room:
+          values.extend(unpacked_values[:room])
+          return (values, "%s:%d" % (self._EncodeKeyCursor(cursor),
+                                     skip + room))
+        values.extend(unpacked_values)
+        skip = 0
+        cursor = self._GetKeyCursor(intermediate_value)
+      
+      if not more:
+        return (values, None)
+    return (values, "%s:%d" % (self._EncodeKeyCursor(cursor), skip))
+  
+  def GetKeySample(self, sample_size):
+    """Sample intermediate keys, weighted by their number of values.
     
-    If we're using nonsense values on the intermediate values, then we can
-    issue multiple queries to retrieve every intermediate value for a given key,
-    allowing us to get past the 1000-result limit built into the AppEngine
-    datastore.  If not, then we can only retrieve the first 1000 entries, and
-    log a warning if we retrieve exactly 1000 entries for a given key.
+    With nonsense values in use, the sample is a random one drawn with a single
+    query, starting from a random nonsense value.  Otherwise the keys are
+    sampled by bisecting the key space, see _GetBisectedKeySample.
     """
-    # We're guaranteed by the intermediate value sink that no intermediate
-    # values are written with the _actual_ minimum value.  Always 1 greater.
-    current_nonsense = 1 - sys.maxint
-    while True:
-      # Loop through all possible intermediate values
-      query = IntermediateValueHolder.all()
-      query.filter("intermediate_key = ", intermediate_key)
+    if not self._use_nonsense_values:
+      def GetQuery(after, up_to):
+        query = self._GetBaseQuery()
+        if after is not None:
+          query.filter("intermediate_key > ", after)
+        query.filter("intermediate_key <= ", up_to)
+        query.order("intermediate_key")
+        return query
       
-      if self._use_job_name:
-        logging.debug("Using job name '%s' in intermediate value query." %
-                      self.job_name)
-        query.filter("job_name = ", self.job_name)
-
-      if self._use_nonsense_values:
-        logging.debug("Using nonsense value '%d' in intermediate value query." %
-                      current_nonsense)
-        query.filter("nonsense > ", current_nonsense)
-        query.order("nonsense")
+      def GetKeys(after, up_to, limit):
+        return [intermediate_value.intermediate_key for intermediate_value
+                in GetQuery(after, up_to).fetch(limit=limit)]
       
-      intermediate_values_fetched = 0
-      for intermediate_value in query.fetch(limit=limit):
-        intermediate_values_fetched += 1
-
-        if self._use_nonsense_values:
-          current_nonsense = intermediate_value.nonsense
-        elif intermediate_values_fetched == min(limit, 1000):
-          logging.warning("Retrieved %d intermediate values for intermediate "
-                          "value key '%s', which is the maximum number of "
-                          "query results we could have returned.  There may be "
-                          "more values available, but because nonsense values "
-                          "are not in use, it is impossible to access them.  "
-                          "You can resolve this by setting "
-                          "intermediate_values_set_nonsense_value = True in "
-                          "the AppEngineMaster initializer." %
-                          (min(limit, 1000),
-                           intermediate_value.intermediate_key))
-        
-        yield intermediate_value
+      def CountKeys(after, up_to):
+        return GetQuery(after, up_to).count(limit=MAX_QUERY_RESULTS)
       
-      # Test for whether or not we've returned > the maximum number of results
-      # desired outside of the yielding loop so that we can guarantee to return
-      # all intermediate values for each given key (don't return the first half
-      # of the intermediate values for intermediate key X just because the
-      # result limit cutoff happened to fall there).
-      if intermediate_values_fetched < limit:
-        return
+      return _GetBisectedKeySample(GetKeys, CountKeys, sample_size)
+    
+    random_nonsense = random.randint(1 - sys.maxint, sys.maxint)
+    query = self._GetBaseQuery()
+    query.filter("nonsense > ", random_nonsense)
+    query.order("nonsense")
+    sample = [value.intermediate_key
+              for value in query.fetch(limit=sample_size)]
+    if len(sample) < sample_size:
+      # Wrap around to the start of the nonsense value range.
+      query = self._GetBaseQuery()
+      query.filter("nonsense <= ", random_nonsense)
+      query.order("nonsense")
+      sample.extend([value.intermediate_key for value in
+                     query.fetch(limit=sample_size - len(sample))])
+    return sample
+  
+  def SetPartition(self, partition):
+    self._partition = partition
+    return self
+  
+  def _GetScanQuery(self):
+    """Get a base query for _Scan, keys-only if the values may be packed."""
+    return self._GetBaseQuery(keys_only=self._packed_values)
   
-  def _GetNextKey(self, greater_than_key, less_than_eq_key):
-    """Determine the value of the next key that should be reduced.
+  def _GetKeyQuery(self, intermediate_key, cursor):
+    """Get a _Scan query for a key's entities after the one at a cursor.
+    
+    The entities are read in nonsense value order when nonsense values are in
+    use, and in datastore key order otherwise, so that there is no limit on
+    the number of entities that can be paged through.
+    
+    Args:
+      intermediate_key: The intermediate key
+      cursor: A cursor from _GetKeyCursor, or None for the first entity
+    """
+    query = self._GetScanQuery()
+    query.filter("intermediate_key = ", intermediate_key)
+    if self._use_nonsense_values:
+      if cursor is None:
+        # No intermediate value is written with the actual minimum nonsense.
+        cursor = 1 - sys.maxint
+      query.filter("nonsense > ", cursor)
+      query.order("nonsense")
+    else:
+      if cursor is not None:
+        query.filter("__key__ > ", cursor)
+      query.order("__key__")
+    return query
+  
+  def _GetKeyCursor(self, intermediate_value):
+    """Get the cursor of an entity, see _GetKeyQuery."""
+    if self._use_nonsense_values:
+      return intermediate_value.nonsense
+    return intermediate_value.key()
+  
+  def _EncodeKeyCursor(self, cursor):
+    """Encode a cursor as its nonsense value, key name or key id."""
+    if cursor is None:
+      return ""
+    if self._use_nonsense_values:
+      return str(cursor)
+    return str(cursor.name() or cursor.id())
+  
+  def _DecodeKeyCursor(self, encoded_cursor):
+    if not encoded_cursor:
+      return None
+    if self._use_nonsense_values:
+      return int(encoded_cursor)
+    # Key names may not begin with a digit, so a number is a key id.
+    id_or_name = encoded_cursor
+    if encoded_cursor.isdigit():
+      id_or_name = int(encoded_cursor)
+    return db.Key.from_path(IntermediateValueHolder.kind(), id_or_name)
+  
+  def _Scan(self, query, values_wanted):
+    """Fetch the first intermediate entities a query matches, by their values.
+    
+    Query limits count entities, but a packed entity holds up to
+    MAX_PACKED_VALUES values.  So when the values may be packed, the query is
+    keys-only, and only the first of the entities whose key names hold at
+    least values_wanted values between them are fetched, with a batch get.
+    Otherwise every entity holds a value, and values_wanted of them are
+    fetched.  At least one entity is fetched, if there are any.
     
     Args:
-      greater_than_key: The value that the next key should be greater than.
-      less_than_eq_key: The value that the next key should be less than or
-        equal to.
+      query: A query from _GetScanQuery
+      values_wanted: The number of values wanted
+    
+    Returns:
+      A (entities, more) tuple, where more is whether the query may match more
+      entities after these ones.
     """
-    get_next_key_query = IntermediateValueHolder.all()
+    limit = min(max(values_wanted, 1), MAX_QUERY_RESULTS)
+    if not self._packed_values:
+      entities = query.fetch(limit=limit)
+      return (entities, len(entities) == limit)
+    keys = query.fetch(limit=limit)
+    num_keys = 0
+    num_values = 0
+    for key in keys:
+      if num_keys and num_values >= values_wanted:
+        break
+      num_keys += 1
+      num_values += _GetIntermediateKeyValueCount(key)
+    entities = [entity for entity in db.get(keys[:num_keys])
+                if entity is not None]
+    return (entities, num_keys < len(keys) or len(keys) == limit)
+  
+  def _GetBaseQuery(self, keys_only=False):
+    query = IntermediateValueHolder.all(keys_only=keys_only)
     if self._use_job_name:
-      get_next_key_query.filter("job_name = ", self.job_name)
+      query.filter("job_name = ", self.job_name)
+    if self._partition is not None:
+      query.filter("partition = ", self._partition)
+    return query
+  
+  def _GetIntermediateValuesForKey(self, intermediate_key, values_per_page):
+    """For the given intermediate value key, get all intermediate values.
     
-    get_next_key_query.filter("intermediate_key > ", greater_than_key)
-    get_next_key_query.filter("intermediate_key <= ", less_than_eq_key)
-    value = get_next_key_query.get()
-    if value is None:
-      return None
-    else:
-      return value.intermediate_key
+    Get all intermediate values from the Datastore, a page of entities holding
+    about values_per_page values at a time, see _Scan, so that a reader that
+    stops early fetches few more values than it reads.  Each page starts after
+    the last entity of the page before, see _GetKeyQuery, so every value is
+    read however many there are.
+    """
+    cursor = None
+    while True:
+      (intermediate_values, more) = self._Scan(
+          self._GetKeyQuery(intermediate_key, cursor), values_per_page)
+      for intermediate_value in intermediate_values:
+        cursor = self._GetKeyCursor(intermediate_value)
+        yield intermediate_value
+      
+      # Test for whether or not there are more values outside of the yielding
+      # loop so that we can guarantee to return all intermediate values for
+      # each given key (don't return the first half of the intermediate values
+      # for intermediate key X just because a page happened to end there).
+      if not more:
+        return
+
+
+class IntermediateAppEngineCleaner(base.Cleaner):
+  """Deletes intermediate values with keys-only queries and batch deletes.
+  
+  Each batch of up to MAX_QUERY_RESULTS values costs one keys-only query and
+  a batch delete per MAX_DATASTORE_BATCH_SIZE values, where the
+  AppEngineValueDeletingMapper reads every value in full and deletes them one
+  at a time.
+  """
+  
+  def __init__(self, job_name):
+    self.job_name = job_name
+    self.SetUseJobName(True)
+    self._partition = None
+  
+  def SetUseJobName(self, use_job_name):
+    self._use_job_name = use_job_name
+    return self
+  
+  def SetPartition(self, partition):
+    self._partition = partition
+    return self
+  
+  def Clean(self, start_point, end_point, max_entries):
+    def GetQuery():
+      query = self._GetBaseQuery()
+      if self._partition is not None:
+        query.filter("partition = ", self._partition)
+      query.filter("intermediate_key > ", start_point)
+      query.filter("intermediate_key <= ", end_point)
+      return query
+    return self._DeleteAll(GetQuery, max_entries)
+  
+  def CleanAttempt(self, attempt, max_entries):
+    def GetQuery():
+      return self._GetBaseQuery().filter("attempt = ", attempt)
+    return self._DeleteAll(GetQuery, max_entries)
+  
+  def _GetBaseQuery(self):
+    query = IntermediateValueHolder.all(keys_only=True)
+    if self._use_job_name:
+      query.filter("job_name = ", self.job_name)
+    return query
+  
+  def _DeleteAll(self, get_query, max_entries):
+    """Delete up to max_entries of the entities a query matches."""
+    entries_deleted = 0
+    while entries_deleted < max_entries:
+      query = get_query()
+      limit = min(max_entries - entries_deleted, MAX_QUERY_RESULTS)
+      keys = query.fetch(limit=limit)
+      for i in xrange(0, len(keys), MAX_DATASTORE_BATCH_SIZE):
+        db.delete(keys[i:i + MAX_DATASTORE_BATCH_SIZE])
+      entries_deleted += len(keys)
+      if len(keys) < limit:
+        break
+    return entries_deleted
 
 
 class AppEngineValueDeletingMapper(base.Mapper):
@@ -266,24 +963,44 @@ class AppEngineMaster(master.Master):
                 reducer=None,
                 source=None,
                 sink=None,
+                combiner=None,
                 intermediate_values_set_job_name=True,
-                intermediate_values_set_nonsense_value=True):
+                intermediate_values_set_nonsense_value=True,
+                intermediate_values_write_batch_size=
+                    DEFAULT_INTERMEDIATE_WRITE_BATCH_SIZE,
+                intermediate_values_pack=True,
+                intermediate_values_codec=None,
+                partitioner=partitioners.HashPartitioner(),
+                num_shards=master.DEFAULT_NUM_SHARDS):
     logging.debug("Beginning QuickInit.")
     assert jobname is not None
     self._jobname = jobname
     self.SetMapper(mapper)
     self.SetReducer(reducer)
+    self.SetCombiner(combiner)
+    self.SetNumShards(num_shards)
     self.SetCleanupMapper(AppEngineValueDeletingMapper())
+    self.SetCleaner(
+        IntermediateAppEngineCleaner(jobname)
+            .SetUseJobName(intermediate_values_set_job_name))
     self.SetSource(source)
 
     self.SetMapperSink(
         AppEngineIntermediateSink(jobname)
             .SetAddJobName(intermediate_values_set_job_name)
-            .SetAddNonsenseValue(intermediate_values_set_nonsense_value))
+            .SetAddNonsenseValue(intermediate_values_set_nonsense_value)
+            .SetWriteBatchSize(intermediate_values_write_batch_size)
+            .SetPackValues(intermediate_values_pack)
+            .SetPartitioner(partitioner, num_shards)
+            .SetCodec(intermediate_values_codec))
     self.SetReducerSource(
         IntermediateAppEngineSource(jobname)
             .SetUseJobName(intermediate_values_set_job_name)
-            .SetUseNonsenseValues(intermediate_values_set_nonsense_value))
+            .SetUseNonsenseValues(intermediate_values_set_nonsense_value)
+            .SetPackedValues(intermediate_values_pack)
+            .SetCodec(intermediate_values_codec))
+    if partitioner is not None:
+      self.SetNumPartitions(num_shards)
     
     self.SetSink(sink)
     logging.debug("Done QuickInit.")
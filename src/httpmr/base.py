@@ -31,6 +31,12 @@ class Mapper(object):
 
 class Reducer(object):
   
+  # Whether Reduce takes its values as an iterator rather than a list.  The
+  # values of an iterating Reducer are read from the Source while it consumes
+  # them, so a key's values need not all fit in memory at once.  The iterator
+  # can only be consumed once, and only during the call to Reduce.
+  iterate_values = False
+  
   def Reduce(self, key, values):
     """Operate on all values output for the given key simultaneously.
     
@@ -51,7 +57,102 @@ class Reducer(object):
     
     Args:
       key: The key (arbitrary object) to which all of the values correspond
-      values: A list of values (arbitrary objects) corresponding to the key.
+      values: A list of values (arbitrary objects) corresponding to the key,
+        or an iterator over them if iterate_values is set.
+    
+    Returns:
+      A generator
+    """
+    raise NotImplementedError()
+
+
+class PartialReducer(Reducer):
+  """A Reducer whose values for a key can be reduced a slice at a time.
+  
+  A key with more values than fit in one reducer task is reduced across as many
+  tasks as it takes: the key's state starts as Initialize's, every slice of
+  values is folded into it by Accumulate, and once every value has been
+  accumulated Finalize outputs the reduced pairs.  The state is carried from
+  task to task in the task URLs, encoded by EncodeState, so it should stay
+  small: a count, a sum or the top few values, say.
+  
+  For example, a PartialReducer that sums its values:
+    def Initialize(self, key):
+      return 0
+    
+    def Accumulate(self, key, state, values):
+      return state + sum([int(value) for value in values])
+    
+    def Finalize(self, key, state):
+      yield key, str(state)
+    
+    def EncodeState(self, state):
+      return str(state)
+    
+    def DecodeState(self, encoded_state):
+      return int(encoded_state)
+  
+  Keys whose values fit in one task are reduced with Reduce, which by default
+  reduces all of the values as a single slice.
+  """
+  
+  def Reduce(self, key, values):
+    return self.Finalize(key, self.Accumulate(key, self.Initialize(key), values))
+  
+  def Initialize(self, key):
+    """Get the state of a key none of whose values have been accumulated."""
+    raise NotImplementedError()
+  
+  def Accumulate(self, key, state, values):
+    """Fold a slice of the key's values into its state, returning the new state.
+    
+    Args:
+      key: The key (arbitrary object) to which all of the values correspond
+      state: The key's state so far
+      values: A list of some of the key's values (arbitrary objects), or an
+        iterator over them if iterate_values is set.
+    """
+    raise NotImplementedError()
+  
+  def Finalize(self, key, state):
+    """Output the reduced pairs for a key all of whose values are accumulated.
+    
+    Finalize must be implemented as a generator, like Reducer#Reduce.
+    """
+    raise NotImplementedError()
+  
+  def EncodeState(self, state):
+    """Encode a key's state as a string."""
+    raise NotImplementedError()
+  
+  def DecodeState(self, encoded_state):
+    """Decode a key's state from a string output by EncodeState."""
+    raise NotImplementedError()
+
+
+class Combiner(object):
+  
+  def Combine(self, key, values):
+    """Pre-aggregate some of the values output by Mappers for the given key.
+    
+    A Combiner runs inside a single mapper task, on the values that task has
+    output for a key so far, and its output is written to intermediate storage
+    in place of those values.  It is an optimization only: Combine may be
+    applied to any subset of a key's values any number of times (including
+    zero), so the pairs it outputs must be valid input both for the Reducer and
+    for another call to Combine.
+    
+    Combine must be implemented as a generator, outputting its combined
+    key-value pairs via the 'yield' operator.
+    
+    For example, a Combine method that pre-sums counts for a Reducer that sums
+    its values:
+      def Combine(self, key, values):
+        yield key, str(sum([int(value) for value in values]))
+    
+    Args:
+      key: The key (arbitrary object) to which all of the values correspond
+      values: A list of values (arbitrary objects) output for the key.
     
     Returns:
       A generator
@@ -78,6 +179,157 @@ class Source(object):
     """
     raise NotImplementedError()
   
+  def GetKeySample(self, sample_size):
+    """Get a sample of this Source's keys, used to plan shard boundaries.
+    
+    The sampled keys should be spread over the Source's data evenly (either
+    evenly spaced in key order, or chosen at random), so that they reflect how
+    the data is distributed over the key space.
+    
+    Args:
+      sample_size: The maximum number of keys that should be sampled
+    
+    Returns:
+      A list of keys, or None if this Source cannot sample its keys.
+    """
+    return None
+  
+  def GetCursor(self, entries_returned):
+    """Get a cursor from which the next Get can resume, see SetCursor.
+    
+    Args:
+      entries_returned: The number of entries the last call to Get returned
+        that were used; the cursor should point just after them.
+    
+    Returns:
+      An opaque string, or None if this Source does not support cursors, in
+      which case the next Get starts after the last key used instead.
+    """
+    return None
+  
+  def SetCursor(self, cursor):
+    """Resume the next call to Get from a cursor output by GetCursor.
+    
+    Resuming from a cursor rather than after the last key used does not skip
+    entries that share that key, and may let the Source resume its scan more
+    cheaply.  The next call to Get must be made with the same start and end
+    points as the one the cursor was taken from.
+    
+    Args:
+      cursor: A cursor output by GetCursor, or None to start from start_point
+    """
+    raise NotImplementedError()
+  
+  def GetKeySlice(self, key, position, max_entries):
+    """Get a slice of the values for a single key.
+    
+    Only Sources read by PartialReducers need implement this, to reduce keys
+    with too many values for one task.
+    
+    Args:
+      key: The key whose values should be retrieved
+      position: An opaque string output by a previous call for the same key, or
+        the empty string for the key's first values
+      max_entries: The maximum number of values that should be retrieved
+    
+    Returns:
+      A (values, position) tuple, where position is that of the slice of
+      values after these ones, or None if there are no more values.
+    """
+    raise NotImplementedError()
+  
+  def SetPartition(self, partition):
+    """Restrict this Source to one partition of its data.
+    
+    Only Sources of intermediate data written by a partitioning Sink need
+    implement this, see Partitioner.
+    
+    Args:
+      partition: The partition number, from 0 to the number of partitions - 1
+    """
+    raise NotImplementedError()
+  
+
+class Cleaner(object):
+  
+  def Clean(self, start_point, end_point, max_entries):
+    """Delete intermediate data in bulk, in place of a cleanup Mapper.
+    
+    Entries are deleted without being read or Mapped, so a Cleaner can delete
+    a whole batch of them with a handful of storage operations.  The deleted
+    entries no longer fall within the range, so the rest of the range is
+    cleaned by calling Clean again with the same start_point.
+    
+    Args:
+      start_point: The starting point for data segmentation.  Entries for this
+        key are excluded (restrictions are 'key > start_point')
+      end_point: The ending point for data segmentation.  Entries for this key
+        must be included (restrictions are 'key <= end_point')
+      max_entries: The maximum number of entries that should be deleted
+    
+    Returns:
+      The number of entries deleted.  Fewer than max_entries means that the
+      range has been cleaned completely.
+    """
+    raise NotImplementedError()
+  
+  def SetPartition(self, partition):
+    """Restrict this Cleaner to one partition of the data, see Source."""
+    raise NotImplementedError()
+  
+  def CleanAttempt(self, attempt, max_entries):
+    """Delete entries written by a Sink tagged with the attempt, see Sink.
+    
+    Returns:
+      The number of entries deleted.  Fewer than max_entries means that all of
+      the attempt's entries have been deleted.
+    """
+    raise NotImplementedError()
+
+
+class Partitioner(object):
+  
+  def Partition(self, key, num_partitions):
+    """Assign an intermediate key to one of the reduce partitions.
+    
+    When the intermediate data is partitioned, each reduce shard reduces every
+    key of one partition, rather than a range of keys.  A good Partitioner
+    spreads the keys, weighted by their number of values, evenly over the
+    partitions.  It must assign a key to the same partition every time, in
+    every process.
+    
+    Args:
+      key: The intermediate key
+      num_partitions: The number of partitions
+    
+    Returns:
+      The key's partition number, from 0 to num_partitions - 1
+    """
+    raise NotImplementedError()
+
+
+class Codec(object):
+  
+  def Encode(self, value):
+    """Encode an intermediate value as a compact byte string.
+    
+    A Codec declared for a job stores the intermediate values output by its
+    Mappers (or Combiner) as binary blobs rather than as text, so that values
+    needn't be stringified by the Mapper and parsed again by the Reducer.  It
+    must decode every value it encodes, in every process.
+    
+    Args:
+      value: An intermediate value (arbitrary object)
+    
+    Returns:
+      A str
+    """
+    raise NotImplementedError()
+  
+  def Decode(self, encoded_value):
+    """Decode an intermediate value from a str output by Encode."""
+    raise NotImplementedError()
+
 
 class Sink(object):
   
@@ -85,4 +337,34 @@ class Sink(object):
     """Output the provided key and value to persistent storage.
     
     """
-    raise NotImplementedError()
\ No newline at end of file
+    raise NotImplementedError()
+  
+  def Flush(self):
+    """Write any output buffered by Put to persistent storage.
+    
+    The Master flushes its sinks before every task responds, so a Sink that
+    buffers output must never rely on holding it past the end of a task.  Sinks
+    that write through on every Put need not override this.
+    """
+    pass
+  
+  def SetAttempt(self, attempt):
+    """Tag everything this Sink writes with the attempt at the current task.
+    
+    Drivers that speculatively execute mapper tasks run a task more than once,
+    and roll back the output of all but one attempt with
+    Cleaner#CleanAttempt, so only mapper sinks used with speculative execution
+    need implement this.
+    
+    Args:
+      attempt: A string identifying the attempt
+    """
+    raise NotImplementedError()
+  
+  def GetCounters(self):
+    """Get Sink-specific statistics to report with the task's statistics.
+    
+    Returns:
+      A dict mapping statistic names to numbers.
+    """
+    return {}
\ No newline at end of file
@@ -0,0 +1,14 @@
+from httpmr import base
+
+class SumCombiner(base.Combiner):
+  """Pre-sums integer values, for use with reducers.SumReducer."""
+  
+  def Combine(self, key, values):
+    sum = 0
+    for value in values:
+      try:
+        sum += int(value)
+      except ValueError, e:
+        # SumReducer skips values it can't parse, so drop them here too.
+        pass
+    yield key, str(sum)
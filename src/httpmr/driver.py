@@ -2,20 +2,31 @@
 
 """Simple multithreaded HTTP request driver for HTTPMR.
 
-Command-line tool for driving HTTPMR operations.  Spawns multiple threads for
-concurrent shard operation, handles statistics collection and operation failure
-retries.
+Command-line tool for driving HTTPMR operations.  Runs a pool of worker threads
+for concurrent shard operation, handles statistics collection and operation
+failure retries.
 
 Sample usage:
 
 driver.py --httpmr_base=http://your.app.com/httpmr_base_url \
     --max_operations_inflight=10 \
-    --max_per_operation_failures=10
+    --max_per_operation_failures=10 \
+    --journal=/tmp/httpmr_job.journal
+
+If the driver dies mid-job, rerunning it with the same options and --resume
+restarts every shard from the last continuation recorded in the journal.
 """
 
+import base64
 import HTMLParser
+import httplib
 import logging
+import math
 import optparse
+import os
+import Queue
+import random
+import socket
 import time
 import sys
 import threading
@@ -23,12 +34,130 @@ import urllib
 import urllib2
 import urlparse
 
+try:
+  import json
+except ImportError:
+  import simplejson as json
+
 MAP_MASTER_TASK_NAME = "map_master"
+MAPPER_TASK_NAME = "mapper"
 REDUCE_MASTER_TASK_NAME = "reduce_master"
+REDUCER_TASK_NAME = "reducer"
 INTERMEDIATE_DATA_CLEANUP_MASTER_TASK_NAME = "cleanup_master"
+INTERMEDIATE_DATA_CLEANUP_TASK_NAME = "cleanup"
+ROLLBACK_TASK_NAME = "rollback"
+TASK = "task"
 OPERATION_TIMEOUT_SEC = "operation_timeout"
+SOURCE_START_POINT = "source_start_point"
+SOURCE_END_POINT = "source_end_point"
+SOURCE_MAX_ENTRIES = "source_max_entries"
+PARTITION = "partition"
+ATTEMPT = "attempt"
+# The position of a speculative task's operation in its shard's chain of
+# operations, set by the driver, see SpeculationController.
+CHAIN_SEQUENCE = "chain_sequence"
+RESPONSE_FORMAT = "format"
+HTML_RESPONSE_FORMAT = "html"
+JSON_RESPONSE_FORMAT = "json"
 MIN_OPERATION_TIMEOUT_SEC_VALUE = 0.5
+MAX_SOURCE_MAX_ENTRIES_VALUE = 10000
+# The AppEngine request deadline.
+DEFAULT_REQUEST_DEADLINE_SEC = 30
+# Adaptive tuning aims to keep every request under this fraction of the
+# request deadline.
+TARGET_REQUEST_DEADLINE_FRACTION = 0.5
+BATCH_GROWTH_FACTOR = 2
+BATCH_SHRINK_FACTOR = 0.5
+# The statistic counting the records an operation read from its Source.
+RECORDS_READ_STATISTIC = "read-count"
+# The statistic counting the intermediate entries a cleanup task deleted.
+RECORDS_CLEANED_STATISTIC = "clean-count"
+# Operations of these tasks delete records rather than read them, and their
+# shards are tuned on RECORDS_CLEANED_STATISTIC.
+CLEANUP_TASK_NAMES = [INTERMEDIATE_DATA_CLEANUP_TASK_NAME, ROLLBACK_TASK_NAME]
+# Statistics whose names end with this suffix are encoded LatencyHistograms,
+# which are merged rather than summed.
+HISTOGRAM_STATISTIC_SUFFIX = "-histogram"
+HISTOGRAM_MIN_LATENCY_SEC = 0.00001
+HISTOGRAM_BUCKET_GROWTH_FACTOR = 1.25
+HISTOGRAM_NUM_BUCKETS = 80
+REPORTED_LATENCY_PERCENTILES = [50, 90, 99]
+# Operations of these tasks may be speculatively executed, see
+# SpeculationController.
+SPECULATIVE_TASK_NAMES = [MAPPER_TASK_NAME, INTERMEDIATE_DATA_CLEANUP_TASK_NAME]
+# An operation is a straggler once it has been in flight for this many times
+# the median duration of the phase's completed operations, and at least
+# SPECULATION_MIN_ELAPSED_SEC.
+SPECULATION_SLOWNESS_FACTOR = 3
+SPECULATION_MIN_ELAPSED_SEC = 2
+# Stragglers are only duplicated once the work queue is empty and no more than
+# this fraction of the phase's shards are still in flight, and once at least
+# SPECULATION_MIN_COMPLETED_OPERATIONS operations of the phase have completed.
+SPECULATION_TAIL_FRACTION = 0.1
+SPECULATION_MIN_COMPLETED_OPERATIONS = 3
+SPECULATION_CHECK_INTERVAL_SEC = 1
 INFINITE_PARAMETER_VALUE = -1
+# A fetch follows at most this many redirects before failing.
+MAX_REDIRECTS = 5
+REDIRECT_STATUSES = [301, 302, 303, 307, 308]
+
+
+def _GetUrlParameter(url, name):
+  """Get the raw value of a query parameter of an operation URL, or None."""
+  if "?" not in url:
+    return None
+  for key_value in url.split("?", 1)[1].split("&"):
+    key_value = key_value.split("=", 1)
+    if key_value[0] == name and len(key_value) == 2:
+      return key_value[1]
+  return None
+
+
+def _SetUrlParameter(url, name, value):
+  """Set the value of a query parameter of an operation URL."""
+  (base, query) = (url.split("?", 1) + [""])[:2]
+  params = []
+  found = False
+  for key_value in query.split("&"):
+    if not key_value:
+      continue
+    if key_value.split("=", 1)[0] == name:
+      key_value = "%s=%s" % (name, value)
+      found = True
+    params.append(key_value)
+  if not found:
+    params.append("%s=%s" % (name, value))
+  return "%s?%s" % (base, "&".join(params))
+
+
+def _RemoveUrlParameter(url, name):
+  """Remove a query parameter from an operation URL."""
+  if "?" not in url:
+    return url
+  (base, query) = url.split("?", 1)
+  params = [key_value for key_value in query.split("&")
+            if key_value.split("=", 1)[0] != name]
+  return "%s?%s" % (base, "&".join(params))
+
+
+def _GetShardKey(url):
+  """Identify the shard an operation URL belongs to.
+  
+  Every shard of a phase covers a key range with a distinct end point, or a
+  whole partition of the intermediate data, which stays the same across the
+  shard's chain of operations.
+  """
+  return (_GetUrlParameter(url, TASK),
+          _GetUrlParameter(url, PARTITION),
+          _GetUrlParameter(url, SOURCE_END_POINT))
+
+
+def _EncodeUrl(url):
+  """URLs decoded from JSON are unicode, encode them like those read from HTML.
+  """
+  if isinstance(url, unicode):
+    return url.encode("utf-8")
+  return url
 
 
 class Error(Exception):
@@ -43,6 +172,87 @@ class TooManyTriesError(UncrecoverableOperationError):
   """An operation has been tried too many times without success."""
 
 
+class RedirectError(UncrecoverableOperationError):
+  """A URL redirected too many times, or without saying where to."""
+
+
+class LatencyHistogram(object):
+  """A fixed-size, mergeable histogram of operation latencies.
+  
+  Latencies are counted in HISTOGRAM_NUM_BUCKETS buckets whose bounds grow
+  geometrically from HISTOGRAM_MIN_LATENCY_SEC, so percentiles are reported to
+  within HISTOGRAM_BUCKET_GROWTH_FACTOR of the true latency.  The maximum is
+  kept exactly.  Histograms from any number of operations can be merged by
+  adding their bucket counts.
+  
+  The Master uses this class too, to record the histograms it reports; it is
+  defined here so that the driver remains a standalone file.
+  """
+  
+  def __init__(self):
+    self.buckets = [0] * HISTOGRAM_NUM_BUCKETS
+    self.count = 0
+    self.max = 0.0
+  
+  def Add(self, latency_sec):
+    self.buckets[self._GetBucket(latency_sec)] += 1
+    self.count += 1
+    self.max = max(self.max, latency_sec)
+  
+  def Merge(self, other):
+    for i in xrange(HISTOGRAM_NUM_BUCKETS):
+      self.buckets[i] += other.buckets[i]
+    self.count += other.count
+    self.max = max(self.max, other.max)
+  
+  def GetPercentile(self, percentile):
+    """Get the upper bound of the bucket holding the percentile'th latency."""
+    if self.count == 0:
+      return 0.0
+    rank = math.ceil(self.count * percentile / 100.0)
+    seen = 0
+    for i in xrange(HISTOGRAM_NUM_BUCKETS):
+      seen += self.buckets[i]
+      if seen >= rank:
+        break
+    return min(self._GetBucketUpperBound(i), self.max)
+  
+  def Encode(self):
+    """Encode the histogram as a string without spaces, e.g. '0.5/3:10,7:2'.
+    
+    The encoding is the maximum latency, then the count of every non-empty
+    bucket, so that it fits on a line of the HTML statistics as well as in a
+    JSON response.
+    """
+    bucket_counts = []
+    for i in xrange(HISTOGRAM_NUM_BUCKETS):
+      if self.buckets[i]:
+        bucket_counts.append("%d:%d" % (i, self.buckets[i]))
+    return "%r/%s" % (self.max, ",".join(bucket_counts))
+  
+  def Decode(self, encoded_histogram):
+    (max_latency, bucket_counts) = encoded_histogram.split("/")
+    self.max = max(self.max, float(max_latency))
+    for bucket_count in bucket_counts.split(","):
+      if bucket_count:
+        (i, count) = map(int, bucket_count.split(":"))
+        self.buckets[i] += count
+        self.count += count
+    return self
+  
+  def _GetBucket(self, latency_sec):
+    if latency_sec <= HISTOGRAM_MIN_LATENCY_SEC:
+      return 0
+    bucket = int(math.ceil(math.log(latency_sec / HISTOGRAM_MIN_LATENCY_SEC) /
+                           math.log(HISTOGRAM_BUCKET_GROWTH_FACTOR)))
+    return min(bucket, HISTOGRAM_NUM_BUCKETS - 1)
+  
+  def _GetBucketUpperBound(self, bucket):
+    if bucket == HISTOGRAM_NUM_BUCKETS - 1:
+      return self.max
+    return HISTOGRAM_MIN_LATENCY_SEC * HISTOGRAM_BUCKET_GROWTH_FACTOR ** bucket
+
+
 class OperationResult(object):
   """Simple data object that holds the result of a map or reduce operation.
   
@@ -51,10 +261,12 @@ class OperationResult(object):
   """
   
   def __init__(self):
+    self.operation_url = None
     self.url = None
     self.next_url = None
     self.errors = []
     self.tries = 0
+    self.elapsed_sec = None
     self.statistics = {}
   
   def __str__(self):
@@ -71,7 +283,9 @@ class OperationResult(object):
       tuple = line.split(" ")
       if len(tuple) == 2:
         key = tuple[0]
-        value = float(tuple[1])
+        value = tuple[1]
+        if not key.endswith(HISTOGRAM_STATISTIC_SUFFIX):
+          value = float(value)
         self.statistics[key] = value
     logging.debug("Got statistics: %s" % self.statistics)
 
@@ -126,92 +340,738 @@ class MasterPageResultHTMLParser(HTMLParser.HTMLParser):
         self.urls.append(tuple[1])
 
 
-class OperationThread(threading.Thread):
-  """An OperationThread handles the execution and retry of an HTTP request.
+class ConnectionPool(object):
+  """Keeps persistent HTTP connections open for reuse, per host.
   
-  The OperationThread handles executing and retrying an HTTP request to a single
-  Map or Reduce operation.  Once the thread has successfully completed its
-  operation (successfully fetched the url assigned via #SetUrl and parsed the
-  operation result page HTML), the callback set via #SetOperationCallback is
-  invoked.  If there is an unrecoverable error (i.e., too many operation
-  failures), the callback set via #SetUnrecoverableErrorCallback is invoked.
+  Fetching over a pooled connection avoids paying a TCP (and TLS) handshake on
+  every operation.  A connection is returned to the pool after each fetch
+  unless the server asked to close it, and at most max_idle_connections idle
+  connections are kept for any given host.
+  
+  Like urllib2, the pool honours the http_proxy, https_proxy and no_proxy
+  environment variables, and follows redirects.
   """
   
-  def SetOperationCallback(self, callback, **kwargs):
-    """Set the callback that will be invoked when this operation is finished.
+  def __init__(self, max_idle_connections=INFINITE_PARAMETER_VALUE):
+    self.max_idle_connections = max_idle_connections
+    self.proxies = urllib.getproxies()
+    self.idle_connections = {}
+    self.lock = threading.Lock()
+    self.connections_opened = 0
+    self.connections_reused = 0
+  
+  def Fetch(self, url):
+    """Fetch the URL with a GET request, returning the response body.
+    
+    Up to MAX_REDIRECTS redirects are followed.
+    
+    Raises:
+      urllib2.HTTPError: If the server responds with a non-200 status.
+      urllib2.URLError: If the request could not be made.
+      RedirectError: If the URL redirects more than MAX_REDIRECTS times, or
+          redirects without a Location.
+    """
+    redirects = 0
+    while True:
+      (status, location, contents) = self._FetchOnce(url)
+      if status not in REDIRECT_STATUSES:
+        return contents
+      if location is None:
+        raise RedirectError("Redirect without a Location from URL %s" % url)
+      redirects += 1
+      if redirects > MAX_REDIRECTS:
+        raise RedirectError("More than %d redirects from URL %s" %
+                            (MAX_REDIRECTS, url))
+      location = urlparse.urljoin(url, location)
+      logging.debug("Following redirect from %s to %s" % (url, location))
+      url = location
+  
+  def _FetchOnce(self, url):
+    """Fetch the URL with a single GET request.
+    
+    Returns:
+      A (status, location, contents) tuple, where location is the value of the
+      response's Location header, if any.
+    """
+    parts = urlparse.urlsplit(url)
+    proxy = self._GetProxy(parts.scheme, parts.netloc)
+    host = (parts.scheme, parts.netloc, proxy)
+    path = parts.path or "/"
+    if parts.query:
+      path = "%s?%s" % (path, parts.query)
+    headers = {}
+    if proxy is not None and parts.scheme == "http":
+      # Plain HTTP proxies are sent the absolute URL, rather than the path.
+      path = urlparse.urlunsplit((parts.scheme, parts.netloc, path, "", ""))
+      headers = self._GetProxyHeaders(proxy)
+    
+    (connection, reused) = self._GetConnection(host)
+    try:
+      (response, contents) = self._Request(connection, path, headers)
+    except (httplib.HTTPException, socket.error), e:
+      if not reused:
+        raise urllib2.URLError(e)
+      # The server may have closed the idle connection since its last use, so
+      # retry once on a fresh connection.
+      logging.debug("Pooled connection to %s failed, reconnecting: %s" %
+                    (parts.netloc, e))
+      connection = self._OpenConnection(host)
+      try:
+        (response, contents) = self._Request(connection, path, headers)
+      except (httplib.HTTPException, socket.error), e:
+        raise urllib2.URLError(e)
+    
+    if response.will_close:
+      connection.close()
+    else:
+      self._ReleaseConnection(host, connection)
+    if response.status in REDIRECT_STATUSES:
+      return (response.status, response.getheader("location"), contents)
+    if response.status != 200:
+      raise urllib2.HTTPError(url,
+                              response.status,
+                              response.reason,
+                              response.msg,
+                              None)
+    return (response.status, None, contents)
+  
+  def GetStatistics(self):
+    self.lock.acquire()
+    statistics = {"connections-opened": self.connections_opened,
+                  "connections-reused": self.connections_reused}
+    self.lock.release()
+    return statistics
+  
+  def _Request(self, connection, path, headers):
+    """Make a GET request, returning the response and its whole body.
+    
+    The connection is closed on any error, so that a broken connection is
+    never returned to the pool.
+    """
+    try:
+      connection.request("GET", path, headers=headers)
+      response = connection.getresponse()
+      return (response, response.read())
+    except:
+      connection.close()
+      raise
+  
+  def _GetConnection(self, host):
+    self.lock.acquire()
+    idle_connections = self.idle_connections.get(host)
+    if idle_connections:
+      connection = idle_connections.pop()
+      self.connections_reused += 1
+      self.lock.release()
+      return (connection, True)
+    self.lock.release()
+    return (self._OpenConnection(host), False)
+  
+  def _GetProxy(self, scheme, netloc):
+    """Get the netloc of the proxy to fetch URLs on the host through, if any."""
+    proxy = self.proxies.get(scheme)
+    if not proxy or urllib.proxy_bypass(netloc):
+      return None
+    if "://" not in proxy:
+      proxy = "http://" + proxy
+    return urlparse.urlsplit(proxy).netloc
+  
+  def _OpenConnection(self, host):
+    (scheme, netloc, proxy) = host
+    logging.debug("Opening a new %s connection to %s" % (scheme, netloc))
+    self.lock.acquire()
+    self.connections_opened += 1
+    self.lock.release()
+    if proxy is None:
+      if scheme == "https":
+        return httplib.HTTPSConnection(netloc)
+      return httplib.HTTPConnection(netloc)
     
+    proxy_netloc = urllib.splituser(proxy)[1]
+    if scheme == "https":
+      # HTTPS is tunnelled through the proxy with a CONNECT request.
+      connection = httplib.HTTPSConnection(proxy_netloc)
+      connection.set_tunnel(netloc, headers=self._GetProxyHeaders(proxy))
+      return connection
+    return httplib.HTTPConnection(proxy_netloc)
+  
+  def _GetProxyHeaders(self, proxy):
+    """Get the headers that authenticate requests to the proxy, if needed."""
+    user_password = urllib.splituser(proxy)[0]
+    if user_password is None:
+      return {}
+    return {"Proxy-Authorization":
+                "Basic %s" % base64.b64encode(urllib.unquote(user_password))}
+  
+  def _ReleaseConnection(self, host, connection):
+    self.lock.acquire()
+    idle_connections = self.idle_connections.setdefault(host, [])
+    if (len(idle_connections) < self.max_idle_connections or
+        self.max_idle_connections == INFINITE_PARAMETER_VALUE):
+      idle_connections.append(connection)
+      connection = None
+    self.lock.release()
+    if connection is not None:
+      connection.close()
+
+
+class ShardController(object):
+  """Tunes the operation timeout and batch size of every shard independently.
+  
+  Each shard's chain of operations starts with the parameters in the URLs from
+  the master page.  After every successful operation the controller compares
+  the wall time of the request with the platform's request deadline: cheap
+  operations that exhausted their batch get a larger source_max_entries and a
+  longer operation_timeout, and operations that came close to the deadline get
+  a smaller batch.  A failed fetch, usually a deadline error, halves both.  The
+  tuned parameters are applied to the shard's next operation.
+  
+  With adaptive tuning disabled, the only adjustment is to lower a failed
+  operation's timeout by one second before it is retried.
+  """
+  
+  def __init__(self,
+               request_deadline_sec=DEFAULT_REQUEST_DEADLINE_SEC,
+               adaptive=True):
+    self.request_deadline_sec = request_deadline_sec
+    self.adaptive = adaptive
+    self.shard_parameters = {}
+    self.lock = threading.Lock()
+  
+  def TuneUrl(self, url):
+    """Apply the shard's current tuned parameters to an operation's URL."""
+    self.lock.acquire()
+    parameters = self.shard_parameters.get(_GetShardKey(url))
+    self.lock.release()
+    if parameters is None:
+      return url
+    (timeout, max_entries) = parameters
+    url = _SetUrlParameter(url, OPERATION_TIMEOUT_SEC, timeout)
+    return _SetUrlParameter(url, SOURCE_MAX_ENTRIES, max_entries)
+  
+  def HandleSuccess(self, url, records_read, elapsed_sec):
+    """Tune a shard's parameters after an operation on url succeeded.
+    
+    args:
+      url: The URL of the operation, as fetched.
+      records_read: The number of records the operation read.
+      elapsed_sec: The wall time of the successful request.
+    """
+    if not self.adaptive:
+      return
+    parameters = self._GetUrlOperationParameters(url)
+    if parameters is None:
+      return
+    (timeout, max_entries) = parameters
+    target_sec = self.request_deadline_sec * TARGET_REQUEST_DEADLINE_FRACTION
+    if elapsed_sec > target_sec:
+      max_entries = max(int(max_entries * BATCH_SHRINK_FACTOR), 1)
+    elif elapsed_sec < target_sec / 2:
+      if records_read >= max_entries:
+        max_entries = min(max_entries * BATCH_GROWTH_FACTOR,
+                          MAX_SOURCE_MAX_ENTRIES_VALUE)
+      timeout = min(timeout + 1, target_sec)
+    self._SetShardParameters(url, timeout, max_entries)
+  
+  def HandleFailure(self, url):
+    """Tune a shard's parameters after a fetch of url failed.
+    
+    Returns:
+      The URL with which the operation should be retried.
+    """
+    parameters = self._GetUrlOperationParameters(url)
+    if parameters is None:
+      logging.warning("Could not parse the operation parameters from URL "
+                      "'%s', operation retry with original values." % url)
+      return url
+    (timeout, max_entries) = parameters
+    if self.adaptive:
+      timeout = max(timeout / 2, MIN_OPERATION_TIMEOUT_SEC_VALUE)
+      max_entries = max(int(max_entries * BATCH_SHRINK_FACTOR), 1)
+    else:
+      timeout = max(timeout - 1, MIN_OPERATION_TIMEOUT_SEC_VALUE)
+    self._SetShardParameters(url, timeout, max_entries)
+    return self.TuneUrl(url)
+  
+  def _GetUrlOperationParameters(self, url):
+    timeout = _GetUrlParameter(url, OPERATION_TIMEOUT_SEC)
+    max_entries = _GetUrlParameter(url, SOURCE_MAX_ENTRIES)
+    if timeout is None or max_entries is None:
+      return None
+    return (float(timeout), int(max_entries))
+  
+  def _SetShardParameters(self, url, timeout, max_entries):
+    logging.debug("Shard %s tuned to timeout %s, max entries %s" %
+                  (_GetShardKey(url), timeout, max_entries))
+    self.lock.acquire()
+    self.shard_parameters[_GetShardKey(url)] = (timeout, max_entries)
+    self.lock.release()
+
+
+class SpeculationController(object):
+  """Duplicates straggling operations at the tail of a phase.
+  
+  Every operation of a speculative task is run as an attempt identified by an
+  ATTEMPT token in its URL.  Once a phase is down to its last few operations,
+  any operation that has been in flight for much longer than the phase's
+  median operation is queued again under a new token.  Whichever attempt
+  completes first decides the operation: its continuation is followed and its
+  statistics are reported.  Every other attempt loses, and stops retrying.
+  Mapper sinks tag their output with the attempt, so the output of a losing
+  mapper attempt is deleted by a rollback operation.  Cleanup operations only
+  delete data, so their losing attempts need no rollback.
+  
+  Operations are identified by their URL as queued, less the ATTEMPT token.
+  A continuation may otherwise have the very URL of the operation that
+  queued it (a bulk cleanup continues from its own start point), so the
+  operations of speculative tasks are numbered in their chains with a
+  CHAIN_SEQUENCE parameter, see GetContinuationUrl.
+  """
+  
+  def __init__(self):
+    self.run_id = "%x" % random.getrandbits(32)
+    self.lock = threading.Lock()
+    self.attempts_started = 0
+    # The start time of every attempt in flight, by operation and attempt.
+    self.operations = {}
+    # The attempt speculatively started for each duplicated operation.
+    self.duplicates = {}
+    # The operations decided by an attempt while others are still in flight.
+    self.decided = set()
+    self.num_shards = 0
+    self.durations = []
+    self.speculative_attempts = 0
+    self.speculative_wins = 0
+    self.wasted_attempts = 0
+    self.wasted_sec = 0.0
+    self.rollbacks = 0
+  
+  def StartPhase(self, num_shards):
+    """Forget the durations of the previous phase's operations."""
+    self.lock.acquire()
+    self.num_shards = num_shards
+    self.durations = []
+    self.lock.release()
+  
+  def StartAttempt(self, url):
+    """Record the start of an attempt at the operation on url.
+  
+    Returns:
+      The URL of the attempt, with an ATTEMPT token for speculative tasks.
+    """
+    if _GetUrlParameter(url, TASK) not in SPECULATIVE_TASK_NAMES:
+      return url
+    self.lock.acquire()
+    attempt = _GetUrlParameter(url, ATTEMPT)
+    if attempt is None:
+      attempt = self._NewAttempt()
+      url = _SetUrlParameter(url, ATTEMPT, attempt)
+    self.operations.setdefault(self._GetOperation(url), {})[attempt] = \
+        time.time()
+    self.lock.release()
+    return url
+  
+  def FinishAttempt(self, url, elapsed_sec, succeeded):
+    """Record the outcome of an attempt.
+  
+    args:
+      url: The URL of the attempt, as returned by StartAttempt.
+      elapsed_sec: The wall time of the attempt.
+      succeeded: Whether the attempt succeeded.
+  
+    Returns:
+      True if the attempt decides its operation, so that its result or error
+      should be reported; False if it lost to another attempt, so that it
+      should be discarded.
+    """
+    attempt = _GetUrlParameter(url, ATTEMPT)
+    if attempt is None:
+      return True
+    operation = self._GetOperation(url)
+    self.lock.acquire()
+    attempts = self.operations.get(operation, {})
+    attempts.pop(attempt, None)
+    # A failed attempt only decides its operation once no other attempt may
+    # yet succeed.
+    won = operation not in self.decided and (succeeded or not attempts)
+    if won:
+      if succeeded:
+        self.durations.append(elapsed_sec)
+      if self.duplicates.get(operation) == attempt:
+        self.speculative_wins += 1
+      if attempts:
+        self.decided.add(operation)
+    else:
+      self.wasted_attempts += 1
+      self.wasted_sec += elapsed_sec
+    if not attempts:
+      self.operations.pop(operation, None)
+      self.duplicates.pop(operation, None)
+      self.decided.discard(operation)
+    self.lock.release()
+    return won
+  
+  def IsSuperseded(self, url):
+    """Whether another attempt has already decided this attempt's operation."""
+    if url is None or _GetUrlParameter(url, ATTEMPT) is None:
+      return False
+    self.lock.acquire()
+    superseded = self._GetOperation(url) in self.decided
+    self.lock.release()
+    return superseded
+  
+  def GetStragglers(self):
+    """Get the URLs of new attempts at the phase's straggling operations.
+  
+    Every operation is duplicated at most once.
+    """
+    self.lock.acquire()
+    try:
+      if len(self.durations) < SPECULATION_MIN_COMPLETED_OPERATIONS:
+        return []
+      undecided = [operation for operation in self.operations
+                   if operation not in self.decided]
+      if len(undecided) > max(1, self.num_shards * SPECULATION_TAIL_FRACTION):
+        return []
+      durations = sorted(self.durations)
+      threshold_sec = max(durations[len(durations) / 2] *
+                              SPECULATION_SLOWNESS_FACTOR,
+                          SPECULATION_MIN_ELAPSED_SEC)
+      now = time.time()
+      urls = []
+      for operation in undecided:
+        attempts = self.operations[operation]
+        if (operation in self.duplicates or not attempts or
+            now - min(attempts.values()) < threshold_sec):
+          continue
+        attempt = self._NewAttempt()
+        # The duplicate counts as in flight from when it is queued, so that
+        # the operation is not decided without it.
+        attempts[attempt] = now
+        self.duplicates[operation] = attempt
+        self.speculative_attempts += 1
+        logging.info("Speculatively duplicating straggler %s" % operation)
+        urls.append(_SetUrlParameter(operation, ATTEMPT, attempt))
+      return urls
+    finally:
+      self.lock.release()
+  
+  def GetContinuationUrl(self, url, next_url):
+    """Number the continuation of the operation on url in its chain."""
+    if _GetUrlParameter(next_url, TASK) not in SPECULATIVE_TASK_NAMES:
+      return next_url
+    sequence = int(_GetUrlParameter(url, CHAIN_SEQUENCE) or 0) + 1
+    return _SetUrlParameter(next_url, CHAIN_SEQUENCE, sequence)
+  
+  def GetRollbackUrl(self, url):
+    """Get the URL of the operation that rolls back a losing attempt.
+  
+    Returns:
+      The rollback URL, or None if the attempt's task needs no rollback.
+    """
+    if _GetUrlParameter(url, TASK) != MAPPER_TASK_NAME:
+      return None
+    self.lock.acquire()
+    self.rollbacks += 1
+    self.lock.release()
+    rollback_url = "%s?%s=%s" % (url.split("?", 1)[0],
+                                 TASK,
+                                 ROLLBACK_TASK_NAME)
+    for name in [ATTEMPT,
+                 RESPONSE_FORMAT,
+                 OPERATION_TIMEOUT_SEC,
+                 SOURCE_MAX_ENTRIES]:
+      value = _GetUrlParameter(url, name)
+      if value is not None:
+        rollback_url = _SetUrlParameter(rollback_url, name, value)
+    return rollback_url
+  
+  def GetStatistics(self):
+    self.lock.acquire()
+    statistics = {"speculative-attempts": self.speculative_attempts,
+                  "speculative-wins": self.speculative_wins,
+                  "speculative-wasted-attempts": self.wasted_attempts,
+                  "speculative-wasted-sec": self.wasted_sec,
+                  "speculative-rollbacks": self.rollbacks}
+    self.lock.release()
+    return statistics
+  
+  def _NewAttempt(self):
+    self.attempts_started += 1
+    return "%s.%d" % (self.run_id, self.attempts_started)
+  
+  def _GetOperation(self, url):
+    return _RemoveUrlParameter(url, ATTEMPT)
+
+
+class CheckpointJournal(object):
+  """Records the progress of every phase in a local file, for --resume.
+  
+  The journal is a file of JSON lines, appended to and synced as the driver
+  goes: one when a phase starts, listing the first operation URL of every
+  shard, one for every completed operation, listing the operation and the
+  URLs it queued (its continuation, a pipelined cleanup or a rollback), and
+  one when the phase is done.  Replaying the lines gives the operations that
+  were queued or in flight when the driver died.  A resumed phase queues
+  exactly those, so that every shard restarts from its last recorded
+  continuation; phases the journal records as done are skipped.
+  
+  Operations in flight when the driver died are performed again, like a
+  retried operation.  A line cut short by the driver's death is ignored.
+  
+  A run that fails cleans up all of its intermediate data, including that of
+  the shards it completed, so it is journaled as aborted, and its cleanup is
+  not journaled.  Resuming an aborted run starts it over from scratch.
+  """
+  
+  def __init__(self, path, resume=False):
+    """Open the journal.
+  
     args:
-      callback: A callable that takes one parameter, the OperationResult
-          constructed by this thread when the operation has completed, and the
-          supplied keyword arguments.
-      kwargs: Keyword arguments that should be passed to the callback.
+      path: The path of the journal file.
+      resume: Whether to resume from the journal's existing contents, rather
+          than starting a new journal.
+    """
+    self.path = path
+    self.lock = threading.Lock()
+    # Maps each phase in the journal to its first URLs, the URLs still
+    # pending, and whether it is done.
+    self.phases = {}
+    self.aborted = False
+    if resume and os.path.exists(path):
+      self._Replay()
+    mode = "w"
+    if resume:
+      mode = "a"
+    self.journal_file = open(path, mode)
+  
+  def GetPhase(self, phase_task_name):
+    """Get the journaled state of a phase.
+  
+    Returns:
+      None if the phase has not been started, or else a tuple of the phase's
+      first operation URLs, the operation URLs still pending, and whether the
+      phase is done.
     """
-    self.operation_callback = callback
-    self.operation_callback_kwargs = kwargs
+    self.lock.acquire()
+    phase = self.phases.get(phase_task_name)
+    self.lock.release()
+    if phase is None:
+      return None
+    (first_urls, pending_urls, done) = phase
+    return (list(first_urls), list(pending_urls), done)
+  
+  def StartPhase(self, phase_task_name, first_urls):
+    self._Append({"phase": phase_task_name, "first_urls": first_urls})
+  
+  def RecordOperation(self, phase_task_name, url, queued_urls):
+    """Record that an operation completed, or None, and queued URLs."""
+    self._Append({"phase": phase_task_name,
+                  "completed": url,
+                  "queued": queued_urls})
+  
+  def FinishPhase(self, phase_task_name):
+    self._Append({"phase": phase_task_name, "done": True})
+  
+  def Abort(self):
+    """Record that the run failed, forgetting every phase journaled so far."""
+    self._Append({"aborted": True})
+  
+  def IsAborted(self):
+    """Whether the last run journaled failed, and nothing was journaled since."""
+    return self.aborted
   
-  def SetUnrecoverableErrorCallback(self, callback, **kwargs):
-    """Set the callback that will be invoked on unrecoverable errors.
+  def Close(self):
+    self.journal_file.close()
+  
+  def _Append(self, record):
+    self.lock.acquire()
+    try:
+      self._Apply(record)
+      self.journal_file.write(json.dumps(record) + "\n")
+      self.journal_file.flush()
+      os.fsync(self.journal_file.fileno())
+    finally:
+      self.lock.release()
+  
+  def _Replay(self):
+    journal_file = open(self.path)
+    try:
+      for line in journal_file:
+        try:
+          record = json.loads(line)
+        except ValueError:
+          logging.warning("Ignoring a damaged journal line: %s" % line)
+          continue
+        self._Apply(record)
+    finally:
+      journal_file.close()
+  
+  def _Apply(self, record):
+    self.aborted = bool(record.get("aborted"))
+    if self.aborted:
+      self.phases = {}
+      return
+    phase_task_name = _EncodeUrl(record["phase"])
+    if "first_urls" in record:
+      first_urls = map(_EncodeUrl, record["first_urls"])
+      self.phases[phase_task_name] = \
+          (first_urls, map(self._GetOperationKey, first_urls), False)
+      return
+    (first_urls, pending_urls, done) = self.phases[phase_task_name]
+    if record.get("done"):
+      done = True
+    else:
+      if record["completed"] is not None:
+        completed = self._GetOperationKey(_EncodeUrl(record["completed"]))
+        if completed in pending_urls:
+          pending_urls.remove(completed)
+      for url in record["queued"]:
+        pending_urls.append(self._GetOperationKey(_EncodeUrl(url)))
+    self.phases[phase_task_name] = (first_urls, pending_urls, done)
+  
+  def _GetOperationKey(self, url):
+    """Attempts at the same speculative operation are the same operation."""
+    if _GetUrlParameter(url, TASK) in SPECULATIVE_TASK_NAMES:
+      return _RemoveUrlParameter(url, ATTEMPT)
+    return url
+
+
+class OperationWorker(threading.Thread):
+  """An OperationWorker executes and retries operations from a work queue.
+  
+  Each OperationWorker is a long-lived thread that repeatedly takes the URL of
+  a Map, Reduce or Cleanup operation from its driver's work queue, fetches it
+  (retrying failures), and hands the parsed OperationResult back to the driver
+  via HandleOperationResult.  If an operation fails unrecoverably (i.e., too
+  many operation failures), the driver's HandleUnrecoverableOperationError is
+  invoked instead.
+  """
+  
+  def __init__(self, driver, work_queue, max_tries):
+    """Initialize the worker.
     
     args:
-      callback: A callable that takes the failed URL as its first argument, the
-          unrecoverable exception as its second, and the supplied keyword
-          arguments.
-      kwargs: The keyword arguments that should be supplied to the callback.
+      driver: The HTTPMRDriver that results and errors should be reported to.
+      work_queue: The Queue.Queue from which operation URLs should be taken.
+      max_tries: The maximum number of times an operation can be tried, see
+          #SetMaxTries.
     """
-    self.error_callback = callback
-    self.error_callback_kwargs = kwargs
+    threading.Thread.__init__(self)
+    self.setDaemon(True)
+    self.driver = driver
+    self.work_queue = work_queue
+    self.SetMaxTries(max_tries)
   
   def SetMaxTries(self, max_tries):
     """Set the maximum number of tries that the operation can be performed.
     
     If the operation is attempted unsuccessfully more than this number of times,
     the operation is considered to fail and a TooManyTriesError is handed to the
-    unrecoverable error callback.
+    driver's unrecoverable error handler.
     """
     self.max_tries = max_tries
   
-  def SetUrl(self, url):
-    """Specify the URL that this operation should operate on."""
-    self.url = url
-    self._cancel = False
-  
   def run(self):
-    """Fetch the URL, retry on failures, invoke error or operation callbacks."""
-    assert self.url is not None
-    assert self.operation_callback is not None
-    assert self.error_callback is not None
-    self.html = None
-
-    logging.info("Starting operation on %s." % self.url)
-    
-    self.results = OperationResult()
-    self.results.url = self.url
-    
+    """Perform operations from the work queue until the process exits."""
+    while True:
+      url = self.work_queue.get()
+      try:
+        try:
+          if not self.driver.IsCancelled():
+            self._PerformOperation(url)
+        except Exception, e:
+          logging.exception("Unexpected error on operation %s" % url)
+          self.driver.HandleUnrecoverableOperationError(
+              url, UncrecoverableOperationError(e))
+      finally:
+        # The driver queues any continuation of this operation before we mark
+        # it done, so the queue only drains once every shard is finished.
+        self.work_queue.task_done()
+  
+  def _PerformOperation(self, url):
+    """Fetch the URL, retry on failures, report the result or error."""
+    operation_url = url
+    if self.driver.speculation_controller is not None:
+      url = self.driver.speculation_controller.StartAttempt(url)
+    attempt_url = url
+    start_time = time.time()
+    url = self.driver.shard_controller.TuneUrl(url)
+    logging.info("Starting operation on %s." % url)
+    results = OperationResult()
+    results.operation_url = operation_url
+    results.url = url
     try:
-      if self._cancel:
-        return
-      self.html = self._FetchWithRetries(self.url, self.max_tries)
-      logging.debug("Retrieved HTML %s" % self.html)
+      contents = self._FetchWithRetries(url,
+                                        self.max_tries,
+                                        results,
+                                        attempt_url)
+      logging.debug("Retrieved response %s" % contents)
     except UncrecoverableOperationError, e:
-      self.error_callback(self.url, e, **self.error_callback_kwargs)
-    self._PopulateResults()
-    if not self._cancel:
-      self.operation_callback(self.results, **self.operation_callback_kwargs)
+      if self._FinishAttempt(attempt_url, start_time, results, False):
+        self.driver.HandleUnrecoverableOperationError(url, e)
+      return
+    if contents is None:
+      self._FinishAttempt(attempt_url, start_time, results, False)
+      return
+    if self.driver.response_format == JSON_RESPONSE_FORMAT:
+      self._PopulateResultsFromJson(contents, results)
+    else:
+      self._PopulateResults(contents, results)
+    if not self._FinishAttempt(attempt_url, start_time, results, True):
+      return
+    records_statistic = RECORDS_READ_STATISTIC
+    if _GetUrlParameter(results.url, TASK) in CLEANUP_TASK_NAMES:
+      records_statistic = RECORDS_CLEANED_STATISTIC
+    self.driver.shard_controller.HandleSuccess(
+        results.url,
+        results.statistics.get(records_statistic, 0),
+        results.elapsed_sec)
+    self.driver.HandleOperationResult(results)
   
-  def Cancel(self):
-    self._cancel = True
+  def _FinishAttempt(self, attempt_url, start_time, results, succeeded):
+    """Report the outcome of an attempt to the SpeculationController.
+    
+    Returns:
+      Whether the attempt decides its operation, see
+      SpeculationController#FinishAttempt.  A losing attempt is handed to the
+      driver's HandleLosingAttempt.
+    """
+    speculation_controller = self.driver.speculation_controller
+    if (speculation_controller is None or
+        speculation_controller.FinishAttempt(attempt_url,
+                                             time.time() - start_time,
+                                             succeeded)):
+      return True
+    logging.info("Discarding losing attempt %s" % attempt_url)
+    self.driver.HandleLosingAttempt(attempt_url, results.tries > 0)
+    return False
   
-  def _FetchWithRetries(self, url, max_tries):
+  def _FetchWithRetries(self, url, max_tries, results, attempt_url=None):
+    """Fetch the URL, retrying failures.
+    
+    Returns:
+      The response, or None if the attempt at attempt_url was superseded by
+      another attempt at the same operation before it succeeded.
+    """
     tries = 0
     while tries < max_tries or max_tries == INFINITE_PARAMETER_VALUE:
+      if (self.driver.speculation_controller is not None and
+          self.driver.speculation_controller.IsSuperseded(attempt_url)):
+        logging.info("Abandoning superseded attempt %s" % attempt_url)
+        return None
       try:
         tries += 1
-        self.results.tries = tries
-        return self._Fetch(url)
-      except urllib2.HTTPError, e:
-        logging.warning("HTTPError on fetch of %s: %s" % (url, str(e)))
-        url = self._ReduceOperationTimeout(url)
-        self.results.errors.append(e)
+        results.tries = tries
+        results.url = url
+        start_time = time.time()
+        contents = self._Fetch(url)
+        results.elapsed_sec = time.time() - start_time
+        return contents
+      except urllib2.URLError, e:
+        logging.warning("Error on fetch of %s: %s" % (url, str(e)))
+        url = self.driver.shard_controller.HandleFailure(url)
+        results.errors.append(e)
         self._WaitForRetry(tries)
     raise TooManyTriesError("Too many tries on URL %s" % url)
   
@@ -223,10 +1083,7 @@ class OperationThread(threading.Thread):
   def _Fetch(self, url):
     safe_url = self._GetSafeUrl(url)
     logging.debug("Fetching %s" % safe_url)
-    f = urllib2.urlopen(safe_url)
-    contents = f.read()
-    f.close()
-    return contents
+    return self.driver.connection_pool.Fetch(safe_url)
   
   def _GetSafeUrl(self, url):
     parts = urlparse.urlsplit(url)
@@ -239,51 +1096,107 @@ class OperationThread(threading.Thread):
              parts.fragment)
     return urlparse.urlunsplit(parts)
 
-  def _ReduceOperationTimeout(self, url):
-    current_timeout = None
-    # TODO: Hand URL parameter parsing off to a library, here and elsewhere
-    params = url.split("?")[1]
-    for key_value in params.split("&"):
-      (key, value) = key_value.split("=", 2)
-      if key == OPERATION_TIMEOUT_SEC:
-        # At this point current_timeout is a string
-        current_timeout = value
-    if current_timeout is not None:
-      new_timeout = max(float(current_timeout) - 1,
-                        MIN_OPERATION_TIMEOUT_SEC_VALUE)
-      return url.replace("%s=%s" % (OPERATION_TIMEOUT_SEC, current_timeout),
-                         "%s=%s" % (OPERATION_TIMEOUT_SEC, new_timeout))
-    else:
-      logging.warning("Could not parse the operation timeout from URL '%s', "
-                      "operation retry with original timeout value." % url)
-      return url
-  
-  def _PopulateResults(self):
+  def _PopulateResults(self, html, results):
     parser = OperationResultHTMLParser()
-    parser.feed(self.html)
+    parser.feed(html)
     parser.close()
     
-    self.results.next_url = None
+    results.next_url = None
     if hasattr(parser, "url"):
-      self.results.next_url = parser.url
+      results.next_url = parser.url
     if hasattr(parser, "statistics"):
-      self.results.ParseStatisticsString(parser.statistics)
+      results.ParseStatisticsString(parser.statistics)
+  
+  def _PopulateResultsFromJson(self, contents, results):
+    response = json.loads(contents)
+    results.next_url = _EncodeUrl(response.get("next_url"))
+    results.statistics = response.get("statistics", {})
   
 
 class HTTPMRDriver(object):
+  """Drives an HTTPMR job through its Map, Reduce and Cleanup phases.
   
-  threads = []
-  threads_pending = []
+  Operations are performed by a fixed pool of OperationWorkers that take
+  operation URLs from a shared work queue.  Each phase starts by queueing the
+  first operation of every shard, and the continuation of each operation is
+  queued as it completes.  A phase is done when the work queue has drained.
+  
+  With speculative execution, straggling operations at the tail of the map
+  and cleanup phases are duplicated, see SpeculationController.  A phase is
+  still only done once every attempt has returned and every losing mapper
+  attempt has been rolled back, so that no later phase reads its output; the
+  win is that a shard's chain of operations carries on from the first attempt
+  to finish.  Reduce operations are never duplicated, since their output is
+  written to the job's final Sink, which cannot be rolled back.
+  """
   
   def __init__(self,
                httpmr_base,
                max_operation_tries=-1,
-               max_operations_inflight=-1):
+               max_operations_inflight=-1,
+               max_idle_connections=None,
+               response_format=JSON_RESPONSE_FORMAT,
+               request_deadline_sec=DEFAULT_REQUEST_DEADLINE_SEC,
+               adaptive_tuning=True,
+               pipelined_cleanup=True,
+               speculative_execution=False,
+               journal_path=None,
+               resume=False):
+    """Initialize the driver.
+    
+    args:
+      httpmr_base: The base URL of the HTTPMR operation.
+      max_operation_tries: The maximum number of times any operation may be
+          tried, -1 for inf.
+      max_operations_inflight: The maximum number of operations to keep
+          simultaneously inflight, -1 for inf.
+      max_idle_connections: The maximum number of idle keep-alive connections
+          to keep open to each host.  Defaults to max_operations_inflight, so
+          that every worker can hold on to its own connection.
+      response_format: The format in which HTTPMR should respond to the
+          driver's requests, JSON_RESPONSE_FORMAT or HTML_RESPONSE_FORMAT.
+      request_deadline_sec: The platform's deadline for a single request.
+      adaptive_tuning: Whether each shard's operation timeout and batch size
+          should be tuned from its results, see ShardController.
+      pipelined_cleanup: Whether each shard's intermediate data cleanup should
+          start as soon as its reduce finishes, see #ReduceAndCleanup.
+      speculative_execution: Whether straggling mapper and cleanup operations
+          should be duplicated.  The job's mapper sink must support
+          Sink#SetAttempt, and its cleaner Cleaner#CleanAttempt.
+      journal_path: The path of a file in which to journal the job's progress,
+          see CheckpointJournal, or None.
+      resume: Whether to resume the job from the journal, rather than starting
+          a new journal.
+    """
     self.httpmr_base = httpmr_base
     self.max_operation_tries = max_operation_tries
     self.max_operations_inflight = max_operations_inflight
-    self.results = []
+    if max_idle_connections is None:
+      max_idle_connections = max_operations_inflight
+    self.connection_pool = ConnectionPool(max_idle_connections)
+    assert response_format in (JSON_RESPONSE_FORMAT, HTML_RESPONSE_FORMAT)
+    self.response_format = response_format
+    self.shard_controller = ShardController(request_deadline_sec,
+                                            adaptive_tuning)
+    self.pipelined_cleanup = pipelined_cleanup
+    self.pipelining_cleanup = False
+    self.speculation_controller = None
+    if speculative_execution:
+      self.speculation_controller = SpeculationController()
+    self.journal = None
+    if journal_path is not None:
+      self.journal = CheckpointJournal(journal_path, resume)
+    # The journal of the current phase, or None if it isn't journaled.
+    self.phase_journal = None
+    self.current_phase = None
+    self.shard_start_points = {}
+    self.work_queue = Queue.Queue()
+    self.workers = []
     self.lock = threading.Lock()
+    self.operations_completed = 0
+    self.aggregate_statistics = {}
+    self.aggregate_histograms = {}
+    self.unrecoverable_error = None
     
   def Run(self):
     """Begin the Driver's Map - Reduce - Cleanup phase.
@@ -294,109 +1207,238 @@ class HTTPMRDriver(object):
     """
     logging.info("Beginning HTTPMR Driver Run with base URL %s" %
                  self.httpmr_base)
-    self.Map()
+    try:
+      if self.journal is not None and self.journal.IsAborted():
+        # The aborted run may have died before its cleanup finished.
+        logging.info("The journaled run was aborted, cleaning up after it and "
+                     "starting over.")
+        self.Cleanup(journaled=False)
+      self.Map()
+      if self.pipelined_cleanup:
+        self.ReduceAndCleanup()
+        return
+      self.Reduce()
+    except UncrecoverableOperationError, e:
+      logging.info("Going to cleanup.")
+      # The cleanup deletes the intermediate data of the shards that did
+      # complete, so the run can't be resumed from where it failed.
+      if self.journal is not None:
+        self.journal.Abort()
+      self.Cleanup(journaled=False)
+      return
+    self.Cleanup()
 
-  def _HandleUnrecoverableOperationError(self, url, error):
+  def IsCancelled(self):
+    """Whether queued operations should be skipped, after a fatal error."""
+    return self.unrecoverable_error is not None
+
+  def HandleUnrecoverableOperationError(self, url, error):
     logging.error("Unrecoverable error on url %s: %s; %s" %
                   (url, type(error), error))
-    for thread in HTTPMRDriver.threads:
-      thread.Cancel()
-    logging.info("Going to cleanup.")
-    self.Cleanup()
+    self.lock.acquire()
+    if self.unrecoverable_error is None:
+      self.unrecoverable_error = error
+    self.lock.release()
+  
+  def HandleLosingAttempt(self, url, fetched):
+    """Roll back a losing attempt, if it may have written anything."""
+    if not fetched:
+      return
+    rollback_url = self.speculation_controller.GetRollbackUrl(url)
+    if rollback_url is not None:
+      logging.debug("Queueing rollback %s" % rollback_url)
+      if self.phase_journal is not None:
+        self.phase_journal.RecordOperation(self.current_phase,
+                                           None,
+                                           [rollback_url])
+      self.work_queue.put(rollback_url)
+  
+  def HandleOperationResult(self, results):
+    """Record a completed operation's results and queue its continuation."""
+    logging.debug("Results: %s" % results)
+    self.lock.acquire()
+    self.operations_completed += 1
+    for key in results.statistics:
+      if key.endswith(HISTOGRAM_STATISTIC_SUFFIX):
+        if key not in self.aggregate_histograms:
+          self.aggregate_histograms[key] = LatencyHistogram()
+        self.aggregate_histograms[key].Decode(results.statistics[key])
+      else:
+        self.aggregate_statistics[key] = \
+            self.aggregate_statistics.get(key, 0) + results.statistics[key]
+    self.lock.release()
+    
+    queued_urls = []
+    if results.next_url is not None:
+      next_url = results.next_url
+      if self.speculation_controller is not None:
+        next_url = self.speculation_controller.GetContinuationUrl(
+            results.operation_url, next_url)
+      logging.debug("Queueing %s" % next_url)
+      queued_urls.append(next_url)
+    elif (self.pipelining_cleanup and
+          _GetUrlParameter(results.url, TASK) == REDUCER_TASK_NAME):
+      cleanup_url = self._GetCleanupUrl(results.url)
+      logging.debug("Shard reduced, queueing cleanup %s" % cleanup_url)
+      queued_urls.append(cleanup_url)
+    # The continuation is journaled before it is queued, so that the journal
+    # never loses an operation.
+    if self.phase_journal is not None:
+      self.phase_journal.RecordOperation(self.current_phase,
+                                         results.operation_url,
+                                         queued_urls)
+    for url in queued_urls:
+      self.work_queue.put(url)
     
   def Map(self):
-    self._LaunchPhase(MAP_MASTER_TASK_NAME, self._AllMapOperationsComplete)
-  
-  def _AllMapOperationsComplete(self):
+    self._RunPhase(MAP_MASTER_TASK_NAME)
     logging.info("Done Mapping!")
-    self.Reduce()
   
   def Reduce(self):
-    self._LaunchPhase(REDUCE_MASTER_TASK_NAME,
-                      self._AllReduceOperationsComplete)
-  
-  def _AllReduceOperationsComplete(self):
+    self._RunPhase(REDUCE_MASTER_TASK_NAME)
     logging.info("Done Reducing!")
-    self.Cleanup()
     
-  def Cleanup(self):
-    self._LaunchPhase(INTERMEDIATE_DATA_CLEANUP_MASTER_TASK_NAME,
-                      self._AllCleanupOperationsComplete)
-    
-  def _AllCleanupOperationsComplete(self):
+  def Cleanup(self, journaled=True):
+    self._RunPhase(INTERMEDIATE_DATA_CLEANUP_MASTER_TASK_NAME, journaled)
     logging.info("Done Cleaning Up!")
-    logging.debug("Results: %s" % self.results)
-    logging.info("Comprehensive Results: %s" % self._GetAggregateResults())
-  
-  def _GetAggregateResults(self):
-    def AddDicts(a, b):
-      sum_dict = {}
-      for key in a:
-        if key in b:
-          sum_dict[key] = a[key] + b[key]
-      return sum_dict
-    return reduce(AddDicts, map(lambda result: result.statistics,
-                                self.results))
-  
-  def _LaunchPhase(self, phase_task_name, all_operations_complete_callback):
-    logging.info("Starting %s phase." % phase_task_name)
-    base_urls = self._GetInitialUrls(phase_task_name)
+    logging.info("Comprehensive Results: %s" % self.GetAggregateResults())
+  
+  def ReduceAndCleanup(self):
+    """Reduce, cleaning up each shard's intermediate data once it is reduced.
+    
+    Reduce and cleanup operations cover the same intermediate key ranges, so
+    rather than waiting for the slowest reduce shard to finish before cleaning
+    up any of them, each shard's cleanup chain is started from its reduce
+    shard's range as soon as the reduce chain has finished.
+    """
+    self.pipelining_cleanup = True
+    try:
+      self._RunPhase(REDUCE_MASTER_TASK_NAME)
+    finally:
+      self.pipelining_cleanup = False
+    logging.info("Done Reducing and Cleaning Up!")
+    logging.info("Comprehensive Results: %s" % self.GetAggregateResults())
+  
+  def _GetCleanupUrl(self, reducer_url):
+    """Get the URL of the first cleanup operation for a reduce shard."""
+    url = _SetUrlParameter(reducer_url,
+                           TASK,
+                           INTERMEDIATE_DATA_CLEANUP_TASK_NAME)
+    return _SetUrlParameter(url,
+                            SOURCE_START_POINT,
+                            self.shard_start_points[_GetShardKey(reducer_url)])
+  
+  def GetAggregateResults(self):
+    """Get the statistics aggregated over every operation performed so far.
+    
+    Each operation's latency histogram is reported as its percentiles and
+    maximum, e.g. "write-p99" and "write-max", in seconds.
+    """
+    self.lock.acquire()
+    results = dict(self.aggregate_statistics)
+    for key in self.aggregate_histograms:
+      histogram = self.aggregate_histograms[key]
+      operation = key[:-len(HISTOGRAM_STATISTIC_SUFFIX)]
+      for percentile in REPORTED_LATENCY_PERCENTILES:
+        results["%s-p%d" % (operation, percentile)] = \
+            histogram.GetPercentile(percentile)
+      results["%s-max" % operation] = histogram.max
+    results["operations"] = self.operations_completed
+    self.lock.release()
+    results.update(self.connection_pool.GetStatistics())
+    if self.speculation_controller is not None:
+      results.update(self.speculation_controller.GetStatistics())
+    return results
+  
+  def _RunPhase(self, phase_task_name, journaled=True):
+    """Perform every operation of a phase, returning once all are complete.
+    
+    Args:
+      phase_task_name: The task name of the phase's master page.
+      journaled: Whether the phase should be journaled, if there's a journal.
+    
+    Raises:
+      UncrecoverableOperationError: If any of the phase's operations failed.
+    """
+    self.phase_journal = None
+    if journaled:
+      self.phase_journal = self.journal
+    journaled_phase = None
+    if self.phase_journal is not None:
+      journaled_phase = self.phase_journal.GetPhase(phase_task_name)
+    if journaled_phase is None:
+      logging.info("Starting %s phase." % phase_task_name)
+      base_urls = self._GetInitialUrls(phase_task_name)
+      pending_urls = base_urls
+      if self.phase_journal is not None:
+        self.phase_journal.StartPhase(phase_task_name, base_urls)
+    else:
+      (base_urls, pending_urls, done) = journaled_phase
+      if done:
+        logging.info("Skipping %s phase, journaled as done." % phase_task_name)
+        return
+      logging.info("Resuming %s phase with %d pending operations." %
+                   (phase_task_name, len(pending_urls)))
+    self.unrecoverable_error = None
+    self.current_phase = phase_task_name
     logging.debug("Initial URLs: %s" % ", ".join(base_urls))
-    self.threads_inflight = 0
+    self._StartWorkers(len(base_urls))
+    if self.speculation_controller is not None:
+      self.speculation_controller.StartPhase(len(base_urls))
     for url in base_urls:
-      thread = self._CreateOperationThread(url,
-                                           all_operations_complete_callback)
-      HTTPMRDriver.threads.append(thread)
-      if (self.threads_inflight < self.max_operations_inflight or
-          self.max_operations_inflight == INFINITE_PARAMETER_VALUE):
-        self.threads_inflight += 1
-        thread.start()
-      else:
-        HTTPMRDriver.threads_pending.append(thread)
+      self.shard_start_points[_GetShardKey(url)] = \
+          _GetUrlParameter(url, SOURCE_START_POINT)
+    for url in pending_urls:
+      self.work_queue.put(url)
+    self._WaitForPhase()
+    if self.unrecoverable_error is not None:
+      raise self.unrecoverable_error
+    if self.phase_journal is not None:
+      self.phase_journal.FinishPhase(phase_task_name)
+  
+  def _WaitForPhase(self):
+    """Wait for the work queue to drain, duplicating stragglers meanwhile."""
+    if self.speculation_controller is None:
+      self.work_queue.join()
+      return
+    joiner = threading.Thread(target=self.work_queue.join)
+    joiner.setDaemon(True)
+    joiner.start()
+    while joiner.isAlive():
+      joiner.join(SPECULATION_CHECK_INTERVAL_SEC)
+      if (joiner.isAlive() and self.work_queue.empty() and
+          not self.IsCancelled()):
+        for url in self.speculation_controller.GetStragglers():
+          self.work_queue.put(url)
+  
+  def _StartWorkers(self, num_shards):
+    """Grow the worker pool to its full size.
+    
+    The pool holds max_operations_inflight workers, or with no limit on the
+    operations inflight, one worker for every shard of the largest phase seen.
+    """
+    pool_size = self.max_operations_inflight
+    if pool_size == INFINITE_PARAMETER_VALUE:
+      pool_size = num_shards
+    while len(self.workers) < pool_size:
+      worker = OperationWorker(self, self.work_queue, self.max_operation_tries)
+      self.workers.append(worker)
+      worker.start()
 
   def _GetInitialUrls(self, task):
-    url = "%s?task=%s" % (self.httpmr_base, task) 
-    html = urllib2.urlopen(url).read()
+    url = "%s?%s=%s&%s=%s" % (self.httpmr_base,
+                              TASK,
+                              task,
+                              RESPONSE_FORMAT,
+                              self.response_format)
+    contents = self.connection_pool.Fetch(url)
+    if self.response_format == JSON_RESPONSE_FORMAT:
+      return map(_EncodeUrl, json.loads(contents)["urls"])
     parser = MasterPageResultHTMLParser()
     parser.Init()
-    parser.feed(html)
+    parser.feed(contents)
     parser.close()
     return parser.urls
-
-  def _CreateOperationThread(self, url, all_operations_complete_callback):
-    thread = OperationThread()
-    thread.SetUrl(url)
-    # TODO(peterdolan): Make the maximum operation tries configurable via a
-    # command-line parameter
-    thread.SetMaxTries(self.max_operation_tries)
-    thread.SetOperationCallback(
-        self._HandleThreadCompletion,
-        all_operations_complete_callback=all_operations_complete_callback)
-    thread.SetUnrecoverableErrorCallback(
-        self._HandleUnrecoverableOperationError)
-    return thread
-  
-  def _HandleThreadCompletion(self, results, all_operations_complete_callback):
-    self.lock.acquire()
-    self.threads_inflight -= 1
-    
-    self.results.append(results)
-    if results.next_url is not None:
-      logging.debug("Initializing new thread to handle %s" % results.next_url)
-      thread = self._CreateOperationThread(results.next_url,
-                                           all_operations_complete_callback)
-      HTTPMRDriver.threads_pending.insert(0, thread)
-
-    if HTTPMRDriver.threads_pending:
-      logging.debug("Starting the next pending thread.")
-      thread = self.threads_pending.pop()
-      self.threads_inflight += 1
-      thread.start()
-    
-    if not self.threads_inflight:
-      logging.debug("All threads completed for this phase.")
-      all_operations_complete_callback()
-    self.lock.release()
   
 
 def main():
@@ -428,6 +1470,73 @@ def main():
                             help="The maximum number of times any given "
                                 + "operation can fail before a fatal error is"
                                 + " thrown.  -1 for inf.")
+  options_parser.add_option("-k",
+                            "--max_idle_connections",
+                            action="store",
+                            type="int",
+                            dest="max_idle_connections",
+                            default=None,
+                            help="The maximum number of idle keep-alive "
+                                + "connections to keep open per host.  "
+                                + "Defaults to --max_operations_inflight, -1 "
+                                + "for inf.")
+  options_parser.add_option("-r",
+                            "--response_format",
+                            action="store",
+                            type="choice",
+                            choices=[JSON_RESPONSE_FORMAT,
+                                     HTML_RESPONSE_FORMAT],
+                            dest="response_format",
+                            default=JSON_RESPONSE_FORMAT,
+                            help="The format HTTPMR should respond in, "
+                                + "json or html.")
+  options_parser.add_option("-d",
+                            "--request_deadline_sec",
+                            action="store",
+                            type="float",
+                            dest="request_deadline_sec",
+                            default=DEFAULT_REQUEST_DEADLINE_SEC,
+                            help="The platform's deadline for a single "
+                                + "request, in seconds.")
+  options_parser.add_option("-n",
+                            "--no_adaptive_tuning",
+                            action="store_false",
+                            dest="adaptive_tuning",
+                            default=True,
+                            help="Use the master's operation timeout and "
+                                + "batch size for every operation instead "
+                                + "of tuning them per shard.")
+  options_parser.add_option("-p",
+                            "--no_pipelined_cleanup",
+                            action="store_false",
+                            dest="pipelined_cleanup",
+                            default=True,
+                            help="Start the intermediate data cleanup phase "
+                                + "only once every shard has been reduced, "
+                                + "instead of cleaning up each shard as soon "
+                                + "as it is reduced.")
+  options_parser.add_option("-s",
+                            "--speculative_execution",
+                            action="store_true",
+                            dest="speculative_execution",
+                            default=False,
+                            help="Duplicate straggling mapper and cleanup "
+                                + "operations at the tail of each phase.")
+  options_parser.add_option("-j",
+                            "--journal",
+                            action="store",
+                            type="string",
+                            dest="journal",
+                            default=None,
+                            help="A local file in which to journal the job's "
+                                + "progress, so that it can be resumed.")
+  options_parser.add_option("--resume",
+                            action="store_true",
+                            dest="resume",
+                            default=False,
+                            help="Resume the job recorded in --journal, "
+                                + "restarting every shard from its last "
+                                + "recorded continuation.")
   options_parser.add_option("-c",
                             "--cleanup_only",
                             action="store_true",
@@ -436,10 +1545,20 @@ def main():
                             help="Only execute the intermediate data cleanup "
                                 + "phase.")
   (options, args) = options_parser.parse_args()
+  if options.resume and options.journal is None:
+    options_parser.error("--resume requires --journal")
   
   driver = HTTPMRDriver(options.httpmr_base,
                         options.max_per_operation_failures,
-                        options.max_operations_inflight)
+                        options.max_operations_inflight,
+                        options.max_idle_connections,
+                        options.response_format,
+                        options.request_deadline_sec,
+                        options.adaptive_tuning,
+                        options.pipelined_cleanup,
+                        options.speculative_execution,
+                        options.journal,
+                        options.resume)
   if options.cleanup_only:
     driver.Cleanup()
   else:
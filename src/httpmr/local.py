@@ -0,0 +1,251 @@
+"""Runs a MapReduce job in-process, across a pool of local worker processes.
+
+The LocalRunner takes the same Mapper, Reducer, Source, Sink and Combiner
+objects as Master.QuickInit, but instead of handing out work through HTTP
+requests it maps every shard in a multiprocessing pool, shuffles the
+intermediate data in memory and reduces across the pool again.  Map and reduce
+shards are planned with the same sharding module the Master uses.
+
+Sample usage, for a job whose data fits on one machine:
+
+  statistics = local.LocalRunner().QuickInit("construct_token_index",
+                                             mapper=TokenMapper(),
+                                             reducer=TokenReducer(),
+                                             source=source,
+                                             sink=sink).Run()
+
+Worker processes are forked from the running process, so the job's objects
+need not be picklable, but the pairs output by Mappers and Reducers must be.
+Each map shard runs in a freshly forked worker, so a Source that keeps state
+between calls to Get starts every shard as this process left it.
+"""
+
+import bisect
+import logging
+import multiprocessing
+import time
+from httpmr import base
+from httpmr import sharding
+from httpmr import sinks
+
+DEFAULT_SOURCE_MAX_ENTRIES = 1000
+DEFAULT_COMBINER_MAX_BUFFERED_VALUES = 10000
+
+# The runner whose job the pool's worker processes perform.  Set before the
+# pool is forked, so the workers inherit it.
+_runner = None
+
+
+class _ListSink(base.Sink):
+  """Collects every pair Put to it in memory."""
+
+  def __init__(self):
+    self.pairs = []
+
+  def Put(self, key, value):
+    self.pairs.append((key, value))
+
+
+def _MapShard(boundary_tuple):
+  return _runner._MapShard(boundary_tuple)
+
+
+def _ReduceShard(keys_values):
+  return _runner._ReduceShard(keys_values)
+
+
+class LocalRunner(object):
+  """Runs a MapReduce job in-process, see the module documentation."""
+
+  def __init__(self):
+    self._combiner = None
+    self._num_shards = sharding.DEFAULT_NUM_SHARDS
+    self._num_processes = multiprocessing.cpu_count()
+    self._source_max_entries = DEFAULT_SOURCE_MAX_ENTRIES
+
+  def QuickInit(self,
+                jobname,
+                mapper=None,
+                reducer=None,
+                source=None,
+                sink=None,
+                combiner=None,
+                num_shards=sharding.DEFAULT_NUM_SHARDS):
+    assert jobname is not None
+    self._jobname = jobname
+    self.SetMapper(mapper)
+    self.SetReducer(reducer)
+    self.SetSource(source)
+    self.SetSink(sink)
+    self.SetCombiner(combiner)
+    self.SetNumShards(num_shards)
+    return self
+
+  def SetMapper(self, mapper):
+    assert isinstance(mapper, base.Mapper)
+    self._mapper = mapper
+    return self
+
+  def SetReducer(self, reducer):
+    assert isinstance(reducer, base.Reducer)
+    self._reducer = reducer
+    return self
+
+  def SetSource(self, source):
+    assert isinstance(source, base.Source)
+    self._source = source
+    return self
+
+  def SetSink(self, sink):
+    assert isinstance(sink, base.Sink)
+    self._sink = sink
+    return self
+
+  def SetCombiner(self, combiner):
+    assert combiner is None or isinstance(combiner, base.Combiner)
+    self._combiner = combiner
+    return self
+
+  def SetNumShards(self, num_shards):
+    assert num_shards > 0
+    self._num_shards = num_shards
+    return self
+
+  def SetNumProcesses(self, num_processes):
+    """Set the number of worker processes."""
+    assert num_processes > 0
+    self._num_processes = num_processes
+    return self
+
+  def SetSourceMaxEntries(self, source_max_entries):
+    """Set the number of entries read from the Source by each Get."""
+    assert source_max_entries > 0
+    self._source_max_entries = source_max_entries
+    return self
+
+  def Run(self):
+    """Run the job to completion.
+
+    Returns:
+      A dict of statistics about the run: record counts, and the wall time of
+      each phase in seconds.
+    """
+    global _runner
+    logging.info("Beginning local run of %s with %d processes." %
+                 (self._jobname, self._num_processes))
+    statistics = {}
+    _runner = self
+    try:
+      start_time = time.time()
+      intermediate_data = self._Map(statistics)
+      statistics["map-time-sec"] = time.time() - start_time
+
+      start_time = time.time()
+      reduce_shards = self._Shuffle(intermediate_data, statistics)
+      del intermediate_data
+      statistics["shuffle-time-sec"] = time.time() - start_time
+
+      start_time = time.time()
+      self._Reduce(reduce_shards, statistics)
+      statistics["reduce-time-sec"] = time.time() - start_time
+    finally:
+      _runner = None
+    logging.info("Done with local run of %s: %s" % (self._jobname, statistics))
+    return statistics
+
+  def _PoolMap(self, function, arguments, maxtasksperchild=None):
+    pool = multiprocessing.Pool(self._num_processes,
+                                maxtasksperchild=maxtasksperchild)
+    try:
+      return pool.map(function, arguments, chunksize=1)
+    finally:
+      pool.close()
+      pool.join()
+
+  def _Map(self, statistics):
+    boundaries = sharding.GetShardBoundaries(self._source, self._num_shards)
+    shard_results = self._PoolMap(_MapShard,
+                                  sharding.GetShardBoundaryTuples(boundaries),
+                                  maxtasksperchild=1)
+    intermediate_data = []
+    statistics["map-count"] = 0
+    for (values_mapped, pairs) in shard_results:
+      statistics["map-count"] += values_mapped
+      intermediate_data.extend(pairs)
+    statistics["intermediate-values"] = len(intermediate_data)
+    return intermediate_data
+
+  def _MapShard(self, boundary_tuple):
+    """Map every entry of one shard, returning the intermediate pairs."""
+    (start_point, end_point) = boundary_tuple
+    output = _ListSink()
+    sink = output
+    if self._combiner is not None:
+      sink = sinks.CombiningSink(output,
+                                 self._combiner,
+                                 DEFAULT_COMBINER_MAX_BUFFERED_VALUES)
+    values_mapped = 0
+    while True:
+      last_key_mapped = None
+      batch_values_mapped = 0
+      for (key, value) in self._source.Get(start_point,
+                                           end_point,
+                                           self._source_max_entries):
+        for (output_key, output_value) in self._mapper.Map(key, value):
+          sink.Put(output_key, output_value)
+        last_key_mapped = key
+        batch_values_mapped += 1
+      if last_key_mapped is None:
+        break
+      values_mapped += batch_values_mapped
+      cursor = self._source.GetCursor(batch_values_mapped)
+      if cursor is None:
+        start_point = last_key_mapped
+      else:
+        self._source.SetCursor(cursor)
+    sink.Flush()
+    return (values_mapped, output.pairs)
+
+  def _Shuffle(self, intermediate_data, statistics):
+    """Group the intermediate data by key and split it into reduce shards."""
+    if not intermediate_data:
+      statistics["reduce-shards"] = 0
+      return []
+    intermediate_data.sort(key=lambda pair: pair[0])
+    keys_values = []
+    for (key, value) in intermediate_data:
+      if keys_values and keys_values[-1][0] == key:
+        keys_values[-1][1].append(value)
+      else:
+        keys_values.append((key, [value]))
+
+    boundaries = sharding.GetShardBoundariesFromSample(
+        [pair[0] for pair in intermediate_data], self._num_shards)
+    # Shard i holds the keys k with boundaries[i] < k <= boundaries[i+1].
+    inner_boundaries = boundaries[1:-1]
+    reduce_shards = [[] for i in xrange(len(inner_boundaries) + 1)]
+    for (key, values) in keys_values:
+      reduce_shards[bisect.bisect_left(inner_boundaries, key)].append(
+          (key, values))
+    statistics["reduce-shards"] = len(reduce_shards)
+    return reduce_shards
+
+  def _Reduce(self, reduce_shards, statistics):
+    statistics["reduce-count"] = 0
+    statistics["write-count"] = 0
+    for (keys_reduced, pairs) in self._PoolMap(_ReduceShard, reduce_shards):
+      statistics["reduce-count"] += keys_reduced
+      for (output_key, output_value) in pairs:
+        self._sink.Put(output_key, output_value)
+        statistics["write-count"] += 1
+    self._sink.Flush()
+    statistics.update(self._sink.GetCounters())
+
+  def _ReduceShard(self, keys_values):
+    """Reduce every key of one shard, returning the output pairs."""
+    output = []
+    for (key, values) in keys_values:
+      if self._reducer.iterate_values:
+        values = iter(values)
+      output.extend(self._reducer.Reduce(key, values))
+    return (len(keys_values), output)
@@ -1,4 +1,4 @@
-from httmr import base
+from httpmr import base
 
 class IdentityMapper(base.Mapper):
   
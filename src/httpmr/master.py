@@ -1,11 +1,16 @@
+import base64
+import itertools
 import logging
+import math
 import os
-import string
+import sys
 import time
+from django.utils import simplejson
 from google.appengine.ext import webapp
 from google.appengine.ext.webapp import template
 from httpmr import base
 from httpmr import driver
+from httpmr import sharding
 from httpmr import sinks
 from wsgiref import handlers
 
@@ -20,137 +25,274 @@ class MissingRequiredParameterError(Error): pass
 # instance, when a mapper task is completed, the name of the template that will
 # be rendered is MAPPER_TASK_NAME + ".html"
 #
-# The *_MASTER_TASK_NAME constants are defined in the driver module because the
-# driver should be a standalone file (to facilitate ease of use, one can simply
-# copy that file around by itself).
+# The task names the driver needs to know about (the *_MASTER_TASK_NAME
+# constants, the task names it pipelines, speculates on or rolls back) are
+# defined in the driver module because the driver should be a standalone file
+# (to facilitate ease of use, one can simply copy that file around by itself).
 MAP_MASTER_TASK_NAME = driver.MAP_MASTER_TASK_NAME
-MAPPER_TASK_NAME = "mapper"
+MAPPER_TASK_NAME = driver.MAPPER_TASK_NAME
 REDUCE_MASTER_TASK_NAME = driver.REDUCE_MASTER_TASK_NAME
-REDUCER_TASK_NAME = "reducer"
+REDUCER_TASK_NAME = driver.REDUCER_TASK_NAME
 INTERMEDIATE_DATA_CLEANUP_MASTER_TASK_NAME = \
     driver.INTERMEDIATE_DATA_CLEANUP_MASTER_TASK_NAME
-INTERMEDIATE_DATA_CLEANUP_TASK_NAME = "cleanup"
+INTERMEDIATE_DATA_CLEANUP_TASK_NAME = \
+    driver.INTERMEDIATE_DATA_CLEANUP_TASK_NAME
+ROLLBACK_TASK_NAME = driver.ROLLBACK_TASK_NAME
 VALID_TASK_NAMES = [MAP_MASTER_TASK_NAME,
                     MAPPER_TASK_NAME,
                     REDUCE_MASTER_TASK_NAME,
                     REDUCER_TASK_NAME,
                     INTERMEDIATE_DATA_CLEANUP_MASTER_TASK_NAME,
-                    INTERMEDIATE_DATA_CLEANUP_TASK_NAME]
+                    INTERMEDIATE_DATA_CLEANUP_TASK_NAME,
+                    ROLLBACK_TASK_NAME]
 
-SOURCE_START_POINT = "source_start_point"
-SOURCE_END_POINT = "source_end_point"
-SOURCE_MAX_ENTRIES = "source_max_entries"
+SOURCE_START_POINT = driver.SOURCE_START_POINT
+SOURCE_END_POINT = driver.SOURCE_END_POINT
+SOURCE_MAX_ENTRIES = driver.SOURCE_MAX_ENTRIES
+PARTITION = driver.PARTITION
+ATTEMPT = driver.ATTEMPT
+# Mapper tasks resume the scan of a Source that supports cursors from the
+# cursor, rather than after the last key mapped, see Source#SetCursor.
+SOURCE_CURSOR = "source_cursor"
+# Reducer tasks that reduce a single key with a PartialReducer, a slice of its
+# values at a time, carry the position of the key's next slice and the key's
+# state so far, see GetReducer.
+PARTIAL_REDUCE_POSITION = "partial_reduce_position"
+PARTIAL_REDUCE_STATE = "partial_reduce_state"
+DEFAULT_SOURCE_MAX_ENTRIES = 1000
 OPERATION_TIMEOUT_SEC = driver.OPERATION_TIMEOUT_SEC
+RESPONSE_FORMAT = driver.RESPONSE_FORMAT
+HTML_RESPONSE_FORMAT = driver.HTML_RESPONSE_FORMAT
+JSON_RESPONSE_FORMAT = driver.JSON_RESPONSE_FORMAT
 DEFAULT_OPERATION_TIMEOUT_SEC = 10
-GREATEST_UNICODE_CHARACTER = "\xEF\xBF\xBD"
+DEFAULT_COMBINER_MAX_BUFFERED_VALUES = 10000
+DEFAULT_STATISTICS_SAMPLE_RATE = 1
+# Keys with more values than this are reduced in slices by a PartialReducer,
+# by default the most values a single Datastore query can return.
+DEFAULT_PARTIAL_REDUCE_THRESHOLD = 1000
+# The maximum number of entries a bulk cleanup deletes with each Cleaner#Clean.
+DEFAULT_CLEANUP_BATCH_SIZE = 500
+# The weight of each completed task in the DeadlineTracker's running estimates
+# of the time a task takes, the number of standard deviations over the average
+# that the next task is predicted to take, and the fraction of the operation
+# timeout reserved for finishing up once tasks have stopped.
+DEADLINE_EWMA_WEIGHT = 0.2
+DEADLINE_COST_DEVIATIONS = 3
+DEADLINE_RESERVE_FRACTION = 0.05
+GREATEST_UNICODE_CHARACTER = sharding.GREATEST_UNICODE_CHARACTER
+DEFAULT_NUM_SHARDS = sharding.DEFAULT_NUM_SHARDS
 
-
-def tobase(base, number):
-  """Ugly.
-  
-  I really wish I didn't have to copy this over, why doesn't Python have a
-  built-in function for representing an int as a string in an arbitrary base?
-  
-  Copied from:
-    http://www.megasolutions.net/python/How-to-convert-a-number-to-binary_-78436.aspx
-  """
-  number = int(number) 
-  base = int(base)         
-  if base < 2 or base > 36: 
-    raise ValueError, "Base must be between 2 and 36"     
-  if not number: 
-    return 0
-  symbols = string.digits + string.lowercase[:26] 
-  answer = [] 
-  while number: 
-    number, remainder = divmod(number, base) 
-    answer.append(symbols[remainder])       
-  return ''.join(reversed(answer)) 
-
-def tob36(number):
-  return tobase(36, number)
+tobase = sharding.tobase
+tob36 = sharding.tob36
 
 
-class TaskSetTimer(object):
+class DeadlineTracker(object):
+  """Predicts whether another task fits before an operation's deadline.
+  
+  Keeps an exponentially weighted moving average and variance of the time
+  each task takes, updated in constant time as tasks complete.  The next task
+  is predicted to take the average plus DEADLINE_COST_DEVIATIONS standard
+  deviations, and tasks are started until that prediction no longer fits
+  before the deadline, less a DEADLINE_RESERVE_FRACTION of the timeout that
+  is kept for flushing sinks and responding.
+  """
   
   def __init__(self, timeout_sec=10.0):
     self.timeout_sec = timeout_sec
-    self.task_completion_times = []
+    self.tasks_completed = 0
+    self.mean_task_sec = 0.0
+    self.task_sec_variance = 0.0
   
   def Start(self):
     self.start_time = time.time()
+    self.last_completion_time = self.start_time
+    self.stop_time = (self.start_time +
+                      self.timeout_sec * (1 - DEADLINE_RESERVE_FRACTION))
   
   def TaskCompleted(self):
-    self.task_completion_times.append(time.time())
+    now = time.time()
+    task_sec = now - self.last_completion_time
+    self.last_completion_time = now
+    self.tasks_completed += 1
+    if self.tasks_completed == 1:
+      self.mean_task_sec = task_sec
+      return
+    difference = task_sec - self.mean_task_sec
+    increment = DEADLINE_EWMA_WEIGHT * difference
+    self.mean_task_sec += increment
+    self.task_sec_variance = ((1 - DEADLINE_EWMA_WEIGHT) *
+                              (self.task_sec_variance + difference * increment))
+  
+  def GetPredictedTaskSec(self):
+    return (self.mean_task_sec +
+            DEADLINE_COST_DEVIATIONS * math.sqrt(self.task_sec_variance))
+  
+  def GetRemainingCapacity(self):
+    """Get the number of tasks predicted to fit before the deadline.
+    
+    Returns None until a task has completed, as there is no estimate yet.
+    """
+    if self.tasks_completed == 0:
+      return None
+    remaining_sec = self.stop_time - time.time()
+    if remaining_sec <= 0:
+      return 0
+    predicted_task_sec = self.GetPredictedTaskSec()
+    if predicted_task_sec <= 0:
+      return sys.maxint
+    return int(remaining_sec / predicted_task_sec)
   
   def ShouldStop(self):
-    if len(self.task_completion_times) == 0:
+    """Whether to stop before the next task, which would miss the deadline.
+    
+    Never stops before the first task has completed, so that every operation
+    makes progress.
+    """
+    if self.tasks_completed == 0:
       return False
-    max_execution_time = 0
-    for i in xrange(len(self.task_completion_times)):
-      if i == 0: continue
-      start_time = self.task_completion_times[i-1]
-      end_time = self.task_completion_times[i]
-      max_execution_time = max(max_execution_time,
-                               end_time - start_time)
-    worst_case_completion_time = time.time() + max_execution_time
-    worst_case_completion_time_since_start_time = \
-        worst_case_completion_time - self.start_time
-    return (worst_case_completion_time_since_start_time >
-            self.timeout_sec * 0.8)
+    return (time.time() + self.GetPredictedTaskSec()) > self.stop_time
 
 
 class OperationStatistics(object):
+  """Times and counts a task's operations.
+  
+  Besides the total time and count of each operation, a LatencyHistogram of
+  each operation's latency is kept.  The time spent on an operation between
+  two calls to Count is one latency sample, so an operation that is timed in
+  several pieces (a map interleaved with its writes, say) is still sampled
+  once.  Time not followed by a Count, such as a final sink flush, is sampled
+  when the statistics are reported.
+  
+  Timing every operation of every record can cost as much as a cheap Mapper,
+  so the operations of only one record in every sample_rate are timed; see
+  BeginRecord.  Counts are always exact, and the time spent on records is
+  extrapolated from the sampled records when the statistics are reported.
+  """
   
   READ = "read"
   WRITE = "write"
   MAP = "map"
   REDUCE = "reduce"
+  ACCUMULATE = "accumulate"
   CLEAN = "clean"
   _valid_operation_names = [READ,
                             WRITE,
                             MAP,
                             REDUCE,
+                            ACCUMULATE,
                             CLEAN]
   
-  def __init__(self):
+  def __init__(self, sample_rate=1):
+    assert sample_rate >= 1
     self._operation_statistics = {}
+    self._record_time = {}
+    self._histograms = {}
+    self._unsampled_time = {}
     for name in self._valid_operation_names:
       self._operation_statistics[name] = 0
       self._operation_statistics[self._GetCounterName(name)] = 0
+      self._record_time[name] = 0
+      self._histograms[name] = driver.LatencyHistogram()
+      self._unsampled_time[name] = None
     self._started = False
+    self._sample_rate = sample_rate
+    self._records = 0
+    self._sampled_records = 0
+    self._in_record = False
+    self._timing = True
   
   def _GetCounterName(self, operation_name):
     return operation_name + "-count"
   
+  def BeginRecord(self):
+    """Mark the start of the next record's operations.
+    
+    Operations started from here until the next call to BeginRecord or
+    EndRecords are timed only if this record is one of the sampled records.
+    """
+    self._in_record = True
+    self._timing = self._records % self._sample_rate == 0
+    if self._timing:
+      self._sampled_records += 1
+    self._records += 1
+  
+  def EndRecords(self):
+    """Mark the end of the per-record operations, timing every operation."""
+    self._in_record = False
+    self._timing = True
+  
   def Start(self, operation):
     assert not self._started
-    assert operation in self._valid_operation_names
     self._started = True
     self._operation = operation
-    self._last_operation_time = time.time()
+    self._timed = self._timing
+    if self._timed:
+      assert operation in self._valid_operation_names
+      self._timed_in_record = self._in_record
+      self._last_operation_time = time.time()
   
   def _Increment(self, name):
-    self._operation_statistics[name] += time.time() - self._last_operation_time
+    elapsed = time.time() - self._last_operation_time
+    if self._timed_in_record:
+      self._record_time[name] += elapsed
+    else:
+      self._operation_statistics[name] += elapsed
+    self._unsampled_time[name] = (self._unsampled_time[name] or 0) + elapsed
+  
+  def Count(self, name, count=1):
+    """Count operations of the given name, timed together as one sample."""
+    self._operation_statistics[self._GetCounterName(name)] += count
+    self._Sample(name)
   
-  def Count(self, name):
-    self._operation_statistics[self._GetCounterName(name)] += 1
+  def _Sample(self, name):
+    if self._unsampled_time[name] is not None:
+      self._histograms[name].Add(self._unsampled_time[name])
+      self._unsampled_time[name] = None
   
   def Stop(self):
     assert self._started
     self._started = False
-    self._Increment(self._operation)
+    if self._timed:
+      self._Increment(self._operation)
+  
+  def AddCounters(self, counters):
+    """Add the supplied {name: number} counters to the reported statistics."""
+    for name in counters:
+      self._operation_statistics[name] = \
+          self._operation_statistics.get(name, 0) + counters[name]
   
   def GetStatistics(self):
+    statistics = self.GetStatisticsDict()
     lines = []
-    for key in self._operation_statistics:
-      lines.append("%s %s" % (key, self._operation_statistics[key]))
+    for key in statistics:
+      lines.append("%s %s" % (key, statistics[key]))
     return "\n".join(lines)
+  
+  def GetStatisticsDict(self):
+    """Get every statistic, including each operation's encoded histogram."""
+    statistics = dict(self._operation_statistics)
+    for name in self._valid_operation_names:
+      if self._sampled_records:
+        statistics[name] += (self._record_time[name] * self._records /
+                             self._sampled_records)
+      self._Sample(name)
+      if self._histograms[name].count:
+        statistics[name + driver.HISTOGRAM_STATISTIC_SUFFIX] = \
+            self._histograms[name].Encode()
+    return statistics
 
 
 class Master(webapp.RequestHandler):
   """The MapReduce master coordinates mappers, reducers, and data."""
   
+  _combiner = None
+  _cleaner = None
+  _num_partitions = None
+  _combiner_max_buffered_values = DEFAULT_COMBINER_MAX_BUFFERED_VALUES
+  _num_shards = DEFAULT_NUM_SHARDS
+  _statistics_sample_rate = DEFAULT_STATISTICS_SAMPLE_RATE
+  _partial_reduce_threshold = DEFAULT_PARTIAL_REDUCE_THRESHOLD
+  
   def QuickInit(self,
                 jobname,
                 mapper=None,
@@ -158,12 +300,16 @@ class Master(webapp.RequestHandler):
                 source=None,
                 mapper_sink=None,
                 reducer_source=None,
-                sink=None):
+                sink=None,
+                combiner=None,
+                num_shards=DEFAULT_NUM_SHARDS):
     logging.debug("Beginning QuickInit.")
     assert jobname is not None
     self._jobname = jobname
     self.SetMapper(mapper)
     self.SetReducer(reducer)
+    self.SetCombiner(combiner)
+    self.SetNumShards(num_shards)
     self.SetSource(source)
     self.SetMapperSink(mapper_sink)
     self.SetReducerSource(reducer_source)
@@ -183,6 +329,72 @@ class Master(webapp.RequestHandler):
     self._reducer = reducer
     return self
   
+  def SetCombiner(self, combiner):
+    """Set the Combiner that pre-aggregates each mapper task's output.
+    
+    If combiner is None, mapper output is written to the mapper sink as-is.
+    """
+    assert combiner is None or isinstance(combiner, base.Combiner)
+    self._combiner = combiner
+    return self
+  
+  def SetCombinerMaxBufferedValues(self, max_buffered_values):
+    """Set how many mapper output values may be held for the Combiner.
+    
+    When a mapper task has buffered more than this many values, they are
+    combined and written out early rather than at the end of the task.
+    """
+    assert max_buffered_values > 0
+    self._combiner_max_buffered_values = max_buffered_values
+    return self
+  
+  def SetNumShards(self, num_shards):
+    """Set the number of shards each phase's data should be split into.
+    
+    Shard boundaries are planned from a sample of the keys of each phase's
+    Source, so that the shards hold roughly equal amounts of data.
+    """
+    assert num_shards > 0
+    self._num_shards = num_shards
+    return self
+
+  def SetNumPartitions(self, num_partitions):
+    """Set the number of partitions the mapper sink's output is split into.
+    
+    With partitioned intermediate data, every reduce and cleanup shard covers
+    one whole partition rather than a range of intermediate keys.  The mapper
+    sink must assign each key to a partition with a Partitioner over the same
+    number of partitions, and the reducer source and Cleaner must support
+    SetPartition.  None, the default, shards the intermediate data by key
+    range.
+    """
+    assert num_partitions is None or num_partitions > 0
+    self._num_partitions = num_partitions
+    return self
+
+  def SetStatisticsSampleRate(self, sample_rate):
+    """Time the operations of only one in every sample_rate records.
+
+    Mapper and Reducer tasks report exact counts, and operation times
+    extrapolated from the sampled records.  A sample_rate of 1, the default,
+    times every operation, which is the most precise but costs the most.
+    """
+    assert sample_rate >= 1
+    self._statistics_sample_rate = sample_rate
+    return self
+
+  def SetPartialReduceThreshold(self, partial_reduce_threshold):
+    """Set how many values a key may have before it is reduced in slices.
+
+    Only applies to a PartialReducer.  The values of keys with at most this
+    many values are read into memory and reduced at once, and larger keys are
+    accumulated by reducer tasks of their own.  The threshold is independent
+    of the number of values a reducer task reads, which the driver may tune.
+    """
+    assert partial_reduce_threshold > 0
+    self._partial_reduce_threshold = partial_reduce_threshold
+    return self
+
   def SetCleanupMapper(self, cleanup_mapper):
     """Set the Mapper that should be used to clean up the intermediate data.
     
@@ -193,6 +405,15 @@ class Master(webapp.RequestHandler):
     assert isinstance(cleanup_mapper, base.Mapper)
     self._cleanup_mapper = cleanup_mapper
     return self
+  
+  def SetCleaner(self, cleaner):
+    """Set the Cleaner that should delete the intermediate data in bulk.
+    
+    If a Cleaner is set, cleanup tasks use it instead of the cleanup Mapper.
+    """
+    assert cleaner is None or isinstance(cleaner, base.Cleaner)
+    self._cleaner = cleaner
+    return self
     
   def SetSource(self, source):
     """Set the data source from which mapper input should be read."""
@@ -239,63 +460,105 @@ class Master(webapp.RequestHandler):
       template_data = self.GetCleanupMaster()
     elif task == INTERMEDIATE_DATA_CLEANUP_TASK_NAME:
       template_data = self.GetCleanupMapper()
+    elif task == ROLLBACK_TASK_NAME:
+      template_data = self.GetRollback()
     else:
       raise UnknownTaskError("Task name '%s' is not recognized.  Valid task "
                              "values are %s" % (task, VALID_TASK_NAMES))
-    self.RenderResponse("%s.html" % task, template_data)
+    
+    if (self.request.params.get(RESPONSE_FORMAT, HTML_RESPONSE_FORMAT) ==
+        JSON_RESPONSE_FORMAT):
+      self.RenderJsonResponse(template_data)
+    else:
+      self.RenderResponse("%s.html" % task, template_data)
   
   def _TaskUrl(self, path_data):
     logging.debug("Rendering next url with path data %s" % path_data)
+    # Subsequent tasks respond in the same format, and work on the same
+    # partition, as the current one.
+    path_data = dict(path_data)
+    for name in (RESPONSE_FORMAT, PARTITION):
+      if name in self.request.params and name not in path_data:
+        path_data[name] = self.request.params[name]
     params = []
     for key in path_data:
       params.append("%s=%s" % (key, path_data[key]))
     return ("%s?%s" % (self.request.path_url, "&".join(params)))
   
-  def _GetShardBoundaries(self):
-    # TODO(peterdolan): Expand this to allow an arbitrary number of shards
-    # instead of a fixed set of 36 shards.
-    boundaries = [""]
-    for i in xrange(35):
-      j = (i + 1)
-      boundaries.append(tob36(j))
-    boundaries.append(GREATEST_UNICODE_CHARACTER)
-    return boundaries
-  
-  def _GetShardBoundaryTuples(self):
-    boundaries = self._GetShardBoundaries()
-    boundary_tuples = []
-    for i in xrange(len(boundaries)):
-      if i == 0:
-        continue
-      boundary_tuples.append((boundaries[i-1], boundaries[i]))
-    return boundary_tuples
+  def _GetShardBoundaryTuples(self, source):
+    boundaries = sharding.GetShardBoundaries(source, self._num_shards)
+    return sharding.GetShardBoundaryTuples(boundaries)
   
-  def _GetUrlsForShards(self, task):
+  def _GetUrlsForShards(self, task, source):
     urls = []
-    for boundary_tuple in self._GetShardBoundaryTuples():
-      start_point = boundary_tuple[0]
-      end_point = boundary_tuple[1]
-      
-      timeout = DEFAULT_OPERATION_TIMEOUT_SEC
-      if OPERATION_TIMEOUT_SEC in self.request.params:
-        timeout = float(self.request.params[OPERATION_TIMEOUT_SEC])
-      
-      urls.append(self._TaskUrl({"task": task,
-                                 SOURCE_START_POINT: start_point,
-                                 SOURCE_END_POINT: end_point,
-                                 SOURCE_MAX_ENTRIES: 1000,
-                                 OPERATION_TIMEOUT_SEC: timeout}))
+    for boundary_tuple in self._GetShardBoundaryTuples(source):
+      urls.append(self._GetFirstTaskUrl(task,
+                                        {SOURCE_START_POINT: boundary_tuple[0],
+                                         SOURCE_END_POINT: boundary_tuple[1]}))
     return urls
   
+  def _GetUrlsForIntermediateShards(self, task):
+    """Get the first task URLs of shards of the intermediate data.
+    
+    Partitioned intermediate data has a shard per partition, covering every
+    key, and otherwise the reducer source is sharded by key range.
+    """
+    if self._num_partitions is None:
+      return self._GetUrlsForShards(task, self._reducer_source)
+    urls = []
+    for partition in xrange(self._num_partitions):
+      urls.append(self._GetFirstTaskUrl(task,
+                                        {PARTITION: partition,
+                                         SOURCE_START_POINT: "",
+                                         SOURCE_END_POINT:
+                                             GREATEST_UNICODE_CHARACTER}))
+    return urls
+  
+  def _GetFirstTaskUrl(self, task, path_data):
+    timeout = DEFAULT_OPERATION_TIMEOUT_SEC
+    if OPERATION_TIMEOUT_SEC in self.request.params:
+      timeout = float(self.request.params[OPERATION_TIMEOUT_SEC])
+    
+    max_entries = DEFAULT_SOURCE_MAX_ENTRIES
+    if SOURCE_MAX_ENTRIES in self.request.params:
+      max_entries = int(self.request.params[SOURCE_MAX_ENTRIES])
+    
+    path_data = dict(path_data)
+    path_data.update({"task": task,
+                      SOURCE_MAX_ENTRIES: max_entries,
+                      OPERATION_TIMEOUT_SEC: timeout})
+    return self._TaskUrl(path_data)
+  
+  def _SelectPartition(self):
+    """Restrict the intermediate data to the task's partition, if it has one."""
+    if PARTITION not in self.request.params:
+      return
+    partition = int(self.request.params[PARTITION])
+    self._reducer_source.SetPartition(partition)
+    if self._cleaner is not None:
+      self._cleaner.SetPartition(partition)
+  
   def GetMapMaster(self):
     """Handle Map controlling page."""
-    return {'urls': self._GetUrlsForShards(MAPPER_TASK_NAME)}
+    return {'urls': self._GetUrlsForShards(MAPPER_TASK_NAME, self._source)}
 
   def GetMapper(self):
-    """Handle mapper tasks."""
+    """Handle mapper tasks.
+    
+    A driver that speculatively executes mapper tasks identifies each attempt
+    at a task, and the mapper sink tags its output with the attempt, so that
+    the output of attempts that lose can be rolled back, see GetRollback.
+    """
+    if ATTEMPT in self.request.params:
+      self._mapper_sink.SetAttempt(self.request.params[ATTEMPT])
+    sink = self._mapper_sink
+    if self._combiner is not None:
+      sink = sinks.CombiningSink(sink,
+                                 self._combiner,
+                                 self._combiner_max_buffered_values)
     return self._GetGeneralMapper(self._mapper,
                                   self._source,
-                                  self._mapper_sink,
+                                  sink,
                                   OperationStatistics.MAP)
   
   def _GetGeneralMapper(self, mapper, source, sink, operation_statistics_name):
@@ -308,7 +571,7 @@ class Master(webapp.RequestHandler):
     assert isinstance(sink, base.Sink)
     
     # Initialize the statistics object, to time the operations for reporting
-    statistics = OperationStatistics()
+    statistics = OperationStatistics(self._statistics_sample_rate)
 
     # Grab the parameters for this map task from the URL
     task = self.request.params["task"]
@@ -317,12 +580,16 @@ class Master(webapp.RequestHandler):
     max_entries = int(self.request.params[SOURCE_MAX_ENTRIES])
     timeout = float(self.request.params[OPERATION_TIMEOUT_SEC])
     
+    if SOURCE_CURSOR in self.request.params:
+      source.SetCursor(
+          self._DecodeUrlValue(self.request.params[SOURCE_CURSOR]))
+    
     statistics.Start(OperationStatistics.READ)
     mapper_data = source.Get(start_point, end_point, max_entries)
     statistics.Stop()
     
     # Initialize the timer, and begin timing our operations
-    timer = TaskSetTimer(timeout)
+    timer = DeadlineTracker(timeout)
     timer.Start()
     
     last_key_mapped = None
@@ -339,6 +606,7 @@ class Master(webapp.RequestHandler):
       statistics.Count(OperationStatistics.READ)
       if timer.ShouldStop():
         break
+      statistics.BeginRecord()
       key = key_value_pair[0]
       value = key_value_pair[1]
       statistics.Start(operation_statistics_name)
@@ -357,27 +625,54 @@ class Master(webapp.RequestHandler):
       values_mapped += 1
       timer.TaskCompleted()
       statistics.Start(OperationStatistics.READ)
+    else:
+      statistics.Stop()
+    statistics.EndRecords()
+    
+    self._FlushSink(sink, statistics)
     
     next_url = None
     if values_mapped > 0:
       logging.debug("Completed %d map operations" % values_mapped)
-      next_url = self._TaskUrl({"task": task,
-                                SOURCE_START_POINT: last_key_mapped,
-                                SOURCE_END_POINT: end_point,
-                                SOURCE_MAX_ENTRIES: max_entries,
-                                OPERATION_TIMEOUT_SEC: timeout})
+      path_data = {"task": task,
+                   SOURCE_START_POINT: last_key_mapped,
+                   SOURCE_END_POINT: end_point,
+                   SOURCE_MAX_ENTRIES: max_entries,
+                   OPERATION_TIMEOUT_SEC: timeout}
+      cursor = source.GetCursor(values_mapped)
+      if cursor is not None:
+        # A cursor is only valid for the query it was taken from.
+        path_data[SOURCE_START_POINT] = start_point
+        path_data[SOURCE_CURSOR] = self._EncodeUrlValue(cursor)
+      next_url = self._TaskUrl(path_data)
     else:
       next_url = None
     return { "next_url": next_url,
-             "statistics": statistics.GetStatistics() }
+             "statistics": statistics }
+      
+  def _FlushSink(self, sink, statistics):
+    """Write out anything the sink has buffered, before the task responds."""
+    statistics.Start(OperationStatistics.WRITE)
+    sink.Flush()
+    statistics.Stop()
+    statistics.AddCounters(sink.GetCounters())
       
   def GetReduceMaster(self):
     """Handle Reduce controlling page."""
-    return {'urls': self._GetUrlsForShards(REDUCER_TASK_NAME)}
+    return {'urls': self._GetUrlsForIntermediateShards(REDUCER_TASK_NAME)}
 
   def GetReducer(self):
-    """Handle reducer tasks."""
-    statistics = OperationStatistics()
+    """Handle reducer tasks.
+    
+    With a PartialReducer, a key with more values than the partial reduce
+    threshold is not reduced with the keys before it.  The task stops before
+    the key, and the key is reduced by a chain of tasks of its own, each of
+    which accumulates slices of the key's values until it runs out of time.
+    The last of them finalizes the key, and the reducer chain carries on after
+    it.
+    """
+    self._SelectPartition()
+    statistics = OperationStatistics(self._statistics_sample_rate)
     
     # Grab the parameters for this map task from the URL
     #
@@ -387,38 +682,61 @@ class Master(webapp.RequestHandler):
     max_entries = int(self.request.params[SOURCE_MAX_ENTRIES])
     timeout = float(self.request.params[OPERATION_TIMEOUT_SEC])
     
+    if PARTIAL_REDUCE_POSITION in self.request.params:
+      return self._GetPartialReducer(start_point,
+                                     end_point,
+                                     max_entries,
+                                     timeout,
+                                     statistics)
+    
+    max_values_per_key = None
+    if isinstance(self._reducer, base.PartialReducer):
+      max_values_per_key = self._partial_reduce_threshold
     reducer_keys_values = self._GetReducerKeyValues(start_point,
                                                     end_point,
                                                     max_entries,
-                                                    statistics)
+                                                    statistics,
+                                                    max_values_per_key)
     
     last_key_reduced = None
     keys_reduced = 0
+    partial_key = None
     # Initialize the timer, and begin timing our operations
-    timer = TaskSetTimer(timeout)
+    timer = DeadlineTracker(timeout)
     timer.Start()
-    for key in reducer_keys_values:
+    statistics.Start(OperationStatistics.READ)
+    for (key, values) in reducer_keys_values:
+      statistics.Stop()
       if timer.ShouldStop():
         break
-      values = reducer_keys_values[key]
-      statistics.Start(OperationStatistics.REDUCE)
-      for (output_key, output_value) in self._reducer.Reduce(key, values):
-        statistics.Stop()
-        
-        statistics.Start(OperationStatistics.WRITE)
-        self._sink.Put(output_key, output_value)
-        statistics.Stop()
-        statistics.Count(OperationStatistics.WRITE)
-        
-        statistics.Start(OperationStatistics.REDUCE)
-      statistics.Stop()
-      statistics.Count(OperationStatistics.REDUCE)
+      if values is None:
+        # The key has too many values to reduce here, reduce it in slices.
+        partial_key = key
+        break
+      statistics.BeginRecord()
+      self._ReduceKey(self._reducer.Reduce(key, values), statistics)
+      # Keys are reduced in ascending order, so every key up to and including
+      # this one is done, and the next task can resume right after it.
       last_key_reduced = key
       keys_reduced += 1
       timer.TaskCompleted()
+      statistics.Start(OperationStatistics.READ)
+    else:
+      statistics.Stop()
+    statistics.EndRecords()
+    
+    self._FlushSink(self._sink, statistics)
     
     next_url = None
-    if keys_reduced > 0:
+    if partial_key is not None:
+      next_url = self._GetPartialReducerUrl(partial_key,
+                                            end_point,
+                                            max_entries,
+                                            timeout,
+                                            "",
+                                            self._reducer.Initialize(
+                                                partial_key))
+    elif keys_reduced > 0:
       logging.debug("Completed %d reduce operations" % keys_reduced)
       next_url = self._TaskUrl({"task": REDUCER_TASK_NAME,
                                 SOURCE_START_POINT: last_key_reduced,
@@ -428,49 +746,254 @@ class Master(webapp.RequestHandler):
     else:
       next_url = None
     return { "next_url": next_url,
-             "statistics": statistics.GetStatistics() }
+             "statistics": statistics }
+  
+  def _GetPartialReducer(self,
+                         key,
+                         end_point,
+                         max_entries,
+                         timeout,
+                         statistics):
+    """Accumulate slices of a single key's values until time runs out.
+    
+    The key's values are read a slice of up to max_entries values at a time,
+    and the key is finalized once its last slice has been accumulated.
+    """
+    position = self.request.params[PARTIAL_REDUCE_POSITION]
+    state = self._reducer.DecodeState(
+        self._DecodeUrlValue(self.request.params[PARTIAL_REDUCE_STATE]))
+    
+    timer = DeadlineTracker(timeout)
+    timer.Start()
+    while position is not None and not timer.ShouldStop():
+      statistics.Start(OperationStatistics.READ)
+      (values, position) = self._reducer_source.GetKeySlice(key,
+                                                            position,
+                                                            max_entries)
+      statistics.Stop()
+      statistics.Count(OperationStatistics.READ, len(values))
+      if self._reducer.iterate_values:
+        values = iter(values)
+      statistics.Start(OperationStatistics.ACCUMULATE)
+      state = self._reducer.Accumulate(key, state, values)
+      statistics.Stop()
+      statistics.Count(OperationStatistics.ACCUMULATE)
+      timer.TaskCompleted()
+    
+    if position is not None:
+      next_url = self._GetPartialReducerUrl(key,
+                                            end_point,
+                                            max_entries,
+                                            timeout,
+                                            position,
+                                            state)
+    else:
+      statistics.BeginRecord()
+      self._ReduceKey(self._reducer.Finalize(key, state), statistics)
+      statistics.EndRecords()
+      self._FlushSink(self._sink, statistics)
+      next_url = self._TaskUrl({"task": REDUCER_TASK_NAME,
+                                SOURCE_START_POINT: key,
+                                SOURCE_END_POINT: end_point,
+                                SOURCE_MAX_ENTRIES: max_entries,
+                                OPERATION_TIMEOUT_SEC: timeout})
+    return { "next_url": next_url,
+             "statistics": statistics }
+  
+  def _GetPartialReducerUrl(self,
+                            key,
+                            end_point,
+                            max_entries,
+                            timeout,
+                            position,
+                            state):
+    return self._TaskUrl({"task": REDUCER_TASK_NAME,
+                          SOURCE_START_POINT: key,
+                          SOURCE_END_POINT: end_point,
+                          SOURCE_MAX_ENTRIES: max_entries,
+                          OPERATION_TIMEOUT_SEC: timeout,
+                          PARTIAL_REDUCE_POSITION: position,
+                          PARTIAL_REDUCE_STATE: self._EncodeUrlValue(
+                              self._reducer.EncodeState(state))})
+  
+  def _EncodeUrlValue(self, value):
+    """Encode an arbitrary string to be passed as a URL parameter value."""
+    if isinstance(value, unicode):
+      value = value.encode("utf-8")
+    return base64.urlsafe_b64encode(value).rstrip("=")
+  
+  def _DecodeUrlValue(self, encoded_value):
+    padding = "=" * (-len(encoded_value) % 4)
+    return base64.urlsafe_b64decode(str(encoded_value) + padding)
+  
+  def _ReduceKey(self, reduced_pairs, statistics):
+    """Write the pairs output by a Reducer for a key, timing the reduction."""
+    statistics.Start(OperationStatistics.REDUCE)
+    for (output_key, output_value) in reduced_pairs:
+      statistics.Stop()
+      
+      statistics.Start(OperationStatistics.WRITE)
+      self._sink.Put(output_key, output_value)
+      statistics.Stop()
+      statistics.Count(OperationStatistics.WRITE)
+      
+      statistics.Start(OperationStatistics.REDUCE)
+    statistics.Stop()
+    statistics.Count(OperationStatistics.REDUCE)
   
   def _GetReducerKeyValues(self,
                            start_point,
                            end_point,
                            max_entries,
-                           statistics):
-    statistics.Start(OperationStatistics.READ)
+                           statistics,
+                           max_values_per_key=None):
+    """Generate a (key, values) tuple for each key, in ascending key order.
+    
+    The reducer source's data is streamed one key at a time, so only a single
+    key's values are ever held in memory.  The Source interface specification
+    guarantees that the data arrives in ascending order by key, and that we will
+    retrieve every intermediate value for a given key.
+    
+    For a Reducer that iterates its values, the values are generated as an
+    iterator that reads them from the source as it is consumed, so not even
+    one key's values are held in memory.  The values of the next key are only
+    read once the reducer is done with the key.
+    
+    A key with more than max_values_per_key values is generated with None for
+    its values, and should be the last key read.  The values of keys with at
+    most max_values_per_key values are read before they are generated, so
+    that their number is known, and iterated over from memory.
+    """
     reducer_data = self._reducer_source.Get(start_point, end_point, max_entries)
-    statistics.Stop()
+    for (key, key_value_pairs) in itertools.groupby(reducer_data,
+                                                    lambda pair: pair[0]):
+      if self._reducer.iterate_values and max_values_per_key is None:
+        yield key, self._IterateReducerValues(key_value_pairs, statistics)
+        continue
+      values = []
+      for key_value_pair in key_value_pairs:
+        if (max_values_per_key is not None and
+            len(values) == max_values_per_key):
+          values = None
+          break
+        statistics.Count(OperationStatistics.READ)
+        values.append(key_value_pair[1].intermediate_value)
+      if values is not None and self._reducer.iterate_values:
+        values = iter(values)
+      yield key, values
+  
+  def _IterateReducerValues(self, key_value_pairs, statistics):
+    """Read the values for a key as the reducer consumes them.
     
-    # Retrieve the mapped data from the datastore and sort it by key.
-    #
-    # The Source interface specification guarantees that we will retrieve every
-    # intermediate value for a given key.
-    reducer_keys_values = {}
-    statistics.Start(OperationStatistics.READ)
-    for key_value_pair in reducer_data:
+    The reads are timed as part of the reduce.
+    """
+    for key_value_pair in key_value_pairs:
       statistics.Count(OperationStatistics.READ)
-      key = key_value_pair[0]
-      value = key_value_pair[1].intermediate_value
-      if key in reducer_keys_values:
-        reducer_keys_values[key].append(value)
-      else:
-        reducer_keys_values[key] = [value]
-    statistics.Stop()
-    return reducer_keys_values
-  
+      yield key_value_pair[1].intermediate_value
     
   def GetCleanupMaster(self):
     """Handle Cleanup controlling page."""
-    return {'urls': self._GetUrlsForShards(INTERMEDIATE_DATA_CLEANUP_TASK_NAME)}
+    return {'urls': self._GetUrlsForIntermediateShards(
+        INTERMEDIATE_DATA_CLEANUP_TASK_NAME)}
   
   def GetCleanupMapper(self):
     """Handle Cleanup Mapper tasks."""
+    self._SelectPartition()
+    if self._cleaner is not None:
+      return self._GetBulkCleanup()
     return self._GetGeneralMapper(self._cleanup_mapper,
                                   self._reducer_source,
                                   sinks.NoOpSink(),
                                   OperationStatistics.CLEAN)
   
+  def _GetBulkCleanup(self):
+    """Handle Cleanup tasks with the Cleaner, in batches.
+    
+    Cleaned entries drop out of the shard's range, so every batch, and the next
+    task, starts from the same start point.
+    """
+    start_point = self.request.params[SOURCE_START_POINT]
+    end_point = self.request.params[SOURCE_END_POINT]
+    def Clean(batch_size):
+      return self._cleaner.Clean(start_point, end_point, batch_size)
+    return self._GetBatchedCleanup({"task": INTERMEDIATE_DATA_CLEANUP_TASK_NAME,
+                                    SOURCE_START_POINT: start_point,
+                                    SOURCE_END_POINT: end_point},
+                                   Clean)
+  
+  def GetRollback(self):
+    """Handle Rollback tasks, which delete the output of a mapper attempt.
+    
+    When a driver speculatively executes a mapper task, every attempt but the
+    one whose continuation the driver follows is rolled back.
+    """
+    attempt = self.request.params[ATTEMPT]
+    def Clean(batch_size):
+      return self._cleaner.CleanAttempt(attempt, batch_size)
+    return self._GetBatchedCleanup({"task": ROLLBACK_TASK_NAME,
+                                    ATTEMPT: attempt},
+                                   Clean)
+  
+  def _GetBatchedCleanup(self, task_path_data, clean):
+    """Clean in batches until everything is cleaned, or time runs out.
+    
+    Args:
+      task_path_data: The path data identifying the task, for the next URL.
+      clean: A function that cleans up to the given number of entries, and
+        returns how many it cleaned.  The cleaning is done once a batch comes
+        up short.
+    """
+    statistics = OperationStatistics()
+    max_entries = int(self.request.params[SOURCE_MAX_ENTRIES])
+    timeout = float(self.request.params[OPERATION_TIMEOUT_SEC])
+    
+    timer = DeadlineTracker(timeout)
+    timer.Start()
+    entries_cleaned = 0
+    range_cleaned = False
+    while entries_cleaned < max_entries and not timer.ShouldStop():
+      batch_size = min(max_entries - entries_cleaned,
+                       DEFAULT_CLEANUP_BATCH_SIZE)
+      statistics.Start(OperationStatistics.CLEAN)
+      batch_cleaned = clean(batch_size)
+      statistics.Stop()
+      statistics.Count(OperationStatistics.CLEAN, batch_cleaned)
+      entries_cleaned += batch_cleaned
+      timer.TaskCompleted()
+      if batch_cleaned < batch_size:
+        range_cleaned = True
+        break
+    
+    next_url = None
+    if not range_cleaned:
+      logging.debug("Cleaned %d entries" % entries_cleaned)
+      path_data = dict(task_path_data)
+      path_data.update({SOURCE_MAX_ENTRIES: max_entries,
+                        OPERATION_TIMEOUT_SEC: timeout})
+      next_url = self._TaskUrl(path_data)
+    return { "next_url": next_url,
+             "statistics": statistics }
+  
   def RenderResponse(self, template_name, template_data):
     path = os.path.join(os.path.dirname(__file__),
                         'templates',
                         template_name)
     logging.debug("Rendering template at path %s" % path)
-    self.response.out.write(template.render(path, template_data))
\ No newline at end of file
+    if "statistics" in template_data:
+      template_data = dict(template_data)
+      template_data["statistics"] = template_data["statistics"].GetStatistics()
+    self.response.out.write(template.render(path, template_data))
+  
+  def RenderJsonResponse(self, template_data):
+    """Write the task's results as a compact JSON object.
+    
+    Statistics are written as a JSON object of numbers, rather than the lines
+    of text rendered into the HTML templates.
+    """
+    if "statistics" in template_data:
+      template_data = dict(template_data)
+      template_data["statistics"] = \
+          template_data["statistics"].GetStatisticsDict()
+    self.response.headers["Content-Type"] = "application/json"
+    self.response.out.write(simplejson.dumps(template_data,
+                                             separators=(",", ":")))
\ No newline at end of file
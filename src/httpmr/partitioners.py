@@ -0,0 +1,13 @@
+import zlib
+from httpmr import base
+
+class HashPartitioner(base.Partitioner):
+  """Spreads keys evenly over the partitions, whatever their order or skew.
+  
+  Uses CRC-32, which is cheap and the same on every machine and Python build.
+  """
+  
+  def Partition(self, key, num_partitions):
+    if isinstance(key, unicode):
+      key = key.encode("utf-8")
+    return (zlib.crc32(str(key)) & 0xffffffff) % num_partitions
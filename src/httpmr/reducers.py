@@ -2,25 +2,56 @@ from httpmr import base
 
 class IdentityReducer(base.Reducer):
   
+  iterate_values = True
+  
   def Reduce(self, key, values):
     for value in values:
       yield key, value
 
 
-class SumReducer(base.Reducer):
+class SumReducer(base.PartialReducer):
   
-  def Reduce(self, key, values):
-    sum = 0
+  iterate_values = True
+  
+  def Initialize(self, key):
+    return 0
+  
+  def Accumulate(self, key, sum, values):
     for value in values:
       try:
         sum += int(value)
       except ValueError, e:
         # TODO: Log the error
         pass
+    return sum
+  
+  def Finalize(self, key, sum):
     yield key, sum
+  
+  def EncodeState(self, sum):
+    return str(sum)
+  
+  def DecodeState(self, encoded_sum):
+    return int(encoded_sum)
 
 
-class CountReducer(base.Reducer):
+class CountReducer(base.PartialReducer):
   
-  def Reduce(self, key, values):
-    yield key, str(len(values))
\ No newline at end of file
+  iterate_values = True
+  
+  def Initialize(self, key):
+    return 0
+  
+  def Accumulate(self, key, count, values):
+    for value in values:
+      count += 1
+    return count
+  
+  def Finalize(self, key, count):
+    yield key, str(count)
+  
+  def EncodeState(self, count):
+    return str(count)
+  
+  def DecodeState(self, encoded_count):
+    return int(encoded_count)
@@ -0,0 +1,113 @@
+"""Planning of the key ranges that split a job's data into shards.
+
+Shards are described by an ascending list of boundaries.  Shard i covers the
+keys k with boundaries[i] < k <= boundaries[i+1], which matches the range
+restrictions of the Source interface.
+
+This module has no webapp dependencies, so that anything that needs to split a
+job's work the same way the Master does can use it.
+"""
+
+import logging
+import string
+
+
+GREATEST_UNICODE_CHARACTER = "\xEF\xBF\xBD"
+DEFAULT_NUM_SHARDS = 36
+# How many key samples to request from a Source for each shard planned.
+KEY_SAMPLES_PER_SHARD = 2
+
+
+def tobase(base, number):
+  """Ugly.
+  
+  I really wish I didn't have to copy this over, why doesn't Python have a
+  built-in function for representing an int as a string in an arbitrary base?
+  
+  Copied from:
+    http://www.megasolutions.net/python/How-to-convert-a-number-to-binary_-78436.aspx
+  """
+  number = int(number) 
+  base = int(base)         
+  if base < 2 or base > 36: 
+    raise ValueError, "Base must be between 2 and 36"     
+  if not number: 
+    return 0
+  symbols = string.digits + string.lowercase[:26] 
+  answer = [] 
+  while number: 
+    number, remainder = divmod(number, base) 
+    answer.append(symbols[remainder])       
+  return ''.join(reversed(answer)) 
+
+def tob36(number):
+  return tobase(36, number)
+
+
+def GetFixedShardBoundaries():
+  """Get the 36 data-independent base-36 shard boundaries.
+  
+  Used when a Source cannot sample its keys.
+  """
+  boundaries = [""]
+  for i in xrange(35):
+    j = (i + 1)
+    boundaries.append(tob36(j))
+  boundaries.append(GREATEST_UNICODE_CHARACTER)
+  return boundaries
+
+
+def GetShardBoundariesFromSample(key_sample, num_shards):
+  """Choose boundaries that split the sampled keys into num_shards even shards.
+  
+  Fewer than num_shards shards result if the sample holds too few distinct keys
+  to split it that finely, and a single shard over the whole key range if the
+  sample is empty.
+  """
+  assert num_shards > 0
+  keys = sorted(key_sample)
+  if not keys:
+    return ["", GREATEST_UNICODE_CHARACTER]
+  boundaries = [""]
+  for i in xrange(1, num_shards):
+    boundary = keys[i * len(keys) // num_shards]
+    if boundary > boundaries[-1]:
+      boundaries.append(boundary)
+  boundaries.append(GREATEST_UNICODE_CHARACTER)
+  return boundaries
+
+
+def GetShardBoundaries(source, num_shards):
+  """Plan num_shards shard boundaries from the key distribution of source.
+  
+  Args:
+    source: The base.Source whose data should be sharded
+    num_shards: The number of shards desired
+  
+  Returns:
+    An ascending list of shard boundaries, the first of which is "" and the last
+    of which is GREATEST_UNICODE_CHARACTER.
+  """
+  key_sample = source.GetKeySample(num_shards * KEY_SAMPLES_PER_SHARD)
+  if key_sample is None:
+    logging.warning("Source %s cannot sample its keys, using the fixed base-36 "
+                    "shard boundaries." % source)
+    return GetFixedShardBoundaries()
+  if len(key_sample) < num_shards:
+    logging.info("Sampled only %d keys of %s for %d shards, using the fixed "
+                 "base-36 shard boundaries." %
+                 (len(key_sample), source, num_shards))
+    return GetFixedShardBoundaries()
+  logging.debug("Planning %d shards from %d sampled keys." %
+                (num_shards, len(key_sample)))
+  return GetShardBoundariesFromSample(key_sample, num_shards)
+
+
+def GetShardBoundaryTuples(boundaries):
+  """Get the (start_point, end_point) tuple of every shard."""
+  boundary_tuples = []
+  for i in xrange(len(boundaries)):
+    if i == 0:
+      continue
+    boundary_tuples.append((boundaries[i-1], boundaries[i]))
+  return boundary_tuples
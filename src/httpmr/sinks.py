@@ -7,4 +7,59 @@ class NoOpSink(base.Sink):
   
   def Put(self, key, value):
     """No-op.  Equivalent to ... > /dev/null."""
-    pass
\ No newline at end of file
+    pass
+
+class CombiningSink(base.Sink):
+  """Runs a Combiner over output buffered in memory before writing it out.
+  
+  Values Put to this sink are grouped by key in memory.  When more than
+  max_buffered_values values are buffered, and whenever the sink is flushed,
+  every buffered key's values are handed to the Combiner and the combined pairs
+  are Put to the wrapped sink.
+  """
+  
+  def __init__(self, sink, combiner, max_buffered_values):
+    assert isinstance(sink, base.Sink)
+    assert isinstance(combiner, base.Combiner)
+    assert max_buffered_values > 0
+    self._sink = sink
+    self._combiner = combiner
+    self._max_buffered_values = max_buffered_values
+    self._buffer = {}
+    self._num_buffered_values = 0
+    self._values_combined = 0
+    self._values_output = 0
+    self._combines = 0
+  
+  def Put(self, key, value):
+    if key in self._buffer:
+      self._buffer[key].append(value)
+    else:
+      self._buffer[key] = [value]
+    self._num_buffered_values += 1
+    if self._num_buffered_values > self._max_buffered_values:
+      self._Combine()
+  
+  def _Combine(self):
+    buffer = self._buffer
+    self._buffer = {}
+    self._num_buffered_values = 0
+    for key in buffer:
+      self._values_combined += len(buffer[key])
+      for (output_key, output_value) in self._combiner.Combine(key,
+                                                               buffer[key]):
+        self._sink.Put(output_key, output_value)
+        self._values_output += 1
+    self._combines += 1
+  
+  def Flush(self):
+    if self._buffer:
+      self._Combine()
+    self._sink.Flush()
+  
+  def GetCounters(self):
+    counters = dict(self._sink.GetCounters())
+    counters["combiner-input-values"] = self._values_combined
+    counters["combiner-output-values"] = self._values_output
+    counters["combiner-flushes"] = self._combines
+    return counters
@@ -0,0 +1,131 @@
+"""Stock Codecs, for storing intermediate values compactly.
+
+Declare one for a job with the intermediate_values_codec argument of
+AppEngineMaster#QuickInit.  Composite values are encoded with the Codecs of
+their elements, for example a (token, count) pair with
+TupleCodec(StringCodec(), IntCodec()).
+"""
+
+import struct
+from httpmr import base
+
+# Signed fixed-width integer encodings, by width in bytes.
+_INT_STRUCTS = dict([(struct.calcsize(format), struct.Struct(format))
+                     for format in ["!b", "!h", "!i", "!q"]])
+_FLOAT_STRUCT = struct.Struct("!d")
+
+
+class IntCodec(base.Codec):
+  """Encodes integers in as few of 1, 2, 4 or 8 bytes as they fit.
+  
+  Values are converted with int(), so numeric strings such as the "1"s output
+  by CountMapper are accepted too, though outputting ints saves converting
+  them.  Integers too large for 8 bytes are encoded in decimal, which is never
+  1, 2, 4 or 8 digits long for them.
+  """
+  
+  def Encode(self, value):
+    value = int(value)
+    for width in sorted(_INT_STRUCTS):
+      if -(1 << (8 * width - 1)) <= value < (1 << (8 * width - 1)):
+        return _INT_STRUCTS[width].pack(value)
+    return str(value)
+  
+  def Decode(self, encoded_value):
+    int_struct = _INT_STRUCTS.get(len(encoded_value))
+    if int_struct is None:
+      return long(encoded_value)
+    return int_struct.unpack(encoded_value)[0]
+
+
+class FloatCodec(base.Codec):
+  """Encodes floats as 8-byte IEEE 754 doubles, exactly."""
+  
+  def Encode(self, value):
+    return _FLOAT_STRUCT.pack(float(value))
+  
+  def Decode(self, encoded_value):
+    return _FLOAT_STRUCT.unpack(encoded_value)[0]
+
+
+class StringCodec(base.Codec):
+  """Encodes strings as UTF-8, decoding them as unicode."""
+  
+  def Encode(self, value):
+    if isinstance(value, unicode):
+      return value.encode("utf-8")
+    return str(value)
+  
+  def Decode(self, encoded_value):
+    return encoded_value.decode("utf-8")
+
+
+def _EncodeLength(length):
+  """Encode a non-negative integer in 7-bit groups, low group first."""
+  encoded = []
+  while length > 0x7f:
+    encoded.append(chr(0x80 | (length & 0x7f)))
+    length >>= 7
+  encoded.append(chr(length))
+  return "".join(encoded)
+
+
+def _SplitElements(encoded_value):
+  """Split a str of length-prefixed elements into the elements."""
+  elements = []
+  position = 0
+  while position < len(encoded_value):
+    length = 0
+    shift = 0
+    while True:
+      byte = ord(encoded_value[position])
+      position += 1
+      length |= (byte & 0x7f) << shift
+      shift += 7
+      if byte < 0x80:
+        break
+    elements.append(encoded_value[position:position + length])
+    position += length
+  return elements
+
+
+def _JoinElements(elements):
+  return "".join(["%s%s" % (_EncodeLength(len(element)), element)
+                  for element in elements])
+
+
+class TupleCodec(base.Codec):
+  """Encodes fixed-length tuples, each element with its own Codec.
+  
+  Every element is prefixed with its length, which costs a single byte for
+  elements of up to 127 bytes.
+  """
+  
+  def __init__(self, *codecs):
+    for codec in codecs:
+      assert isinstance(codec, base.Codec)
+    self._codecs = codecs
+  
+  def Encode(self, value):
+    assert len(value) == len(self._codecs)
+    return _JoinElements([codec.Encode(element)
+                          for (codec, element) in zip(self._codecs, value)])
+  
+  def Decode(self, encoded_value):
+    return tuple([codec.Decode(element) for (codec, element)
+                  in zip(self._codecs, _SplitElements(encoded_value))])
+
+
+class ListCodec(base.Codec):
+  """Encodes lists of any length, every element with the same Codec."""
+  
+  def __init__(self, codec):
+    assert isinstance(codec, base.Codec)
+    self._codec = codec
+  
+  def Encode(self, value):
+    return _JoinElements([self._codec.Encode(element) for element in value])
+  
+  def Decode(self, encoded_value):
+    return [self._codec.Decode(element)
+            for element in _SplitElements(encoded_value)]